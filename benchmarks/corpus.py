@@ -0,0 +1,94 @@
+"""
+Synthetic corpora for the INCA benchmarks.
+
+All corpora are generated from a seeded random generator, so runs with the
+same size and seed use identical documents.
+"""
+
+import os
+import random
+import datetime
+
+WORDS = (
+    "de het een en van in is dat op te zijn voor met die niet aan er om "
+    "ook als bij of nog wel naar dan uit kabinet minister regering kamer "
+    "partij verkiezingen europa gemeente economie belasting zorg onderwijs "
+    "politie rechter klimaat energie woningmarkt werkgelegenheid onderzoek "
+    "burgers bedrijven miljoen procent jaar week vandaag gisteren morgen"
+).split()
+
+DOCTYPES = ["nu", "nos", "volkskrant", "telegraaf", "trouw"]
+
+MONTHS = [
+    "January",
+    "February",
+    "March",
+    "April",
+    "May",
+    "June",
+    "July",
+    "August",
+    "September",
+    "October",
+    "November",
+    "December",
+]
+
+
+def _text(rng, words):
+    return " ".join(rng.choice(WORDS) for _ in range(words))
+
+
+def articles(n, seed=42, words=300, doctypes=DOCTYPES):
+    """Returns `n` scraped news articles with the fields of an RSS scraper"""
+    rng = random.Random(seed)
+    start = datetime.datetime(2019, 1, 1)
+    documents = []
+    for i in range(n):
+        doctype = doctypes[i % len(doctypes)]
+        title = _text(rng, 8)
+        documents.append(
+            dict(
+                id="{}-{}".format(doctype, i),
+                doctype=doctype,
+                url="https://www.{}.nl/artikel/{}".format(doctype, i),
+                title=title,
+                title_rss=title,
+                teaser=_text(rng, 30),
+                teaser_rss=_text(rng, 30),
+                text=_text(rng, words),
+                byline=_text(rng, 2),
+                category=rng.choice(["politiek", "economie", "sport", "cultuur"]),
+                publication_date=(start + datetime.timedelta(hours=i)).isoformat(),
+                feedurl="https://www.{}.nl/rss".format(doctype),
+                htmlsource="<html><body><p>{}</p></body></html>".format(
+                    _text(rng, words)
+                ),
+            )
+        )
+    return documents
+
+
+def lexisnexis_file(directory, n, seed=42, words=300):
+    """Writes a LexisNexis export with `n` articles, returns its filename"""
+    rng = random.Random(seed)
+    filename = os.path.join(directory, "lexisnexis_{}.txt".format(n))
+    with open(filename, "w", encoding="utf-8") as f:
+        for i in range(n):
+            date = datetime.date(2019, 1, 1) + datetime.timedelta(days=i % 365)
+            f.write("\n{:>30} of {} DOCUMENTS\n\n".format(i + 1, n))
+            f.write("                                 De Telegraaf\n\n")
+            f.write(
+                "                           {} {}, {}\n\n".format(
+                    MONTHS[date.month - 1], date.day, date.year
+                )
+            )
+            f.write("{}\n\n".format(_text(rng, 8)))
+            f.write("BYLINE: {}\n\n".format(_text(rng, 2)))
+            f.write("SECTION: BINNENLAND; Blz. {}\n\n".format(i % 20))
+            f.write("LENGTH: {} woorden\n\n".format(words))
+            f.write("{}\n\n".format(_text(rng, words)))
+            f.write("LOAD-DATE: {}\n\n".format(date.isoformat()))
+            f.write("LANGUAGE: DUTCH; NEDERLANDS\n\n")
+            f.write("PUBLICATION-TYPE: Krant\n\n")
+    return filename
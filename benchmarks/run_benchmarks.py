@@ -0,0 +1,344 @@
+"""
+Benchmarks for the hot paths of INCA.
+
+The benchmarks run against an in-memory SQLite store (see core/storage.py)
+instead of elasticsearch, on synthetic corpora (see corpus.py), so results
+only depend on the code and the machine. Every benchmark is set up anew for
+each repetition; only the benchmarked call is timed.
+
+Usage:
+```
+python benchmarks/run_benchmarks.py                      # all, 1000 documents
+python benchmarks/run_benchmarks.py --size 10000 --repeat 5
+python benchmarks/run_benchmarks.py database             # names containing 'database'
+python benchmarks/run_benchmarks.py --output benchmarks/results
+python benchmarks/run_benchmarks.py --compare benchmarks/results/<commit>.json
+```
+
+With `--output`, results are written to `<output>/<commit>.json`, so runs
+of different commits can be compared with `--compare`. Benchmarks whose
+dependencies are not installed are skipped.
+"""
+
+import os
+import sys
+import copy
+import json
+import time
+import argparse
+import platform
+import tempfile
+import statistics
+import subprocess
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import corpus  # noqa: E402 (benchmarks/ is on the path when run as a script)
+
+BENCHMARKS = []
+
+
+def benchmark(name):
+    """Registers a benchmark. The decorated function receives a `Context`,
+    sets up the benchmark and returns the function to time."""
+
+    def register(function):
+        BENCHMARKS.append((name, function))
+        return function
+
+    return register
+
+
+class Context:
+    """Size, working directory and local document store of a benchmark run"""
+
+    def __init__(self, size, directory):
+        self.size = size
+        self.directory = directory
+        self.store = use_local_store()
+
+    def articles(self, **kwargs):
+        return corpus.articles(self.size, **kwargs)
+
+    def fill(self, **kwargs):
+        """Stores the synthetic corpus, returns the stored documents"""
+        from inca.core import database
+
+        database.insert_documents(self.articles(**kwargs))
+        query = {"query": {"match_all": {}}}
+        return list(database.scroll_query(query, log_interval=0))
+
+    def filename(self, name):
+        return os.path.join(
+            self.directory, "{}_{}".format(time.perf_counter_ns(), name)
+        )
+
+
+def use_local_store():
+    """Points the database functions of INCA to a new in-memory store"""
+    from inca.core import database, search_utils, scraper_class, descriptors
+    from inca.core.storage import SQLiteBackend
+
+    store = SQLiteBackend(":memory:")
+    database.backend = store
+    database.DATABASE_AVAILABLE = True
+    search_utils._backend = store
+    search_utils._DATABASE_AVAILABLE = True
+    scraper_class.backend = store
+    descriptors._store = SQLiteBackend(":memory:", table="descriptors")
+    descriptors.DATABASE_AVAILABLE = True
+    return store
+
+
+######################
+# core
+######################
+
+
+@benchmark("document._add_metadata")
+def add_metadata(context):
+    from inca.core.document_class import Document
+
+    class benchmark_scraper(Document):
+        doctype = "benchmark"
+        version = "0.1"
+        functiontype = "scraper"
+
+        def get(self):
+            """Benchmark documents"""
+
+    task = benchmark_scraper()
+    documents = context.articles()
+    return lambda: [task._add_metadata(doc) for doc in documents]
+
+
+@benchmark("database._remove_dots")
+def remove_dots(context):
+    from inca.core.database import _remove_dots
+
+    documents = context.articles()
+    for doc in documents:
+        doc["user"] = {"entities.urls": [], "profile": {"screen.name": doc["byline"]}}
+    return lambda: [_remove_dots(doc) for doc in documents]
+
+
+@benchmark("basic_utils.extract_columns")
+def extract_columns(context):
+    from inca.core.basic_utils import extract_columns
+
+    documents = context.fill()
+    fields = ["_source.text", "_source.category", "_source.doctype", "_id"]
+    return lambda: extract_columns(documents, fields)
+
+
+@benchmark("database.insert_documents")
+def insert_documents(context):
+    from inca.core import database
+
+    documents = context.articles()
+    return lambda: database.insert_documents(documents)
+
+
+@benchmark("database.update_document")
+def update_document(context):
+    from inca.core import database
+
+    documents = context.fill()
+    for doc in documents:
+        doc["_source"]["text_lowercase"] = doc["_source"]["text"].lower()
+    return lambda: [database.update_document(doc) for doc in documents]
+
+
+@benchmark("database.scroll_query")
+def scroll_query(context):
+    from inca.core import database
+
+    context.fill()
+    query = {"query": {"match_all": {}}}
+    return lambda: sum(1 for _ in database.scroll_query(query, log_interval=0))
+
+
+######################
+# processing
+######################
+
+
+def _processor(context, processor, save=False, **kwargs):
+    documents = context.fill()
+    if save:
+        # processes all documents of a doctype, saving the results
+        return lambda: list(
+            processor.runwrap("nu", field="text", save=True, force=True, **kwargs)
+        )
+    return lambda: list(
+        processor.runwrap(copy.deepcopy(documents), field="text", **kwargs)
+    )
+
+
+@benchmark("processing.lowercase")
+def lowercase(context):
+    from inca.processing.basic_text_processing import lowercase
+
+    return _processor(context, lowercase())
+
+
+@benchmark("processing.clean_whitespace")
+def clean_whitespace(context):
+    from inca.processing.basic_text_processing import clean_whitespace
+
+    return _processor(context, clean_whitespace())
+
+
+@benchmark("processing.regex_tagger")
+def regex_tagger(context):
+    from inca.processing.regextagger_processing import regex_tagger
+
+    return _processor(context, regex_tagger(), regex=r"\bminister\w*")
+
+
+@benchmark("processing.lowercase.save")
+def lowercase_save(context):
+    from inca.processing.basic_text_processing import lowercase
+
+    return _processor(context, lowercase(), save=True)
+
+
+######################
+# import and export
+######################
+
+
+@benchmark("export.export_csv")
+def export_csv(context):
+    from inca.importers_exporters.csv import export_csv
+
+    context.fill()
+    filename = context.filename("export.csv")
+    return lambda: export_csv().run(query="*", destination=filename)
+
+
+@benchmark("export.export_json_file")
+def export_json_file(context):
+    from inca.importers_exporters.json import export_json_file
+
+    context.fill()
+    filename = context.filename("export.json")
+    return lambda: export_json_file().run(query="*", destination=filename)
+
+
+@benchmark("import.lnimporter.load")
+def lnimporter_load(context):
+    from inca.importers_exporters.lexisnexis import lnimporter
+
+    filename = corpus.lexisnexis_file(context.directory, context.size)
+    return lambda: sum(1 for _ in lnimporter().load(filename, encoding="utf-8"))
+
+
+######################
+# analysis
+######################
+
+
+@benchmark("analysis.cosine_similarity.fit")
+def cosine_similarity(context):
+    from inca.analysis.cosine_analysis import cosine_similarity
+
+    context.fill(doctypes=["nu", "nos"])
+    return lambda: cosine_similarity().fit(
+        "nu", "nos", filter_below=2, filter_above=0.9
+    )
+
+
+######################
+# running
+######################
+
+
+def run(name, setup, size, repeat):
+    timings = []
+    for _ in range(repeat):
+        with tempfile.TemporaryDirectory() as directory:
+            function = setup(Context(size, directory))
+            started = time.perf_counter()
+            function()
+            timings.append(time.perf_counter() - started)
+    return dict(
+        name=name,
+        size=size,
+        repeat=repeat,
+        min=min(timings),
+        median=statistics.median(timings),
+        documents_per_second=size / min(timings),
+    )
+
+
+def commit():
+    try:
+        return (
+            subprocess.check_output(
+                ["git", "rev-parse", "--short", "HEAD"], stderr=subprocess.DEVNULL
+            )
+            .decode()
+            .strip()
+        )
+    except Exception:
+        return "unknown"
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark INCA hot paths")
+    parser.add_argument("names", nargs="*", help="only run matching benchmarks")
+    parser.add_argument("--size", type=int, default=1000, help="corpus size")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--output", help="directory to write <commit>.json to")
+    parser.add_argument("--compare", help="earlier results to compare with")
+    args = parser.parse_args(argv)
+
+    import logging
+
+    # processors set the INCA logger to DEBUG, so silence logging globally
+    logging.disable(logging.WARNING)
+    os.environ.setdefault("TQDM_DISABLE", "1")
+
+    previous = {}
+    if args.compare:
+        with open(args.compare) as f:
+            previous = {r["name"]: r for r in json.load(f)["results"]}
+
+    results = []
+    header = "{:<36} {:>10} {:>10} {:>12}"
+    print(header.format("benchmark", "min (s)", "median", "docs/s"))
+    for name, setup in BENCHMARKS:
+        if args.names and not any(n in name for n in args.names):
+            continue
+        try:
+            result = run(name, setup, args.size, args.repeat)
+        except ImportError as e:
+            print("{:<36} skipped: {}".format(name, e))
+            continue
+        results.append(result)
+        line = "{name:<36} {min:>10.4f} {median:>10.4f} {documents_per_second:>12.0f}"
+        line = line.format(**result)
+        if name in previous:
+            line += "  {:+.1%}".format(result["min"] / previous[name]["min"] - 1)
+        print(line)
+
+    if args.output:
+        os.makedirs(args.output, exist_ok=True)
+        filename = os.path.join(args.output, commit() + ".json")
+        with open(filename, "w") as f:
+            json.dump(
+                dict(
+                    commit=commit(),
+                    python=platform.python_version(),
+                    machine=platform.node(),
+                    results=results,
+                ),
+                f,
+                indent=2,
+            )
+        print("Results written to {}".format(filename))
+
+
+if __name__ == "__main__":
+    main()
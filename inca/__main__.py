@@ -65,18 +65,14 @@ for s in defaultconfig.sections():
 
 
 from celery import Celery, group, chain, chord
+from celery.signals import worker_init
 from . import core
 import configparser
 from .core import search_utils
 from .core import taskmanager
 import datetime
 
-from . import processing  # helps celery recognize the processing tasks
-from . import scrapers  # helps celery recognize the scraping tasks
-from . import rssscrapers
-from . import clients  # helps celery recognize client tasks
-from . import analysis  # helps celery recognize analysis tasks
-from . import importers_exporters  # helps celery recognize import/export tasks
+from .core import registry  # task modules are imported lazily, see core.registry
 
 from optparse import OptionParser
 
@@ -86,6 +82,13 @@ from .interface import make_interface
 os.chdir(currentdir)
 
 
+@worker_init.connect
+def _import_tasks(**kwargs):
+    """Registers all tasks in celery workers, which do not build endpoints
+    that import task modules lazily (see core.registry)"""
+    registry.import_all()
+
+
 class Inca:
     """INCA main class for easy access to functionality
 
@@ -133,9 +136,26 @@ class Inca:
 
     _prompt = "Placeholder"
 
-    def __init__(self, prompt="TLI", distributed=False, verbose=True, debug=False):
+    def __init__(
+        self, prompt="TLI", distributed=False, verbose=True, debug=False, lazy=True
+    ):
         self._LOCAL_ONLY = distributed
         self._prompt = getattr(make_interface, prompt).prompt
+        if lazy:
+            self._construct_lazy_tasks(registry.load_manifest(self._taskmaster))
+        else:
+            registry.import_all()
+            self._construct_all_tasks()
+
+        if verbose:
+            logger.setLevel("INFO")
+            logger.info("Providing verbose output")
+        if debug:
+            logger.setLevel("DEBUG")
+            logger.debug("Activating debugmode")
+
+    def _construct_all_tasks(self):
+        """Construct endpoints from all tasks registered with celery"""
         self._construct_tasks("scrapers")
         self._construct_tasks("processing")
 
@@ -145,13 +165,6 @@ class Inca:
         self._construct_tasks("importers_exporters")
         self._construct_tasks("rssscrapers")
 
-        if verbose:
-            logger.setLevel("INFO")
-            logger.info("Providing verbose output")
-        if debug:
-            logger.setLevel("DEBUG")
-            logger.debug("Activating debugmode")
-
     class analysis:
         """Data analysis tools"""
 
@@ -177,6 +190,47 @@ class Inca:
 
         pass
 
+    def _construct_lazy_tasks(self, manifest):
+        """Construct endpoints from the task manifest
+
+        Endpoints import the module of their task when they are first
+        called, see `core.registry`.
+
+        Parameters
+        ----
+        manifest : list
+            Task descriptions as returned by `registry.load_manifest`
+        """
+        target_functions = ["fit", "predict", "plot", "interpretation", "quality"]
+
+        for entry in manifest:
+            function = entry["function"]
+            if function == "analysis":
+
+                class analysis_placeholder:
+                    pass
+
+                analysis_placeholder.__doc__ = entry["classdoc"]
+                for method in target_functions:
+                    endpoint = registry.lazy_method(self._taskmaster, entry, method)
+                    setattr(analysis_placeholder, method, staticmethod(endpoint))
+                setattr(self.analysis, entry["taskname"], analysis_placeholder)
+                continue
+
+            function_class = getattr(self, function)
+            if entry.get("service_name"):
+                for suffix, method in registry.CLIENT_METHODS:
+                    setattr(
+                        function_class,
+                        "{}_{}".format(entry["service_name"], suffix),
+                        registry.lazy_method(self._taskmaster, entry, method),
+                    )
+            endpoint = registry.lazy_method(
+                self._taskmaster, entry, "runwrap", prompt=self._prompt
+            )
+            endpoint.__doc__ = entry["doc"]
+            setattr(function_class, entry["taskname"], endpoint)
+
     def _analysis_task_constructor(self):
         """Construct endpoints specifically for analysis tasks
 
@@ -437,7 +491,15 @@ def commandline():
         action = "run"
 
     logger.info("running {tasktype} : {task}".format(**locals()))
-    task_func(action=action, *args[2:])
+    result = task_func(action=action, *args[2:])
+    # processors return generators, which only do their work when consumed;
+    # other tasks have finished when they return
+    if inspect.isgenerator(result):
+        for item in result:
+            if options.celery:
+                logger.info(item)  # a summary per group of celery tasks
+            elif not options.silent:
+                print(item)
     logger.info("finished {tasktype} : {task}".format(**locals()))
 
 
@@ -6,12 +6,20 @@ import pandas as pd
 import logging
 import numpy as np
 import string
+import zlib
+import itertools
 import sklearn
-from sklearn.feature_extraction.text import CountVectorizer, TfidfVectorizer
+from sklearn.feature_extraction.text import (
+    CountVectorizer,
+    TfidfVectorizer,
+    HashingVectorizer,
+)
 from sklearn.model_selection import train_test_split
+from sklearn.preprocessing import normalize
 
 from ..core.analysis_base_class import Analysis
-from scipy.sparse import csr_matrix
+from ..core.basic_utils import batches, compile_path, extract_columns
+from scipy.sparse import csr_matrix, vstack
 from sklearn.linear_model import SGDClassifier
 from sklearn.metrics import accuracy_score, precision_score, f1_score, recall_score
 from sklearn import svm
@@ -37,6 +45,9 @@ class classification(Analysis):
         rand_shuffle=True,
         tfidf=True,
         vocabul=None,
+        batch_size=None,
+        classes=None,
+        n_features=2 ** 20,
     ):
         """
         This method should train a Classifier model on the input documents.\n
@@ -81,6 +92,16 @@ class classification(Analysis):
                         encountered in the labeled documents are used to form the vocabulary.
         @type vocabul: list, or None type object
         @param one_pass: Keeps all documents in memory instead of retrieving them twice from ElasticSearch
+        @param batch_size: If given, the documents are streamed: they are vectorized with a HashingVectorizer and the model is
+                           trained with partial_fit on batches of this many documents, so they are never all kept in memory.
+                           Documents are not shuffled, so they should be retrieved in random order. Documents are held out for
+                           the test set by a hash of their id. With tfidf, the inverse document frequencies are updated from
+                           each batch. mindf, maxdf, vocabul and add_prediction are not used. Returns (None, None, None).
+        @type batch_size: int, or None type object
+        @param classes: All labels that can occur, required with batch_size
+        @type classes: list, or None type object
+        @param n_features: The number of hashed features used with batch_size. The default is 2**20.
+        @type n_features: int
         """
 
         self.model = None
@@ -95,19 +116,34 @@ class classification(Analysis):
         self.vectorizer = None
         self.labels = []
         self.documents_fulltext = []
+        self.idf = None
+
+        if batch_size:
+            return self._fit_batches(
+                documents,
+                x_field,
+                label_field,
+                batch_size,
+                classes,
+                n_features,
+                testsize,
+                tfidf,
+            )
 
         counter = 0
         invalidchars = set(string.punctuation)
 
+        get_x, get_label = compile_path(x_field), compile_path(label_field)
         for doc in documents:
             counter += 1
-            if len(core.basic_utils.dotkeys(doc, x_field)) > 0:
+            text = get_x(doc)
+            if len(text) > 0:
                 self.valid_docs.append(doc["_id"])
-                self.labels.append(core.basic_utils.dotkeys(doc, label_field))
-                self.documents_fulltext.append(core.basic_utils.dotkeys(doc, x_field))
+                self.labels.append(get_label(doc))
+                self.documents_fulltext.append(text)
 
                 if counter < 5:
-                    text = core.basic_utils.dotkeys(doc, x_field).lower()
+                    text = text.lower()
                     if any(char in invalidchars for char in text):
                         logger.info(
                             "Punctuation has not been removed. Proceeding without pre-processing."
@@ -139,7 +175,11 @@ class classification(Analysis):
         self.fitted = self.vectorizer.fit_transform(
             self.documents_fulltext, self.labels
         )
-        self.vocab = np.array(self.vectorizer.get_feature_names())
+        try:
+            self.vocab = self.vectorizer.get_feature_names_out()
+        except AttributeError:
+            # scikit-learn < 1.0
+            self.vocab = np.array(self.vectorizer.get_feature_names())
         logger.info(
             "{} x entries and {} y entries".format(
                 self.fitted.shape[0], len(self.labels)
@@ -162,7 +202,88 @@ class classification(Analysis):
 
         return (self.vocab, self.fitted, self.labels)
 
-    def predict(self, documents=None, x_field=None, **kwargs):
+    def _fit_batches(
+        self,
+        documents,
+        x_field,
+        label_field,
+        batch_size,
+        classes,
+        n_features,
+        testsize,
+        tfidf,
+    ):
+        if classes is None:
+            raise ValueError("All classes have to be given to train in batches")
+        self.vectorizer = HashingVectorizer(
+            n_features=n_features, alternate_sign=False, norm=None
+        )
+        if tfidf:
+            self.document_frequencies = np.zeros(n_features)
+            self.n_documents = 0
+            self.idf = np.ones(n_features)
+        self.model = SGDClassifier(
+            loss="hinge", penalty="l2", alpha=1e-3, random_state=42
+        )
+
+        test_counts, y_test = [], []
+        n_train = n_invalid = 0
+        valid = self._valid_documents(documents, x_field)
+        for batch in batches(valid, batch_size):
+            texts, labels, ids = extract_columns(batch, [x_field, label_field, "_id"])
+            counts = self.vectorizer.transform(texts)
+            labels = np.array(labels)
+            if tfidf:
+                self._update_idf(counts)
+            held_out = np.array([_held_out(_id, testsize) for _id in ids])
+            if held_out.any():
+                test_counts.append(counts[held_out])
+                y_test.extend(labels[held_out])
+            if not held_out.all():
+                X = self._weigh(counts[~held_out])
+                self.model.partial_fit(X, labels[~held_out], classes=classes)
+                n_train += X.shape[0]
+
+        logger.info(
+            "Trained on {} documents, {} held out for testing, {} invalid".format(
+                n_train, len(y_test), len(self.invalid_docs)
+            )
+        )
+        if test_counts:
+            self.X_test = self._weigh(vstack(test_counts))
+            self.y_test = y_test
+        return (None, None, None)
+
+    def _valid_documents(self, documents, x_field):
+        get_x = compile_path(x_field)
+        for doc in documents:
+            if len(get_x(doc)) > 0:
+                yield doc
+            else:
+                self.invalid_docs.append(doc["_id"])
+
+    def _update_idf(self, counts):
+        """Adds the document frequencies of a batch and recomputes the
+        smoothed inverse document frequencies, as in TfidfTransformer"""
+        self.document_frequencies += np.bincount(
+            counts.indices, minlength=counts.shape[1]
+        )
+        self.n_documents += counts.shape[0]
+        self.idf = (
+            np.log((1 + self.n_documents) / (1 + self.document_frequencies)) + 1
+        )
+
+    def _weigh(self, counts):
+        if self.idf is None:
+            return counts
+        return normalize(counts.multiply(self.idf).tocsr())
+
+    def _features(self, texts):
+        return self._weigh(self.vectorizer.transform(texts))
+
+    def predict(
+        self, documents=None, x_field=None, add_prediction="", batch_size=1000, **kwargs
+    ):
         """
         This method performs classification of new unseen documents.\n
         @param documents: the documents to classify.
@@ -175,26 +296,42 @@ class classification(Analysis):
         @type x_field: str
         @param doctype: the ElasticSearch doctype provided to the set of documents
         @type doctype: str
+        @param add_prediction: If given, documents (dicts) are classified in batches and the prediction of each document is
+                               written to the database in this field, using bulk partial updates. Documents can then be a
+                               generator, such as a scroll over the database.
+        @type add_prediction: str
+        @param batch_size: The number of documents classified and written at once with add_prediction. The default is 1000.
+        @type batch_size: int
         """
 
-        if documents == None:
+        if add_prediction:
+            if x_field is None:
+                raise Exception("You have to input the x_field to add predictions")
+            return self._predict_batches(documents, x_field, add_prediction, batch_size)
+
+        if documents is None:
             documents = self.X_test
             logger.info(
                 "Since no documents were inputted, this shall run the trained model on the test dataset reserved as 20% of the original labeled example dataset."
             )
         else:
-            if type(documents[0]) is str:
+            if hasattr(documents, "__getitem__"):
+                first = documents[0]
+            else:
+                # a generator, put back the first document after inspecting it
+                first = next(iter(documents))
+                documents = itertools.chain([first], documents)
+            if type(first) is str:
                 logger.info(
                     "It seems that the input documents are a list of strings, proceeding without extracting any specific field"
                 )
-                documents = self.vectorizer.transform(documents)
-            elif type(documents[0]) is dict and x_field is not None:
+                documents = self._features(documents)
+            elif type(first) is dict and x_field is not None:
                 logger.info(
                     "It seems that the input documents are a list of dicts, extracting the provided x_field"
                 )
-                documents = self.vectorizer.transform(
-                    (core.basic_utils.dotkeys(doc, x_field) for doc in documents)
-                )
+                get_x = compile_path(x_field)
+                documents = self._features(get_x(doc) for doc in documents)
             else:
                 raise Exception(
                     "You have to input either nothing, or a list of strings, or a list of dicts together with the x_field"
@@ -205,6 +342,33 @@ class classification(Analysis):
 
         return self.predictions
 
+    def _predict_batches(self, documents, x_field, add_prediction, batch_size):
+        from ..core.database import bulk_update_fields, failed_ids
+
+        predictions = []
+        failed = []
+        for batch in batches(self._valid_documents(documents, x_field), batch_size):
+            (texts,) = extract_columns(batch, [x_field])
+            labels = self.model.predict(self._features(texts)).tolist()
+            success, errors = bulk_update_fields(
+                (doc["_id"], {add_prediction: label})
+                for doc, label in zip(batch, labels)
+            )
+            if errors:
+                failed.extend(failed_ids(errors))
+            predictions.extend(labels)
+        self.predictions = np.array(predictions)
+        if failed:
+            logger.warning(
+                "Unable to save {} predictions: {}".format(len(failed), ", ".join(failed))
+            )
+        logger.info(
+            "Added {} predictions to {}".format(
+                len(self.predictions) - len(failed), add_prediction
+            )
+        )
+        return self.predictions
+
     def quality(self, **kwargs):
         """
         This method has the functionality to report on the quality of the underlying Classification (trained) model which was created as a         random subset as a proportion of the input documents.\n
@@ -235,3 +399,8 @@ class classification(Analysis):
             "recall": self.test_recall,
             "f1": self.test_f1score,
         }
+
+
+def _held_out(document_id, testsize):
+    """Assigns a document to the test set by a stable hash of its id"""
+    return zlib.crc32(str(document_id).encode("utf-8")) % 1000 < testsize * 1000
@@ -1,4 +1,5 @@
 from ..core.analysis_base_class import Analysis
+from ..core.basic_utils import batches
 import logging
 
 logger = logging.getLogger("INCA")
@@ -7,11 +8,10 @@ logger = logging.getLogger("INCA")
 # from nltk.text import Text, TextCollection
 # from nltk.tokenize import word_tokenize
 
-from sklearn.feature_extraction.text import TfidfVectorizer
+import joblib
+from sklearn.feature_extraction.text import TfidfVectorizer, HashingVectorizer
 
-vectorizer = TfidfVectorizer()
-
-from sklearn.cluster import KMeans
+from sklearn.cluster import KMeans, MiniBatchKMeans
 
 from os import environ
 
@@ -33,17 +33,28 @@ import numpy as np
 
 
 class hype_cluster(Analysis):
-    def fit(self, documents, textkey, N_clusters):
+    def fit(
+        self,
+        documents,
+        textkey,
+        N_clusters,
+        batch_size=None,
+        n_features=2 ** 18,
+        vocabulary=None,
+    ):
         """
           Gets texts from specified documents
           Creates clusters based on the documents provided
           
-          Kmeans algorith is used to create the clusters
+          Kmeans algorith is used to create the clusters. With a batch_size,
+          documents are streamed: they are vectorized and clustered with
+          MiniBatchKMeans one batch at a time, so the number of documents is
+          not limited by memory.
 
           Parameters
           ----
           documents:
-          News articles stored as dicts in the Inca database
+          News articles stored as dicts in the Inca database (can be a generator)
 
           textkey: string
           The key where the texts can be found (eg 'title' or 'text')
@@ -51,6 +62,16 @@ class hype_cluster(Analysis):
           N_clusters: int
           Desired number of clusters
 
+          batch_size: int (default=None)
+          If given, cluster batches of this many documents with MiniBatchKMeans
+
+          n_features: int (default=2**18)
+          Number of hashed features used in batch mode
+
+          vocabulary: list (default=None)
+          A fixed vocabulary to use in batch mode instead of hashed features.
+          Top terms per cluster are only known with a fixed vocabulary.
+
           Yields
           ----
           Makes model and returns the specified number of clusters. 
@@ -58,30 +79,44 @@ class hype_cluster(Analysis):
           """
 
         self.textkey = textkey
+        texts = (
+            d["_source"][self.textkey]
+            for d in documents
+            if self.textkey in d.get("_source", {})
+        )
 
-        texts = []
-        for d in documents:
-            try:
-                texts.append(d["_source"][self.textkey])
-            except:
-                pass
-
-        # make model
         print("Making model")
-        self.X1 = vectorizer.fit(texts)
-        X2 = self.X1.transform(texts)
-
-        # clustering
-        self.km = KMeans(
-            n_clusters=N_clusters, init="k-means++", max_iter=100, n_init=1
-        )
-        self.km.fit(X2)
+        if batch_size is None:
+            self.X1 = TfidfVectorizer()
+            X2 = self.X1.fit_transform(list(texts))
+            self.km = KMeans(
+                n_clusters=N_clusters, init="k-means++", max_iter=100, n_init=1
+            )
+            self.km.fit(X2)
+            terms = _feature_names(self.X1)
+        else:
+            if vocabulary is None:
+                # stateless, so batches can be vectorized without fitting
+                self.X1 = HashingVectorizer(
+                    n_features=n_features, alternate_sign=False
+                )
+                terms = None
+            else:
+                self.X1 = TfidfVectorizer(vocabulary=vocabulary, use_idf=False)
+                self.X1.fit(vocabulary)
+                terms = _feature_names(self.X1)
+            self.km = MiniBatchKMeans(
+                n_clusters=N_clusters, init="k-means++", batch_size=batch_size
+            )
+            # the first batch needs at least one document per cluster
+            for batch in batches(texts, max(batch_size, N_clusters)):
+                self.km.partial_fit(self.X1.transform(batch))
         print("done")
 
-        # Top clusters
-        print("Top terms per cluster:")
         self.order_centroids = self.km.cluster_centers_.argsort()[:, ::-1]
-        terms = vectorizer.get_feature_names()
+        if terms is None:
+            return
+        print("Top terms per cluster:")
         for i in range(N_clusters):
             print("Cluster %d:" % i, end="")
             for ind in self.order_centroids[i, :10]:
@@ -107,7 +142,7 @@ class hype_cluster(Analysis):
         )  # centers could also be plotted instead
         plt.show()
 
-    def predict(self, documents):
+    def predict(self, documents, batch_size=1000):
         """
           Predicts in which cluster a new text is placed
           
@@ -116,19 +151,57 @@ class hype_cluster(Analysis):
           documents:
           News articles stored as dicts in the Inca database
           Will use the same key specifiied above to retrieve texts
+
+          batch_size: int (default=1000)
+          Number of documents that are vectorized and predicted at once
           
           Yields
           ----
           A tuple (document, cluster id) 
           """
 
-        for doc in documents:
-            try:
-                Y = self.X1.transform([doc["_source"][self.textkey]])
-                predictions = self.km.predict(Y)
-                yield doc, predictions[0]
-            except:
-                pass
+        documents = (
+            doc for doc in documents if self.textkey in doc.get("_source", {})
+        )
+        for batch in batches(documents, batch_size):
+            Y = self.X1.transform([doc["_source"][self.textkey] for doc in batch])
+            for doc, prediction in zip(batch, self.km.predict(Y)):
+                yield doc, prediction
+
+    def save(self, path):
+        """
+          Saves the fitted model, so it can be used later with `load`
+
+          Parameters
+          ----
+          path: string
+          The file to save the model to
+          """
+        joblib.dump(
+            dict(
+                vectorizer=self.X1,
+                model=self.km,
+                textkey=self.textkey,
+                order_centroids=self.order_centroids,
+            ),
+            path,
+        )
+
+    def load(self, path):
+        """
+          Loads a model saved with `save`
+
+          Parameters
+          ----
+          path: string
+          The file the model was saved to
+          """
+        saved = joblib.load(path)
+        self.X1 = saved["vectorizer"]
+        self.km = saved["model"]
+        self.textkey = saved["textkey"]
+        self.order_centroids = saved["order_centroids"]
+        return self
 
 
 class hype_tfidf(Analysis):
@@ -136,7 +209,8 @@ class hype_tfidf(Analysis):
         """
           Calculates Tf-idf score for each document and creates a dataframe
 
-          Note: does not work with documents obtained through a generator (generators have no len)
+          Documents are read only once, so they can be obtained through a
+          generator (such as a scroll over the database).
 
           Parameters
           ----
@@ -144,7 +218,7 @@ class hype_tfidf(Analysis):
           News articles stored as dicts in the Inca database
           
           searchterm: string
-          Word or words (phrase) used to calculate the tf-idf score (eg. 'fake news'). Will automatically be lowercased.
+          Word used to calculate the tf-idf score (eg. 'brexit'). Will automatically be lowercased.
 
           textkey: string
           The key where the texts can be found (eg 'title' or 'text')
@@ -157,25 +231,28 @@ class hype_tfidf(Analysis):
 
         self.searchterm = searchterm.lower()
         self.textkey = textkey
-        textsonly = (e["_source"].get(self.textkey, "") for e in documents)
-        vectorizer.fit(textsonly)
 
-        self.df1 = pd.DataFrame(columns=["Type", "Publication Date", "Tf-idf"])
+        types, dates, texts = [], [], []
         for e in documents:
-            X = vectorizer.transform([e["_source"].get(self.textkey, "")])
-            tfidfscore = X[0, vectorizer.vocabulary_[self.searchterm]]
-            # print(self.searchterm, tfidfscore)
-            self.df1 = self.df1.append(
-                pd.DataFrame(
-                    {
-                        "Type": e["_type"],
-                        "Publication Date": e["_source"]["publication_date"],
-                        "Tf-idf": tfidfscore,
-                    },
-                    index=[0],
-                ),
-                ignore_index=True,
+            types.append(e.get("_type", e["_source"].get("doctype")))
+            dates.append(e["_source"]["publication_date"])
+            texts.append(e["_source"].get(self.textkey, ""))
+
+        self.vectorizer = TfidfVectorizer()
+        X = self.vectorizer.fit_transform(texts)
+        column = self.vectorizer.vocabulary_.get(self.searchterm)
+        if column is None:
+            logger.warning(
+                "'{term}' does not occur in the documents".format(term=self.searchterm)
             )
+            scores = np.zeros(len(texts))
+        else:
+            scores = X[:, column].toarray().ravel()
+
+        self.df1 = pd.DataFrame(
+            {"Type": types, "Publication Date": dates, "Tf-idf": scores},
+            columns=["Type", "Publication Date", "Tf-idf"],
+        )
         return self.df1
 
     def plot(self):
@@ -196,7 +273,8 @@ class hype_tfidf_perday(Analysis):
         """
           Concatenates documents per day and then calculates Tf-idf score for each day document and creates a dataframe
 
-          Note: does not work with documents obtained through a generator (generators have no len)
+          Documents are read only once, so they can be obtained through a
+          generator (such as a scroll over the database).
 
           Parameters
           ----
@@ -213,41 +291,47 @@ class hype_tfidf_perday(Analysis):
           ----
           Creates dataframe with tf-idf scores of the most important words per day.
           The dataframe includes the publication date, and the top_n most important words and their tf-idf scores as a tuple.
+          Days with fewer than top_n words have None in the remaining columns.
 
           """
 
         self.textkey = textkey
 
-        df2 = pd.DataFrame(columns=["Publication Date", "Text"])
+        days = {}
         for e in documents:
-            df2 = df2.append(
-                {
-                    "Publication Date": e["_source"]["publication_date"][:-9],
-                    "Text": e["_source"].get(self.textkey, ""),
-                },
-                ignore_index=True,
-            )
-
-        df3 = df2.groupby("Publication Date")["Text"].apply(" ".join).reset_index()
+            day = e["_source"]["publication_date"][:-9]
+            days.setdefault(day, []).append(e["_source"].get(self.textkey, ""))
+        dates = sorted(days)
+
+        self.vectorizer = TfidfVectorizer()
+        tfidf_matrix = self.vectorizer.fit_transform(
+            " ".join(days[day]) for day in dates
+        ).tocsr()
+        terms = _feature_names(self.vectorizer)
+
+        rows = []
+        for i in range(tfidf_matrix.shape[0]):
+            start, end = tfidf_matrix.indptr[i], tfidf_matrix.indptr[i + 1]
+            scores = tfidf_matrix.data[start:end]
+            columns = tfidf_matrix.indices[start:end]
+            if len(scores) > top_n:
+                top = np.argpartition(-scores, top_n)[:top_n]
+            else:
+                top = np.arange(len(scores))
+            top = top[np.argsort(-scores[top], kind="stable")]
+            row = [(terms[columns[j]], scores[j]) for j in top]
+            rows.append(row + [None] * (top_n - len(row)))
 
         column_list = ["top{}".format(i) for i in range(1, top_n + 1)]
+        self.df4 = pd.DataFrame(rows, columns=column_list)
+        self.df4.insert(0, "Publication Date", dates)
 
-        tfidf_matrix = vectorizer.fit_transform(df3["Text"])
-
-        tfidf_df = pd.DataFrame(tfidf_matrix.toarray())
-        tfidf_df.columns = vectorizer.get_feature_names()
-
-        order = np.argsort(-tfidf_df.values, axis=1)[:, :top_n]
-        result = pd.DataFrame(
-            tfidf_df.columns[order], columns=column_list, index=tfidf_df.index
-        )
-
-        results2 = result.copy()
-
-        for idx, row in result.iterrows():
-            for col in column_list:
-                results2.iloc[idx][col] = (row[col], tfidf_df.iloc[idx][row[col]])
+        return self.df4
 
-        self.df4 = pd.concat([df3["Publication Date"], results2], axis=1)
 
-        return self.df4
+def _feature_names(vectorizer):
+    try:
+        return vectorizer.get_feature_names_out()
+    except AttributeError:
+        # scikit-learn < 1.0
+        return np.array(vectorizer.get_feature_names())
@@ -5,19 +5,16 @@ import os
 import sys
 import nltk
 import gensim
-import configparser
 from nltk.corpus import stopwords
 from gensim.utils import tokenize
 from gensim.models.ldamodel import LdaModel
 from ..core.analysis_base_class import Analysis
 from gensim.corpora.dictionary import Dictionary
 from ..helpers.text_preprocessing import *
+from ..core.database import config
 
 root_dir = os.path.dirname(os.path.realpath(__file__))
 
-config = configparser.ConfigParser()
-config.read("settings.cfg")
-
 DEFAULTLANGUAGE = config.get("inca", "default_data_language")
 
 
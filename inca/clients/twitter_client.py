@@ -6,11 +6,14 @@ from ..core.client_class import Client, elasticsearch_required
 from ..core.basic_utils import dotkeys
 from twython import Twython, TwythonRateLimitError
 from ..core.database import client as database_client
+from ..core.database import backend, elastic_index, existing_ids
 import json
 import logging
+import queue
 import sys
 import time
-from ..core.search_utils import doctype_first, doctype_last
+from concurrent.futures import ThreadPoolExecutor
+from ..core.search_utils import doctype_first, doctype_last, list_credentials
 
 logger = logging.getLogger("INCA.%s" % __name__)
 
@@ -155,12 +158,128 @@ class twitter(Client):
             logger.warn("No credentials available...")
 
 
+# tweet ids are sorted as numbers (see schema.json), on indices without that
+# mapping the tweet that was stored last is used
+LATEST_SORT = [
+    {"id.number": {"order": "desc", "unmapped_type": "long"}},
+    {"META.ADDED": {"order": "desc", "unmapped_type": "date"}},
+]
+
+
+def latest_tweet_ids(screen_names):
+    """Returns `{screen_name : id}` of the latest stored tweet of each account
+
+    All accounts are looked up in a single aggregation on `user.screen_name`,
+    which schema.json maps as a lowercased keyword. Indices created before
+    that mapping do not support the aggregation, so there each account is
+    looked up separately. Screen names are matched case-insensitively;
+    accounts without stored tweets are left out. Other storage backends
+    than elasticsearch do not support aggregations, so there all stored
+    tweets are scrolled through instead.
+    """
+    if not screen_names:
+        return {}
+    names = {name.lower(): name for name in screen_names}
+    if backend.name != "elasticsearch":
+        return _scroll_latest_tweet_ids(names)
+    try:
+        return _aggregate_latest_tweet_ids(names)
+    except Exception as e:
+        logger.info(
+            "Could not aggregate tweets per account, looking them up one by one: "
+            "{e}".format(e=e)
+        )
+        return _search_latest_tweet_ids(names)
+
+
+def _aggregate_latest_tweet_ids(names):
+    """`latest_tweet_ids` in one aggregation, `names` maps lowercased screen
+    names to screen names"""
+    body = {
+        "size": 0,
+        "query": {
+            "bool": {
+                "filter": [
+                    {"term": {"doctype": "tweets"}},
+                    {"terms": {"user.screen_name": list(names)}},
+                ]
+            }
+        },
+        "aggs": {
+            "accounts": {
+                "terms": {"field": "user.screen_name", "size": len(names)},
+                "aggs": {
+                    # top_hits rather than max, as a max aggregation returns
+                    # a double that cannot represent all 64 bit tweet ids
+                    "latest": {
+                        "top_hits": {
+                            "size": 1,
+                            "sort": LATEST_SORT,
+                            "_source": ["id"],
+                        }
+                    }
+                },
+            }
+        },
+    }
+    response = database_client.search(index=elastic_index, body=body)
+    latest = {}
+    for bucket in response["aggregations"]["accounts"]["buckets"]:
+        name = names.get(bucket["key"].lower())
+        hits = bucket["latest"]["hits"]["hits"]
+        if name and hits:
+            latest[name] = hits[0]["_source"]["id"]
+    return latest
+
+
+def _search_latest_tweet_ids(names):
+    """`latest_tweet_ids` with a search per account, `names` maps lowercased
+    screen names to screen names"""
+    latest = {}
+    for lowercased, name in names.items():
+        body = {
+            "size": 1,
+            "query": {
+                "bool": {
+                    "filter": [
+                        {"term": {"doctype": "tweets"}},
+                        {"match": {"user.screen_name": lowercased}},
+                    ]
+                }
+            },
+            "sort": LATEST_SORT,
+            "_source": ["id"],
+        }
+        hits = database_client.search(index=elastic_index, body=body)["hits"]["hits"]
+        if hits:
+            latest[name] = hits[0]["_source"]["id"]
+    return latest
+
+
+def _scroll_latest_tweet_ids(names):
+    """`latest_tweet_ids` without aggregations, `names` maps lowercased screen
+    names to screen names"""
+    # terms queries are case sensitive here, so screen names are matched below
+    query = {"query": {"term": {"doctype": "tweets"}}}
+    latest = {}
+    for doc in backend.scroll(query, source=["id", "user"]):
+        screen_name = (doc["_source"].get("user") or {}).get("screen_name") or ""
+        name = names.get(screen_name.lower())
+        if name and doc["_source"].get("id"):
+            latest[name] = max(latest.get(name, 0), doc["_source"]["id"])
+    return latest
+
+
 class twitter_timeline(twitter):
     """Class to retrieve twitter timelines for a given account"""
 
     sort_field = "content.resources.statuses./statuses/user_timeline.reset"
     preference = "lowest"
 
+    doctype = "tweets"
+    version = "0.2"
+    functiontype = "twitter_client"
+
     def get(
         self,
         credentials,
@@ -186,16 +305,12 @@ class twitter_timeline(twitter):
             pass  # sometimes you just can't get a rate-limit estimate
 
         if not force:
-            since_id = doctype_first(
-                doctype="tweets", query="user.screen_name:" + screen_name
-            )
-            if len(since_id) == 0:
+            since_id = latest_tweet_ids([screen_name]).get(screen_name)
+            if since_id is None:
                 logger.info(
                     "settings since_id to None as there are no tweets for this user"
                 )
-                since_id = None
             else:
-                since_id = since_id[0].get("_source", {}).get("id", None)
                 logger.info("settings since_id to {since_id}".format(**locals()))
         try:
             batchsize = 1
@@ -214,8 +329,11 @@ class twitter_timeline(twitter):
                 if not batchsize:
                     continue
                 max_id = min([tweet.get("id", None) for tweet in tweets]) - 1
+                existing = set()
+                if not force:
+                    existing = existing_ids(t["id_str"] for t in tweets)
                 for num, tweet in enumerate(tweets):
-                    if self._check_exists(tweet["id_str"])[0] and not force:
+                    if tweet["id_str"] in existing:
                         logger.info(
                             "skipping existing {screen_name}-{tweet[id]}".format(
                                 **locals()
@@ -260,6 +378,132 @@ class twitter_timeline(twitter):
             )
 
 
+    @elasticsearch_required
+    def harvest(
+        self,
+        screen_names,
+        app="default",
+        force=False,
+        exclude_replies=False,
+        include_rts=True,
+    ):
+        """Retrieves the timelines of many accounts concurrently
+
+        The latest stored tweet of all accounts is looked up at once, after
+        which each available credential of `app` retrieves timelines in its
+        own thread, waiting when its rate limit is reached. Whether tweets
+        were stored before is checked per page of 200 tweets.
+
+        Parameters
+        ----
+        screen_names : list
+            The accounts to retrieve
+        app : string (default='default')
+            The app of which all credentials are used
+        force : bool (default=False)
+            Retrieve (and overwrite) all available tweets, not only new ones
+
+        Returns
+        ----
+        dict
+            `{screen_name : number of new tweets}`, None for failed accounts
+        """
+        credentials = list_credentials(self.service_name, app)
+        if not credentials:
+            logger.warning("No credentials found for {app}".format(app=app))
+            return {}
+        since_ids = {} if force else latest_tweet_ids(screen_names)
+        accounts = queue.Queue()
+        for screen_name in screen_names:
+            accounts.put(screen_name)
+        results = {}
+
+        def work(credential):
+            api = self._get_client(credentials=credential["_source"]["credentials"])
+            while True:
+                try:
+                    screen_name = accounts.get_nowait()
+                except queue.Empty:
+                    return
+                try:
+                    results[screen_name] = self._harvest_timeline(
+                        api,
+                        screen_name,
+                        since_ids.get(screen_name),
+                        force,
+                        exclude_replies=exclude_replies,
+                        include_rts=include_rts,
+                    )
+                except Exception as e:
+                    logger.warning(
+                        "Failed to retrieve {screen_name}: {e}".format(
+                            screen_name=screen_name, e=e
+                        )
+                    )
+                    results[screen_name] = None
+
+        logger.info(
+            "Retrieving {n} timelines with {m} credentials".format(
+                n=len(screen_names), m=len(credentials)
+            )
+        )
+        with ThreadPoolExecutor(max_workers=len(credentials)) as executor:
+            for finished in executor.map(work, credentials):
+                pass
+        return results
+
+    def _harvest_timeline(self, api, screen_name, since_id, force, **kwargs):
+        max_id = None
+        saved = 0
+        while True:
+            try:
+                tweets = api.get_user_timeline(
+                    screen_name=screen_name,
+                    max_id=max_id,
+                    since_id=since_id,
+                    count=200,
+                    **kwargs
+                )
+            except TwythonRateLimitError as e:
+                _wait_until(e.retry_after)
+                continue
+            if not tweets:
+                break
+            max_id = min(tweet["id"] for tweet in tweets) - 1
+            existing = set() if force else existing_ids(t["id_str"] for t in tweets)
+            new = []
+            for tweet in tweets:
+                if tweet["id_str"] in existing:
+                    continue
+                tweet["_id"] = tweet["id_str"]
+                tweet = self._add_metadata(tweet)
+                self._verify(tweet)
+                new.append(tweet)
+            if new:
+                self._save_documents(new)
+                saved += len(new)
+            if api.get_lastfunction_header("x-rate-limit-remaining") == "0":
+                _wait_until(api.get_lastfunction_header("x-rate-limit-reset"))
+        logger.info(
+            "retrieved {saved} new tweets for {screen_name}".format(
+                saved=saved, screen_name=screen_name
+            )
+        )
+        return saved
+
+
+def _wait_until(reset):
+    """Sleeps until a rate limit reset time (epoch seconds), or for a minute
+    if the reset time is unknown"""
+    try:
+        delay = int(reset) - time.time() + 1
+    except (TypeError, ValueError):
+        delay = 60
+    if delay > 0:
+        logger.info("Rate limit reached, waiting {delay:.0f}s".format(delay=delay))
+        time.sleep(delay)
+
+
 class twitter_followers(twitter):
     """Class to retrieve twitter followers for a given account
     https://dev.twitter.com/rest/reference/get/followers/ids
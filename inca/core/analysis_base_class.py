@@ -71,7 +71,8 @@ class Analysis(Task):
 
     def runwrap(self, action="run", *args, **kwargs):
         """
-        Call the task as either a local or distributed process
+        Call the task as either a local or distributed process. 'celery_batch'
+        runs the task as a single celery task and returns its result.
         """
         if action == "run":
             return self.run(*args, **kwargs)
@@ -79,6 +80,12 @@ class Analysis(Task):
         if action == "delay":
             return self.delay(*args, **kwargs)
 
+        if action == "celery_batch":
+            # runs the whole task as one celery task and waits for it: unlike
+            # processors, which split documents over slices, there is nothing
+            # to split here, so this is not a distributed run
+            return self.delay(*args, **kwargs).get()
+
     def run(self, *args, **kwargs):
         self.fit(*args, **kwargs)
         # self.predict(*args,**kwargs)
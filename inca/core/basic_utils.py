@@ -2,21 +2,167 @@
 This file contains some basic utilities:
 
 1. dotkeys(dict, key_string) : allows the use of .-separated nested fields such as 'name.firstname' as dict[name][firstname]
+2. compile_path(key_string) : returns a function that gets the (nested) field from a dict, as dotkeys does
+3. extract_columns(dicts, key_strings) : gets many (nested) fields of many dicts at once, as lists per field
+4. remove_dots(dict) : replaces dots in (nested) keys, as elasticsearch does not accept them
+5. flatten(dict) : flattens nested fields to .-separated keys, for instance for CSV files
+6. batches(iterable, size) : yields lists of (at most) size items, for bulk requests
+
+These functions run on every document that is stored, exported or analysed,
+so they traverse documents without recursion and cache the getters and keys
+they create.
 
 """
 
+import os
+import logging
+import itertools
 
-def dotkeys(doc, key_string):
-    """returns the (nested) field specified by the key_string from the doc """
-    if type(key_string) != list:
-        keys = key_string.split(".")
-    else:
-        keys = key_string
+logger = logging.getLogger("INCA")
+
+# key : key with dots replaced, (path, key) : joined path, and key string :
+# getter; the caches are cleared when they grow beyond MAX_CACHED keys
+MAX_CACHED = 100000
+_undotted = {}
+_paths = {}
+_getters = {}
+
+
+def _getter(keys):
     if not keys:
-        return doc
-    field = keys.pop(0)
-    result = doc.get(field, {})
-    if len(keys) > 0 and type(result) == dict:
-        return dotkeys(result, keys)
-    else:
+        return lambda doc: doc
+    if len(keys) == 1:
+        (key,) = keys
+        return lambda doc: doc.get(key, {})
+    first, rest = keys[0], keys[1:]
+
+    def get(doc):
+        result = doc.get(first, {})
+        for key in rest:
+            if type(result) != dict:
+                break
+            result = result.get(key, {})
         return result
+
+    return get
+
+
+def compile_path(key_string):
+    """returns a function that returns the (nested) field specified by the
+    key_string (or list of keys) from a doc, as dotkeys does"""
+    if type(key_string) == str:
+        path, keys = key_string, key_string.split(".")
+    else:
+        path = keys = tuple(key_string)
+    getter = _getters.get(path)
+    if getter is None:
+        if len(_getters) > MAX_CACHED:
+            _getters.clear()
+        getter = _getters[path] = _getter(tuple(keys))
+    return getter
+
+
+def dotkeys(doc, key_string):
+    """returns the (nested) field specified by the key_string from the doc """
+    return compile_path(key_string)(doc)
+
+
+def extract_columns(docs, key_strings):
+    """returns a list per key_string with the (nested) field of each doc, as
+    dotkeys does, in a single pass over the docs"""
+    keys = [
+        tuple(k.split(".")) if type(k) == str else tuple(k) for k in key_strings
+    ]
+    # keys shared by all fields, such as `_source`, are looked up once per doc
+    shared = ()
+    if keys:
+        shared = tuple(os.path.commonprefix(keys))
+        shared = shared[: min(len(k) for k in keys) - 1]
+    get_shared = compile_path(shared)
+    getters = [compile_path(k[len(shared) :]) for k in keys]
+    columns = [[] for k in keys]
+    appends = [column.append for column in columns]
+    pairs = list(zip(appends, getters))
+    for doc in docs:
+        parent = get_shared(doc)
+        if shared and type(parent) != dict:
+            for append in appends:
+                append(parent)
+        else:
+            for append, get in pairs:
+                append(get(parent))
+    return columns
+
+
+def _undot(key):
+    undotted = _undotted.get(key)
+    if undotted is None:
+        if len(_undotted) > MAX_CACHED:
+            _undotted.clear()
+        undotted = _undotted[key] = key.replace(".", "_")
+    return undotted
+
+
+def remove_dots(document):
+    """replaces dots in the keys of the (nested) dicts of the doc by
+    underscores, in place, and returns the doc"""
+    dicts = [document]
+    while dicts:
+        current = dicts.pop()
+        dotted = []
+        for key, value in current.items():
+            if "." in key:
+                dotted.append(key)
+            if type(value) == dict:
+                dicts.append(value)
+        for key in dotted:
+            current[_undot(key)] = current.pop(key)
+    return document
+
+
+def _join(path, key):
+    joined = _paths.get((path, key))
+    if joined is None:
+        if len(_paths) > MAX_CACHED:
+            _paths.clear()
+        joined = _paths[path, key] = "{}.{}".format(path, key) if path else key
+    return joined
+
+
+def flatten(document, skip=(), skip_nested=()):
+    """returns a flat dict of strings from the (nested) doc, in which nested
+    keys are joined by dots. Keys in `skip` are left out of the doc, keys in
+    `skip_nested` out of nested dicts."""
+    flat = {}
+    stack = [("", iter(document.items()), skip)]
+    while stack:
+        path, items, skipped = stack[-1]
+        for key, value in items:
+            if key in skipped:
+                continue
+            if type(value) == str:
+                flat[_join(path, key)] = value
+            elif type(value) == dict:
+                stack.append((_join(path, key), iter(value.items()), skip_nested))
+                break
+            else:
+                try:
+                    flat[_join(path, key)] = str(value)
+                except:
+                    logger.warning(
+                        "Unable to ready field {key} for writing".format(key=key)
+                    )
+        else:
+            stack.pop()
+    return flat
+
+
+def batches(iterable, size):
+    """yields lists of `size` items of the iterable, the last one can be
+    shorter"""
+    iterator = iter(iterable)
+    while True:
+        batch = list(itertools.islice(iterator, size))
+        if not batch:
+            return
+        yield batch
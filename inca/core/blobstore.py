@@ -0,0 +1,193 @@
+"""
+This file provides a content-addressed store for raw payloads.
+
+Scraped documents carry large raw payloads, such as the `htmlsource` of
+articles or the `xml_content` of parliamentary proceedings, that are hardly
+ever searched but inflate the index. When a blob store is configured, these
+fields are written to compressed files on disk, keyed by the SHA-256 hash of
+their content, and documents in elasticsearch only keep the hash as
+`<field>_blob`. Identical payloads are stored once.
+
+Files are compressed with zstd if the `zstandard` package is installed and
+with gzip otherwise, and sharded over subdirectories by the first
+characters of their hash.
+
+The store is enabled by setting `path` in the `[blobstore]` section of
+settings.cfg. Code that needs a payload should call `resolve` on the
+document's `_source`, which loads offloaded fields on demand.
+"""
+
+import os
+import gzip
+import logging
+import configparser
+from hashlib import sha256
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+logger = logging.getLogger("INCA")
+
+# the settings database.py reads, which imports this file
+INCADIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+config = configparser.ConfigParser()
+config.read([os.path.join(INCADIR, "settings.cfg"), "settings.cfg"])
+
+PAYLOAD_FIELDS = ["htmlsource", "xml_content"]
+REFERENCE_SUFFIX = "_blob"
+
+
+class BlobStore:
+    """A directory of compressed, content-addressed payloads
+
+    Parameters
+    ----
+    path : string
+        The root directory of the store
+    level : int (default=3)
+        The compression level
+    """
+
+    def __init__(self, path, level=3):
+        self.path = os.path.expanduser(path)
+        self.level = level
+        if zstandard is not None:
+            self.extension = ".zst"
+            self._compressor = zstandard.ZstdCompressor(level=level)
+        else:
+            logger.info("zstandard is not installed, compressing blobs with gzip")
+            self.extension = ".gz"
+
+    def _filename(self, key, extension):
+        return os.path.join(self.path, key[:2], key[2:4], key + extension)
+
+    def _compress(self, data):
+        if self.extension == ".zst":
+            return self._compressor.compress(data)
+        return gzip.compress(data, compresslevel=self.level)
+
+    def put(self, payload):
+        """Stores a payload and returns its key
+
+        Parameters
+        ----
+        payload : string or bytes
+            The content to store
+
+        Returns
+        ----
+        string
+            The SHA-256 hash of the (utf-8 encoded) payload
+        """
+        if type(payload) == str:
+            payload = payload.encode("utf-8")
+        key = sha256(payload).hexdigest()
+        filename = self._filename(key, self.extension)
+        if os.path.exists(filename):
+            return key
+        os.makedirs(os.path.dirname(filename), exist_ok=True)
+        tmpname = "{filename}.{pid}.tmp".format(filename=filename, pid=os.getpid())
+        with open(tmpname, "wb") as f:
+            f.write(self._compress(payload))
+        os.replace(tmpname, filename)
+        return key
+
+    def get(self, key):
+        """Returns the stored payload for a key as string, None if missing"""
+        filename = self._filename(key, ".zst")
+        if os.path.exists(filename):
+            if zstandard is None:
+                raise ImportError("zstandard is required to read {}".format(filename))
+            with open(filename, "rb") as f:
+                payload = zstandard.ZstdDecompressor().decompress(f.read())
+            return payload.decode("utf-8")
+        filename = self._filename(key, ".gz")
+        if os.path.exists(filename):
+            with gzip.open(filename, "rb") as f:
+                return f.read().decode("utf-8")
+        logger.warning("Blob {key} not found in {self.path}".format(**locals()))
+        return None
+
+    def exists(self, key):
+        return any(
+            os.path.exists(self._filename(key, extension))
+            for extension in [".zst", ".gz"]
+        )
+
+
+_path = config.get("blobstore", "path", fallback=None)
+store = _path and BlobStore(_path) or None
+
+
+def offload(source, fields=PAYLOAD_FIELDS):
+    """Moves payload fields of a document to the blob store
+
+    The payload is replaced by a `<field>_blob` reference, also in the
+    `META` of the document. Does nothing if no blob store is configured.
+
+    Parameters
+    ----
+    source : dict
+        The document (or its `_source`), changed in place
+    fields : list
+        The payload fields to offload
+
+    Returns
+    ----
+    dict
+        The changed document
+    """
+    if store is None:
+        return source
+    for field in fields:
+        payload = source.get(field)
+        if not payload or type(payload) not in (str, bytes):
+            continue
+        reference = field + REFERENCE_SUFFIX
+        source[reference] = store.put(payload)
+        source.pop(field)
+        meta = source.get("META")
+        if type(meta) == dict and field in meta:
+            meta[reference] = meta.pop(field)
+    return source
+
+
+def resolve(source, fields=PAYLOAD_FIELDS):
+    """Loads offloaded payload fields of a document from the blob store
+
+    Parameters
+    ----
+    source : dict
+        The `_source` of a document, changed in place
+    fields : list
+        The payload fields to load
+
+    Returns
+    ----
+    dict
+        The document, with the payload in `<field>` for every field that
+        has a `<field>_blob` reference
+    """
+    for field in fields:
+        key = source.get(field + REFERENCE_SUFFIX)
+        if not key or source.get(field):
+            continue
+        if store is None:
+            logger.warning(
+                "Document refers to blob {key}, but no blob store is configured".format(
+                    key=key
+                )
+            )
+            continue
+        payload = store.get(key)
+        if payload is not None:
+            source[field] = payload
+    return source
+
+
+def resolve_document(document, fields=PAYLOAD_FIELDS):
+    """Like `resolve`, but for a document including elasticsearch metadata"""
+    resolve(document.get("_source", document), fields)
+    return document
@@ -9,15 +9,13 @@ requires a functioning elasticsearch instance.
 from .scraper_class import Scraper
 from ..clients._general_utils import *
 from .database import DATABASE_AVAILABLE
-
-if DATABASE_AVAILABLE:
-    from .database import client
-    from elasticsearch.exceptions import (
-        ConnectionError,
-        ConnectionTimeout,
-        NotFoundError,
-        RequestError,
-    )
+from .database import client
+from elasticsearch.exceptions import (
+    ConnectionError,
+    ConnectionTimeout,
+    NotFoundError,
+    RequestError,
+)
 import time
 import datetime
 import logging
@@ -204,7 +202,7 @@ class Client(Scraper):
             return []
 
         logger.info("Starting client")
-        if DATABASE_AVAILABLE == True and kwargs.get("database", True):
+        if DATABASE_AVAILABLE and kwargs.get("database", True):
             for docs in self.get(credentials=usable_credentials, *args, **kwargs):
                 # in case the function yields individual rather than batch results
                 if type(docs) == dict:
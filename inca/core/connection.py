@@ -0,0 +1,294 @@
+"""
+This file provides the connection to elasticsearch.
+
+The client is created when it is first used, not when INCA is imported, so
+importing INCA never waits for the network. `ClientManager.client` is a
+proxy that can be imported everywhere (as `core.database.client`) and
+behaves like an `Elasticsearch` instance. Every request made through it
+follows one retry policy: failed requests due to timeouts, unreachable
+nodes or an overloaded cluster are retried a bounded number of times with
+exponential backoff. The number of calls, retries, failures and the
+latency of requests are recorded per operation, see `ClientManager.metrics`.
+
+Multiple nodes can be configured as a comma-separated list of `host:port`
+in `<dependencies>.hosts` in the `[elasticsearch]` section of settings.cfg.
+The client keeps a connection pool per node and, if `sniff = true`,
+discovers the other nodes of the cluster.
+"""
+
+import time
+import random
+import logging
+import threading
+
+from elasticsearch import Elasticsearch
+from elasticsearch.exceptions import (
+    ConnectionError,
+    ConnectionTimeout,
+    TransportError,
+)
+
+logger = logging.getLogger("INCA")
+
+RETRY_STATUS = [429, 502, 503, 504]
+
+
+class RetryPolicy:
+    """Retries failed requests with bounded exponential backoff
+
+    Parameters
+    ----
+    max_retries : int (default=5)
+        Maximum number of retries of a request, after which the error is raised
+    backoff : float (default=0.5)
+        Seconds to wait before the first retry, doubled for each next retry
+    max_backoff : float (default=30)
+        Maximum number of seconds to wait between retries
+    """
+
+    def __init__(self, max_retries=5, backoff=0.5, max_backoff=30):
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+
+    @staticmethod
+    def retryable(error):
+        if isinstance(error, (ConnectionError, ConnectionTimeout)):
+            return True
+        return isinstance(error, TransportError) and error.status_code in RETRY_STATUS
+
+    def wait(self, attempt):
+        """Seconds to wait before retry number `attempt` (starting at 0), with
+        jitter so clients do not retry in lockstep"""
+        delay = min(self.backoff * 2 ** attempt, self.max_backoff)
+        return delay / 2 + random.uniform(0, delay / 2)
+
+    def call(self, function, *args, on_retry=None, **kwargs):
+        attempt = 0
+        while True:
+            try:
+                return function(*args, **kwargs)
+            except Exception as e:
+                if attempt >= self.max_retries or not self.retryable(e):
+                    raise
+                delay = self.wait(attempt)
+                logger.warning(
+                    "Elasticsearch request failed ({e}), retry {n} of {max} in "
+                    "{delay:.1f}s".format(
+                        e=e, n=attempt + 1, max=self.max_retries, delay=delay
+                    )
+                )
+                if on_retry:
+                    on_retry()
+                time.sleep(delay)
+                attempt += 1
+
+
+class Metrics:
+    """Counts calls, retries and failures and sums latency per operation"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._operations = {}
+
+    def _operation(self, name):
+        return self._operations.setdefault(
+            name, dict(calls=0, retries=0, failures=0, seconds=0.0, max_seconds=0.0)
+        )
+
+    def retry(self, name):
+        with self._lock:
+            self._operation(name)["retries"] += 1
+
+    def record(self, name, seconds, failed=False):
+        with self._lock:
+            operation = self._operation(name)
+            operation["calls"] += 1
+            operation["failures"] += failed
+            operation["seconds"] += seconds
+            operation["max_seconds"] = max(operation["max_seconds"], seconds)
+
+    def snapshot(self):
+        """Returns the metrics per operation, including the mean latency"""
+        with self._lock:
+            snapshot = {name: dict(op) for name, op in self._operations.items()}
+        for operation in snapshot.values():
+            operation["mean_seconds"] = operation["seconds"] / max(
+                operation["calls"], 1
+            )
+        return snapshot
+
+    def reset(self):
+        with self._lock:
+            self._operations = {}
+
+
+# namespaced APIs, such as client.indices, whose requests are retried as well
+_NAMESPACES = ("indices", "cluster", "snapshot", "ingest", "tasks", "cat", "nodes")
+
+
+class _ClientProxy:
+    """Behaves like an Elasticsearch client, but connects (and sets up the
+    index) on first use and sends every request through the retry policy"""
+
+    def __init__(self, manager, target=None, prefix=""):
+        self._manager = manager
+        self._target = target
+        self._prefix = prefix
+
+    def __getattr__(self, name):
+        target = self._target
+        if target is None:
+            # connecting also sets up the index, before the first request
+            self._manager.is_available()
+            target = self._manager.connect()
+        attribute = getattr(target, name)
+        operation = self._prefix + name
+        if not self._prefix and name in _NAMESPACES:
+            return _ClientProxy(self._manager, attribute, operation + ".")
+        if not callable(attribute) or name.startswith("_"):
+            # e.g. client.transport, which helpers use directly
+            return attribute
+        return lambda *args, **kwargs: self._manager.request(
+            operation, attribute, *args, **kwargs
+        )
+
+    def __bool__(self):
+        return True
+
+
+class _Availability:
+    """Truthy if the database can be used, checked on first evaluation"""
+
+    def __init__(self, check):
+        self._check = check
+
+    def __bool__(self):
+        return self._check()
+
+    def __eq__(self, other):
+        return bool(self) == other
+
+    def __hash__(self):
+        return hash(bool(self))
+
+    def __repr__(self):
+        return repr(bool(self))
+
+
+class ClientManager:
+    """Creates and configures the elasticsearch client on first use
+
+    Parameters
+    ----
+    config : ConfigParser
+        The INCA settings
+    setup : callable (default=None)
+        Called with the client after connecting, for instance to create the
+        index. Exceptions make the database unavailable.
+    retry_policy : RetryPolicy (default=None)
+        The retry policy for all requests, configured from settings.cfg if
+        not given
+    """
+
+    def __init__(self, config, setup=None, retry_policy=None):
+        self.config = config
+        self.setup = setup
+        dependencies = config.get("inca", "dependencies", fallback="standard")
+        section = "elasticsearch"
+        self.hosts = _hosts(config, section, dependencies)
+        self.timeout = config.getint(section, "timeout", fallback=60)
+        self.maxsize = config.getint(section, "maxsize", fallback=25)
+        self.sniff = config.getboolean(section, "sniff", fallback=False)
+        self.retry_policy = retry_policy or RetryPolicy(
+            max_retries=config.getint(section, "max_retries", fallback=5),
+            backoff=config.getfloat(section, "retry_backoff", fallback=0.5),
+        )
+        self.metrics = Metrics()
+        self.client = _ClientProxy(self)
+        self.available = _Availability(self.is_available)
+        self._client = None
+        self._available = None
+        self._lock = threading.Lock()
+        self._check_lock = threading.Lock()
+
+    def connect(self):
+        """Returns the elasticsearch client, creating it if needed"""
+        if self._client is None:
+            with self._lock:
+                if self._client is None:
+                    self._client = Elasticsearch(
+                        self.hosts,
+                        timeout=self.timeout,
+                        maxsize=self.maxsize,
+                        sniff_on_start=self.sniff,
+                        sniff_on_connection_fail=self.sniff,
+                        sniffer_timeout=self.sniff and 60 or None,
+                        # the transport only fails over to other nodes,
+                        # retries with backoff are done by the retry policy
+                        max_retries=len(self.hosts) - 1,
+                        retry_on_timeout=False,
+                    )
+        return self._client
+
+    def is_available(self):
+        """Checks once whether elasticsearch can be used"""
+        if self._available is None:
+            with self._check_lock:
+                if self._available is None:
+                    self._available = self._check()
+        return self._available
+
+    def _check(self):
+        # a single attempt: an unreachable database should not delay INCA
+        try:
+            version = int(self.connect().info()["version"]["number"].split(".")[0])
+            if version < 6:
+                logger.warning(
+                    "Your version of ElasticSearch is not compatible with inca, version 6 or higher is required. Continuing without database. This means you will not be able to SAVE the results of any scraper or processor!"
+                )
+                return False
+            if self.setup:
+                # a client that does not wait for this check to finish
+                self.setup(_ClientProxy(self, self.connect()))
+            return True
+        except Exception as e:
+            logger.warning(
+                "No database functionality available ({e}). This means you will not be able to SAVE the results of any scraper or processor!".format(
+                    e=e
+                )
+            )
+            return False
+
+    def request(self, operation, function, *args, **kwargs):
+        """Calls a client method with the retry policy, recording metrics"""
+        started = time.time()
+        try:
+            result = self.retry_policy.call(
+                function,
+                *args,
+                on_retry=lambda: self.metrics.retry(operation),
+                **kwargs
+            )
+        except Exception:
+            self.metrics.record(operation, time.time() - started, failed=True)
+            raise
+        self.metrics.record(operation, time.time() - started)
+        return result
+
+
+def _hosts(config, section, dependencies):
+    """The configured nodes as a list of {host, port} dictionaries"""
+    hosts = config.get(section, "%s.hosts" % dependencies, fallback="")
+    if hosts:
+        nodes = []
+        for node in hosts.split(","):
+            host, _, port = node.strip().partition(":")
+            nodes.append(dict(host=host, port=int(port or 9200)))
+        return nodes
+    return [
+        dict(
+            host=config.get(section, "%s.host" % dependencies, fallback="localhost"),
+            port=config.getint(section, "%s.port" % dependencies, fallback=9200),
+        )
+    ]
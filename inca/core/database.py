@@ -5,71 +5,96 @@ This module provides database access objects. The idea is
 that all database specific functionality is in this document alone. Other
 classes and functions should interact with the database only through
 functionality provided here.
+
+Documents are stored through a storage backend (see core.storage), by
+default elasticsearch. With `storage = sqlite` in the `[inca]` section of
+settings.cfg, documents are stored in a local SQLite file instead and no
+elasticsearch cluster is needed. Backups, deduplication and sliced
+scrolling require elasticsearch.
 """
 
 
 import logging
 import json
 import csv
-from elasticsearch import Elasticsearch, NotFoundError, helpers
-from elasticsearch.exceptions import ConnectionTimeout
+from elasticsearch import NotFoundError, helpers
 import time
 from datetime import datetime
 import configparser
 import requests
 from celery import Task
 import os
+import threading
+from queue import Queue
 from tqdm import tqdm
 from hashlib import md5
 from .filenames import id2filename
+from .basic_utils import remove_dots
+from .extraction import reparse_documents
+from . import blobstore
+from .storage import get_backend
+from .connection import ClientManager
+from . import instrumentation
+
+INCADIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 
 config = configparser.ConfigParser()
-config.read("settings.cfg")
+config.read([os.path.join(INCADIR, "settings.cfg"), "settings.cfg"])
 
 logger = logging.getLogger("INCA")
 logging.getLogger("elasticsearch").setLevel(logging.CRITICAL)
 
-try:
-    client = Elasticsearch(
-        host=config.get(
-            "elasticsearch", "%s.host" % config.get("inca", "dependencies")
-        ),
-        port=int(
-            config.get("elasticsearch", "%s.port" % config.get("inca", "dependencies"))
-        ),
-        timeout=60,
-    )  # should be updated to reflect config
-    elastic_index = config.get("elasticsearch", "document_index")
+STORAGE = config.get("inca", "storage", fallback="elasticsearch")
+elastic_index = config.get("elasticsearch", "document_index", fallback="inca")
+
+
+def _create_index(client):
+    """initialize mappings if index does not yet exist"""
+    if not client.indices.exists(elastic_index):
+        with open(os.path.join(INCADIR, "schema.json")) as f:
+            client.indices.create(elastic_index, json.load(f))
+
+
+# The client connects on first use, see core.connection
+manager = ClientManager(config, setup=_create_index)
+client = manager.client
+DATABASE_AVAILABLE = manager.available
+
+backend = get_backend(config, client, elastic_index)
+if backend.name != "elasticsearch":
     DATABASE_AVAILABLE = True
-    check = int(client.info()["version"]["number"][0])
-    if check < 6:
-        logger.warning(
-            "Your version of ElasticSearch is not compatible with inca, version 6 or higher is required. More information can be found here: ... Continuing without database. This means you will not be able to SAVE the results of any scraper or processor!"
-        )
-        DATABASE_AVAILABLE = False
-    # initialize mappings if index does not yet exist
-    try:
-        # if not elastic_index in client.indices.get_aliases().keys():
-        if not client.indices.exists(elastic_index):
-            client.indices.create(elastic_index, json.load(open("schema.json")))
-    except Exception as e:
-        raise Exception("Unable to communicate with elasticsearch, {}".format(e))
-except:
-    logger.warning(
-        "No database functionality available. This means you will not be able to SAVE the results of any scraper or processor!"
-    )
-    DATABASE_AVAILABLE = False
 
 
+def client_metrics():
+    """Returns the number of calls, retries and failures and the latency of
+    elasticsearch requests per operation"""
+    return manager.metrics.snapshot()
+
+
+def _client_samples():
+    for operation, metrics in client_metrics().items():
+        for metric in ["calls", "retries", "failures", "seconds"]:
+            yield (
+                "inca_elasticsearch_{}_total".format(metric),
+                dict(operation=operation),
+                metrics[metric],
+            )
+
+
+instrumentation.registry.add_collector(_client_samples)
+
+
+@instrumentation.timed("inca_database_seconds", function="get_document")
 def get_document(doc_id):
     if not check_exists(doc_id)[0]:
         logger.debug("No document found with id {doc_id}".format(**locals()))
         return {}
     else:
-        document = client.get(elastic_index, doc_type="doc", id=doc_id)
+        document = backend.get(doc_id)
     return document
 
 
+@instrumentation.timed("inca_database_seconds", function="check_exists")
 def check_exists(document_id):
     if not DATABASE_AVAILABLE:
         return False, {}
@@ -77,32 +102,24 @@ def check_exists(document_id):
         logger.warning("You did not provide a document_id, returning False")
         return False, {}
     index = elastic_index
-    try:
-        retrieved = client.get(elastic_index, doc_type="doc", id=document_id)
-        logger.debug(
-            "elastic_index {index} - document [{document_id}] found, return document".format(
-                **locals()
-            )
-        )
-        return True, retrieved
-    except NotFoundError:
+    # timeouts are retried by the client (see core.connection)
+    retrieved = backend.get(document_id)
+    if retrieved is None:
         logger.debug(
             "elastic_index {index} - document [{document_id}] NOT found, returning false".format(
                 **locals()
             )
         )
         return False, {}
-    # TODO: ADD TIMEOUT HANDLER
-    except ConnectionTimeout:
-        logger.warning(
-            "unable to check for documents in elasticsearch elastic_index [{elastic_index}]".format(
-                **{"elastic_index": elastic_index}
-            )
+    logger.debug(
+        "elastic_index {index} - document [{document_id}] found, return document".format(
+            **locals()
         )
-        time.sleep(1)
-        return check_exists(document_id)
+    )
+    return True, retrieved
 
 
+@instrumentation.timed("inca_database_seconds", function="update_document")
 def update_document(document, force=False, retry=0, max_retries=10):
     """
     Documents should usually only be appended, not updated as such.
@@ -117,49 +134,25 @@ def update_document(document, force=False, retry=0, max_retries=10):
         Indicates whether the document should replace (true) or only
         expand existing documents (false). Note that partial updates
         are not supported when forcing.
-    retry (optional): integer [default=0]
-        counter of the number of tries
-    max_retries (optional): integer [default=10]
-        number of attempts to insert documents. Compared to retry integer.
+    retry, max_retries (optional):
+        ignored, failed requests are retried by the client (see core.connection)
 
     """
     exists, old_document = check_exists(document["_id"])
+    blobstore.offload(document["_source"])
     if exists and not force:
         logging.debug(
             "updating existing document {old_document[_id]}".format(**locals())
         )
         document["_source"].update(old_document["_source"])
         document = _remove_dots(document)
-        client.update(
-            index=elastic_index,
-            doc_type="doc",
-            id=document["_id"],
-            body={"doc": document["_source"]},
-        )
+        backend.update(document["_id"], document["_source"])
     elif exists and force:
-        client.delete(index=elastic_index, doc_type="doc", id=old_document["_id"])
+        backend.delete(old_document["_id"])
 
         logging.info("FORCED UPDATE of {old_document[_id]}".format(**locals()))
         document = _remove_dots(document)
-        try:
-            client.index(
-                index=elastic_index,
-                doc_type="doc",
-                id=old_document["_id"],
-                body=document["_source"],
-            )
-        except Exception as e:
-            if retry < max_retries:
-                logging.warning(
-                    "FAILED TO RE-INSERT DOCUMENT {document[_id]}, {e} retrying".format(
-                        **locals()
-                    )
-                )
-                update_document(
-                    document, force=force, retry=retry + 1, max_retries=max_retries
-                )
-            else:
-                raise e
+        backend.insert(document["_source"], old_document["_id"])
     else:
         logging.debug(
             "No existing document found for {document}, defering to insert function"
@@ -168,6 +161,15 @@ def update_document(document, force=False, retry=0, max_retries=10):
     pass
 
 
+@instrumentation.timed("inca_database_seconds", function="existing_ids")
+def existing_ids(document_ids):
+    """Returns the set of ids in `document_ids` that are stored, in a single
+    request. Use this instead of `check_exists` to check many documents."""
+    if not DATABASE_AVAILABLE:
+        return set()
+    return backend.existing([i for i in document_ids if i and str(i).strip()])
+
+
 def delete_document(document_id):
     """ delete a document
 
@@ -193,7 +195,7 @@ def delete_document(document_id):
     if not found:
         logger.debug("{document_id} does not exist".format(**locals()))
         return False
-    response = client.delete(index=elastic_index, id=document["_id"], doc_type="doc")
+    backend.delete(document["_id"])
     return True
 
 
@@ -206,6 +208,7 @@ def delete_doctype(doctype):
     return True
 
 
+@instrumentation.timed("inca_database_seconds", function="insert_document")
 def insert_document(document, custom_identifier=""):
     """ Insert a new document into the default index """
     document = _remove_dots(document)
@@ -219,14 +222,7 @@ def insert_document(document, custom_identifier=""):
         document_type = "unknown"
         document["_source"]["doctype"] = document_type
     if not custom_identifier:
-        try:
-            doc = client.index(
-                index=elastic_index,
-                doc_type="doc",
-                body=document.get("_source", document),
-            )
-        except ConnectionTimeout:
-            doc = {"_id": insert_document(document, custom_identifier)}
+        doc = {"_id": backend.insert(document.get("_source", document))}
     else:
         test = check_exists(custom_identifier)
         if test[0] == True:
@@ -235,19 +231,16 @@ def insert_document(document, custom_identifier=""):
             )
             return {}
         else:
-            try:
-                doc = client.index(
-                    index=elastic_index,
-                    doc_type="doc",
-                    body=document.get("_source", document),
-                    id=custom_identifier,
+            doc = {
+                "_id": backend.insert(
+                    document.get("_source", document), custom_identifier
                 )
-            except ConnectionTimeout:
-                doc = {"_id": insert_document(document["_source"], custom_identifier)}
+            }
     logger.debug("added new document, content: {document}".format(**locals()))
     return doc["_id"]
 
 
+@instrumentation.timed("inca_database_seconds", function="insert_documents")
 def insert_documents(documents, identifiers="id"):
     """ Insert a batch of documents in ES
 
@@ -280,9 +273,10 @@ def insert_documents(documents, identifiers="id"):
                 % (len(documents), len(identifiers))
             )
             raise Exception("Unable to process document batch")
+        # check all identifiers in a single request
+        existing = existing_ids(identifiers)
         for doc, identifier in zip(documents, identifiers):
-            test = check_exists(identifier)
-            if test[0] == True:
+            if str(identifier) in existing:
                 logger.warning(
                     "Identifier %s already exists in database, document is not inserted. Please choose a different identifier."
                     % identifier
@@ -294,11 +288,11 @@ def insert_documents(documents, identifiers="id"):
 
     if type(identifiers) == str:
         logger.debug("Processing identifiers as key")
+        existing = existing_ids(doc.get(identifiers, "") for doc in documents)
         for doc in documents:
             id_value = doc.get(identifiers, "")
             if id_value:
-                test = check_exists(id_value)
-                if test[0] == True:
+                if str(id_value) in existing:
                     logger.warning(
                         "Identifier %s already exists in database, document is not inserted. Please choose a different identifier."
                         % id_value
@@ -312,12 +306,9 @@ def insert_documents(documents, identifiers="id"):
                     "Key for identifier not found, reverting to ES generated."
                 )
 
-    documents = [doc for doc in documents if doc["_id"] != {}]
-    for doc in documents:
-        doc["_index"] = elastic_index
-        doc["_type"] = "doc"
+    documents = [doc for doc in documents if doc.get("_id") != {}]
     # Insert documents
-    logger.debug(helpers.bulk(client, documents))
+    logger.debug(backend.bulk(documents))
     return [doc.get("_id", "random") for doc in documents]
 
 
@@ -399,19 +390,14 @@ class bulk_upsert(Task):
 
     def run(self, documents):
         logger.debug(documents)
-        return helpers.bulk(client, documents)
+        return backend.bulk(documents)
 
 
 def _remove_dots(document):
     """ elasticsearch is allergic to dots like '.' in keys.
     if you're not careful, it may choke!
     """
-    for k, v in document.items():
-        if "." in k:
-            document[k.replace(".", "_")] = document.pop(k)
-        if type(v) == dict:
-            document[k.replace(".", "_")] = _remove_dots(v)
-    return document
+    return remove_dots(document)
 
 
 def scroll_query(query, scroll_time="30m", log_interval=None):
@@ -440,7 +426,7 @@ def scroll_query(query, scroll_time="30m", log_interval=None):
         total = 0
         update_step = -1
     else:
-        total = client.search(index=elastic_index, body=query)["hits"]["total"]
+        total = backend.count(query)
         if type(log_interval) == int:
             update_step = log_interval
         elif type(log_interval) == float:
@@ -448,13 +434,177 @@ def scroll_query(query, scroll_time="30m", log_interval=None):
         else:
             update_step = min((total / 1000), 100)
 
-    for doc in tqdm(
-        helpers.scan(client, index=elastic_index, query=query, scroll=scroll_time),
-        total=total,
+    # only the time spent retrieving documents is recorded, not the time
+    # spent by the caller between documents
+    documents = iter(backend.scroll(query, scroll_time=scroll_time))
+    waited, n = 0.0, 0
+    try:
+        with tqdm(total=total) as progress:
+            while True:
+                started = time.perf_counter()
+                doc = next(documents, None)
+                waited += time.perf_counter() - started
+                if doc is None:
+                    break
+                n += 1
+                progress.update()
+                yield doc
+    finally:
+        instrumentation.observe(
+            "inca_database_seconds", waited, function="scroll_query"
+        )
+        instrumentation.increment(
+            "inca_database_documents_total", n, function="scroll_query"
+        )
+
+
+def scroll_query_slice(
+    query, slice_id, slices, source=None, scroll_time="30m", size=500
+):
+    """Scroll through one slice of the results of a query
+
+    Slices are independent, so they can be retrieved by different threads,
+    processes or machines. Only elasticsearch can slice a scroll: with other
+    backends, the first slice holds all results and the others are empty.
+
+    Parameters
+    ----
+    query : dict
+        An elasticsearch query
+    slice_id : int
+        The slice to retrieve, from 0 up to `slices`
+    slices : int
+        The number of slices in which the results are split
+    source, scroll_time, size
+        See `sliced_scroll_query`
+
+    yields
+    ----
+    dict
+        A stored document, including elasticsearch metadata
+    """
+    if backend.name != "elasticsearch":
+        if slice_id == 0:
+            for doc in backend.scroll(query, size=size, source=source):
+                yield doc
+        return
+    body = dict(query)
+    if slices > 1:
+        body["slice"] = {"id": slice_id, "max": slices}
+    if source is not None:
+        body["_source"] = source
+    for doc in helpers.scan(
+        client, index=elastic_index, query=body, scroll=scroll_time, size=size
     ):
         yield doc
 
 
+def sliced_scroll_query(
+    query, slices=4, source=None, scroll_time="30m", size=500, buffersize=5000
+):
+    """Scroll through the results of a query with parallel sliced scrolls
+
+    Parameters
+    ----
+    query : dict
+        An elasticsearch query
+    slices : int (default=4)
+        The number of slices to scroll in parallel. Preferably not more than
+        the number of shards of the index.
+    source : list (default=None)
+        If given, only these fields of `_source` are retrieved
+    scroll_time : string (default='30m')
+        See `scroll_query`
+    size : int (default=500)
+        Number of documents retrieved per scroll request and slice
+    buffersize : int (default=5000)
+        Maximum number of retrieved documents kept in memory
+
+    yields
+    ----
+    dict
+        A stored document, including elasticsearch metadata. Documents of
+        different slices are interleaved, so the order is not defined.
+
+    """
+    if backend.name != "elasticsearch":
+        for doc in backend.scroll(query, size=size, source=source):
+            yield doc
+        return
+
+    buffer = Queue(maxsize=buffersize)
+    done = object()
+
+    def scroll_slice(slice_id):
+        try:
+            for doc in scroll_query_slice(
+                query, slice_id, slices, source, scroll_time, size
+            ):
+                buffer.put(doc)
+        except Exception as e:
+            buffer.put(e)
+        buffer.put(done)
+
+    threads = [
+        threading.Thread(target=scroll_slice, args=(slice_id,), daemon=True)
+        for slice_id in range(slices)
+    ]
+    for thread in threads:
+        thread.start()
+    running = len(threads)
+    while running:
+        doc = buffer.get()
+        if doc is done:
+            running -= 1
+        elif isinstance(doc, Exception):
+            raise doc
+        else:
+            yield doc
+
+
+def bulk_update_fields(updates, chunk_size=500):
+    """Writes partial updates of documents in bulk
+
+    Unlike `update_document`, this does not retrieve the stored document
+    first. Only the given fields are sent, and other fields are left as
+    they are.
+
+    Parameters
+    ----
+    updates : iterable
+        (document_id, fields) tuples, in which `fields` is a dict with the
+        new values of the fields to update
+    chunk_size : int (default=500)
+        Number of updates sent per bulk request
+
+    Returns
+    ----
+    tuple
+        The number of successful updates and a list of errors
+    """
+    return backend.bulk_update(
+        ((document_id, _remove_dots(fields)) for document_id, fields in updates),
+        chunk_size=chunk_size,
+    )
+
+
+def failed_ids(errors):
+    """Returns the ids of the documents in the errors of `bulk_update_fields`
+
+    Parameters
+    ----
+    errors : list
+        The errors returned by `bulk_update_fields`
+
+    Returns
+    ----
+    list
+        The ids of the documents that were not updated, as strings
+    """
+    # elasticsearch reports errors per action, e.g. {'update': {'_id': ...}}
+    return [str(error.get("update", error).get("_id")) for error in errors]
+
+
 #####################
 #
 # Database backup functionality
@@ -699,6 +849,7 @@ def reparse(g, f, force=False):
     # To implement that, we need a better logic on which fields are to be replaced when
 
     for doc in g:
+        blobstore.resolve(doc["_source"], ["htmlsource"])
         text_old = doc["_source"].get("text", "")
         htmlsource = doc["_source"].get("htmlsource", None)
         if not htmlsource:
@@ -730,3 +881,133 @@ def reparse(g, f, force=False):
         update_document(
             doc, force=True
         )  # this force=True has nothing to do with the parameter passed to reparse()
+
+
+def _reparse_changes(doc, parsed, fields, force):
+    """Returns the fields of a reparsed document that should be updated"""
+    source = doc["_source"]
+    changes = {}
+    for field in fields or parsed.keys():
+        new = parsed.get(field)
+        if new is None or new == "" or new == []:
+            continue  # never replace content by an empty parse
+        old = source.get(field)
+        if old == new:
+            continue
+        if old and not force:
+            continue  # by default, only fill fields that are empty
+        changes[field] = new
+    return changes
+
+
+def bulk_reparse(
+    query,
+    f,
+    fields=None,
+    force=False,
+    dryrun=True,
+    processes=None,
+    slices=4,
+    chunk_size=500,
+    examples=10,
+):
+    """Reparses stored `htmlsource` in parallel and writes changes in bulk
+
+    Documents are retrieved with a sliced scroll, including only the
+    `htmlsource` and the fields to update. The parse function runs in a pool
+    of worker processes and only the changed fields are written back with
+    bulk partial updates.
+
+    Parameters
+    ----
+    query : string or dict
+        A query string or elasticsearch query selecting the documents
+    f : callable
+        A parse function, such as `news_scraper.nu.parsehtml` or an
+        `extraction.Extractor`
+    fields : list (default=None)
+        The fields to update. If None, all fields returned by `f` are
+        considered and the full `_source` is retrieved.
+    force : bool (default=False)
+        If False, only empty fields are filled. If True, existing values
+        are replaced as well.
+    dryrun : bool (default=True)
+        If True, nothing is written and only a summary of changes is returned
+    processes : int (default=None)
+        Number of worker processes, defaults to the number of CPUs
+    slices : int (default=4)
+        Number of parallel scroll slices
+    chunk_size : int (default=500)
+        Number of updates per bulk request
+    examples : int (default=10)
+        Number of example changes to include in the summary
+
+    Returns
+    ----
+    dict
+        Summary with the number of documents processed, unparsable and
+        changed, the number of changes per field, example changes and, when
+        not a dry-run, the number of updates written and the errors.
+
+    Example usage:
+    ```
+    from inca.rssscrapers import news_scraper
+    summary = bulk_reparse('doctype:"nu"', news_scraper.nu.parsehtml, fields=["text"])
+    summary = bulk_reparse('doctype:"nu"', news_scraper.nu.parsehtml, fields=["text"], dryrun=False)
+    ```
+    """
+    if type(query) == str:
+        query = {"query": {"query_string": {"query": query}}}
+    source = fields and ["htmlsource", "htmlsource_blob"] + list(fields) or None
+    documents = (
+        blobstore.resolve_document(doc, ["htmlsource"])
+        for doc in sliced_scroll_query(query, slices=slices, source=source)
+    )
+
+    summary = dict(
+        processed=0, unparsable=0, unchanged=0, changed=0, fields={}, examples=[]
+    )
+
+    def changes():
+        for doc, parsed in reparse_documents(documents, f, processes=processes):
+            summary["processed"] += 1
+            if not parsed:
+                summary["unparsable"] += 1
+                continue
+            changed = _reparse_changes(doc, parsed, fields, force)
+            if not changed:
+                summary["unchanged"] += 1
+                continue
+            summary["changed"] += 1
+            for field, new in changed.items():
+                summary["fields"][field] = summary["fields"].get(field, 0) + 1
+                if len(summary["examples"]) < examples:
+                    old = doc["_source"].get(field, "")
+                    summary["examples"].append(
+                        dict(
+                            _id=doc["_id"],
+                            field=field,
+                            old=str(old)[:30],
+                            new=str(new)[:30],
+                        )
+                    )
+            yield doc["_id"], changed
+
+    if dryrun:
+        for _ in changes():
+            pass
+    else:
+        summary["updated"], summary["errors"] = bulk_update_fields(
+            changes(), chunk_size=chunk_size
+        )
+    logger.info(
+        "Reparsed {processed} documents: {changed} changed, {unchanged} unchanged, "
+        "{unparsable} unparsable".format(**summary)
+    )
+    if dryrun:
+        logger.info(
+            "Dry-run, nothing was written. Changes per field: {}".format(
+                summary["fields"]
+            )
+        )
+    return summary
@@ -0,0 +1,155 @@
+"""
+This file provides the registry of function descriptors used in `META`.
+
+Every field of a document records which function added it. Instead of
+copying the full description of that function (its docstring, version,
+arguments, ...) under `META[<field>]` for every field of every document,
+the description is stored once as a descriptor, identified by a short hash
+of its content. Per-field META entries only contain the descriptor id and
+the time the field was added:
+
+```
+"META": {
+    "ADDED": "2019-01-01T12:00:00",
+    "title": {"DESCRIPTOR": "1f0e3dad9990", "ADDED_AT": "2019-01-01T12:00:00"},
+    ...
+}
+```
+
+Descriptors are cached in-process and stored in a separate index (the
+`descriptor_index` setting in the `[elasticsearch]` section, by default the
+document index name followed by `_descriptors`), or in a separate table
+when documents are stored with the SQLite backend. Use `expand_meta` to get
+the full descriptions back. Documents with the old, full META entries are
+left as they are.
+"""
+
+import json
+import time
+import logging
+import threading
+from hashlib import sha1
+
+from .database import backend, client, config, DATABASE_AVAILABLE
+from .storage import ElasticsearchBackend, SQLiteBackend
+
+logger = logging.getLogger("INCA")
+
+DESCRIPTOR_INDEX = config.get(
+    "elasticsearch",
+    "descriptor_index",
+    fallback=config.get("elasticsearch", "document_index", fallback="inca")
+    + "_descriptors",
+)
+DESCRIPTOR_KEY = "DESCRIPTOR"
+ID_LENGTH = 12
+RETRY_AFTER = 60  # seconds before storing a descriptor is tried again
+
+if backend.name == "sqlite":
+    _store = SQLiteBackend(backend.path, table="descriptors")
+else:
+    _store = ElasticsearchBackend(client, DESCRIPTOR_INDEX)
+
+_descriptors = {}  # descriptor id : descriptor
+_stored = set()  # ids of descriptors known to be in the descriptor index
+_retry_at = {}  # descriptor id : time to try again after failing to store it
+_lock = threading.Lock()
+
+
+def describe(task, arguments):
+    """Returns the descriptor of a task called with `arguments`"""
+    try:
+        docstring = task.get.__doc__
+    except AttributeError:
+        try:
+            docstring = task.process.__doc__
+        except AttributeError:
+            docstring = task.run.__doc__
+    return dict(
+        ADDED_USING=str(task.__class__).split(" ")[1],
+        ADDED_METHOD=docstring,
+        FUNCTION_VERSION=task.version,
+        FUNCTION_VERSION_DATE=task.date,
+        FUNCTION_TYPE=task.functiontype,
+        FUNCTION_ARGUMENTS=arguments,
+    )
+
+
+def descriptor_id(descriptor):
+    """Returns the short content hash identifying a descriptor"""
+    serialized = json.dumps(descriptor, sort_keys=True, default=str)
+    return sha1(serialized.encode("utf-8")).hexdigest()[:ID_LENGTH]
+
+
+def register(descriptor):
+    """Adds a descriptor to the registry and returns its id
+
+    The descriptor is written to the descriptor index the first time it is
+    seen by this process. If that fails, it is tried again when the
+    descriptor is registered after `RETRY_AFTER` seconds.
+    """
+    key = descriptor_id(descriptor)
+    if key in _stored or _retry_at.get(key, 0) > time.monotonic():
+        return key
+    with _lock:
+        _descriptors[key] = descriptor
+        if key in _stored or not DATABASE_AVAILABLE:
+            return key
+        if _retry_at.get(key, 0) > time.monotonic():
+            return key
+        try:
+            body = json.loads(json.dumps(descriptor, default=str))
+            _store.insert(body, key)
+            _stored.add(key)
+            _retry_at.pop(key, None)
+        except Exception as e:
+            _retry_at[key] = time.monotonic() + RETRY_AFTER
+            logger.warning(
+                "Unable to store descriptor {key}, retrying in {s} seconds: {e}".format(
+                    key=key, s=RETRY_AFTER, e=e
+                )
+            )
+    return key
+
+
+def get_descriptor(key):
+    """Returns the descriptor with id `key`, or None if it is unknown"""
+    if key in _descriptors:
+        return _descriptors[key]
+    if not DATABASE_AVAILABLE:
+        return None
+    descriptor = _store.get(key)
+    if descriptor is None:
+        logger.warning("Descriptor {key} not found".format(key=key))
+        return None
+    _descriptors[key] = descriptor["_source"]
+    _stored.add(key)
+    return _descriptors[key]
+
+
+def field_meta(key, added_at):
+    """Returns the META entry of a single field"""
+    return {DESCRIPTOR_KEY: key, "ADDED_AT": added_at}
+
+
+def expand_meta(meta):
+    """Replaces descriptor ids in a META dictionary by the full descriptions
+
+    Parameters
+    ----
+    meta : dict
+        The `META` of a document
+
+    Returns
+    ----
+    dict
+        A copy of `meta` in which every compact per-field entry contains the
+        full descriptor. Entries in the old format are returned unchanged.
+    """
+    expanded = {}
+    for field, entry in meta.items():
+        if type(entry) == dict and DESCRIPTOR_KEY in entry:
+            entry = dict(entry)
+            entry.update(get_descriptor(entry[DESCRIPTOR_KEY]) or {})
+        expanded[field] = entry
+    return expanded
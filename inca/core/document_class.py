@@ -16,6 +16,9 @@ from .search_utils import doctype_last, doctype_first
 logger = logging.getLogger("INCA")
 
 from .database import insert_document, insert_documents, update_document, check_exists
+from . import blobstore
+from . import descriptors
+from . import instrumentation
 
 
 class Document(Task):
@@ -24,7 +27,7 @@ class Document(Task):
     On save attempts, this class tries to infer whether required fields
     are present.
 
-    The 'META' key contains a key:description of all other keys in the document.
+    The 'META' key contains a key:descriptor reference for all other keys in the document.
     """
 
     functiontype = (
@@ -33,10 +36,12 @@ class Document(Task):
     version = ""  # string indicating version of function to track changes (e.g. "0.1")
     date = datetime.datetime(year=1, day=1, month=1)  # last function update date
     doctype = ""  # The doctype of documents generated by this function
+    field_types = {}  # {field : type} to generate the index mapping, see core.mapping
 
     def runwrap(self, action="run", *args, **kwargs):
         """
-        Call the task as either a local or distributed process
+        Call the task as either a local or distributed process. 'celery_batch'
+        runs the task as a single celery task and returns its result.
         """
         if action == "run":
             return self.run(*args, **kwargs)
@@ -44,6 +49,13 @@ class Document(Task):
         if action == "delay":
             return self.delay(*args, **kwargs)
 
+        if action == "celery_batch":
+            # runs the whole task as one celery task and waits for it: unlike
+            # processors, which split documents over slices, there is nothing
+            # to split here, so this is not a distributed run
+            logger.info("Sent {task} to celery".format(task=self.__class__.__name__))
+            return self.delay(*args, **kwargs).get()
+
     def __init__(self):
         """
         intializes the document as either a document to be handled by the database or not
@@ -61,6 +73,9 @@ class Document(Task):
         Note that by default, documents can only extend, not replace
         old documents.
 
+        Raw payloads such as `htmlsource` are moved to the blob store, if
+        one is configured (see core.blobstore).
+
         """
         if type(document) == list:
             logger.debug("Detected document batch, forwarding to batch saver")
@@ -82,8 +97,10 @@ class Document(Task):
                 custom_identifier = document.pop("_id")
             else:
                 custom_identifier = None
+            blobstore.offload(document)
             self._verify(document)
             insert_document(document, custom_identifier=custom_identifier)
+            self._count_documents(1)
 
     def _save_documents(self, documents, forced=False):
         """
@@ -107,9 +124,20 @@ class Document(Task):
                 custom_identifier = document.pop("_id")
             else:
                 custom_identifier = None
+            blobstore.offload(document)
             self._verify(document)
 
         insert_documents(documents)
+        self._count_documents(len(documents))
+
+    def _count_documents(self, n):
+        """Records the number of documents saved or processed by this task"""
+        instrumentation.increment(
+            "inca_documents_total",
+            n,
+            functiontype=self.functiontype,
+            task=self.__class__.__name__,
+        )
 
     def _update_document(self, new_document_body):
         """
@@ -125,31 +153,18 @@ class Document(Task):
         This method generates the metadata for returned documents based on
         the 'get' function docstring and arguments.
 
-        All new keys are reflected in the 'META' key with the information
-        about the script in question.
+        All new keys are reflected in the 'META' key with a reference to
+        the description of the script in question, which is stored once
+        (see core.descriptors).
 
         """
         if type(document) == list or isinstance(document, types.GeneratorType):
             return [self._add_metadata(doc) for doc in document]
-        try:
-            docstring = self.get.__doc__
-        except:
-            try:
-                docstring = self.process.__doc__
-            except:
-                docstring = self.run.__doc__
 
         document["doctype"] = self.doctype
 
-        meta = dict(
-            ADDED_AT=datetime.datetime.now(),
-            ADDED_USING=str(self.__class__).split(" ")[1],
-            ADDED_METHOD=docstring,
-            FUNCTION_VERSION=self.version,
-            FUNCTION_VERSION_DATE=self.date,
-            FUNCTION_TYPE=self.functiontype,
-            FUNCTION_ARGUMENTS=kwargs,
-        )
+        descriptor = descriptors.register(descriptors.describe(self, kwargs))
+        meta = descriptors.field_meta(descriptor, datetime.datetime.now())
 
         if not document.get("META", False):
             document["META"] = dict(ADDED=datetime.datetime.now())
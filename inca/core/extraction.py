@@ -0,0 +1,289 @@
+"""
+This file provides a declarative, parse-once HTML extraction layer.
+
+Instead of evaluating XPath strings one `tree.xpath` call at a time, scrapers
+can declare the fields they extract as a dictionary of `Field` objects. The
+selectors are compiled once (when the `Extractor` is created, normally at
+class definition) into `lxml.etree.XPath` objects and evaluated against a
+single parsed tree.
+
+Example:
+```
+from inca.core.extraction import Extractor, Field
+
+class myoutlet(rss):
+    extractor = Extractor({
+        "title": Field("//h1/text()", first=True),
+        "text": Field('//div[@class="article"]/p//text()', join=" "),
+        "byline": Field('//*[@class="author"]/text()', '//*[@class="author"]/a/text()', first=True),
+    })
+
+    def parsehtml(self, htmlsource):
+        return self.extractor(htmlsource)
+```
+
+For bulk reparsing of stored `htmlsource`, `parse_many` and `reparse_documents`
+spread the parsing over a pool of worker processes.
+"""
+
+import logging
+import inspect
+from multiprocessing import Pool
+from lxml import etree
+from lxml.html import fromstring
+
+from .basic_utils import batches
+
+try:
+    from lxml.cssselect import CSSSelector
+except ImportError:
+    CSSSelector = None
+
+logger = logging.getLogger("INCA")
+
+BATCHSIZE = 1000  # number of sources handed to the pool at once
+
+
+class Field:
+    """A field to extract from an HTML tree
+
+    Parameters
+    ----
+    *selectors : strings
+        One or more XPath expressions (or CSS selectors if `css=True`). They
+        are tried in order and the first selector that yields a non-empty
+        result is used, mirroring the try/except fallbacks of hand-written
+        `parsehtml` methods.
+    css : bool (default=False)
+        Whether the selectors are CSS selectors (requires `cssselect`)
+    first : bool (default=False)
+        Only return the first result of the selector
+    join : string (default=None)
+        If given, join all results with this string
+    strip : bool (default=True)
+        Strip whitespace from string results
+    default : any (default="")
+        Value to return if none of the selectors match
+    process : callable (default=None)
+        Function applied to the result. Use a module-level function (not a
+        lambda) if the extractor should be usable in a process pool.
+    """
+
+    def __init__(
+        self,
+        *selectors,
+        css=False,
+        first=False,
+        join=None,
+        strip=True,
+        default="",
+        process=None
+    ):
+        self.selectors = selectors
+        self.css = css
+        self.first = first
+        self.join = join
+        self.strip = strip
+        self.default = default
+        self.process = process
+        self.compiled = [self._compile(selector) for selector in selectors]
+
+    def _compile(self, selector):
+        if not self.css:
+            return etree.XPath(selector)
+        if CSSSelector is None:
+            raise ImportError("CSS selectors require the `cssselect` package")
+        return CSSSelector(selector, translator="html")
+
+    def __getstate__(self):
+        # compiled XPath objects cannot be pickled, recompile on unpickling
+        state = self.__dict__.copy()
+        state.pop("compiled")
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.compiled = [self._compile(selector) for selector in self.selectors]
+
+    def evaluate(self, tree):
+        """Returns the value of this field for a parsed tree"""
+        for selector in self.compiled:
+            result = selector(tree)
+            if result:
+                break
+        else:
+            return self.default
+        if type(result) == list:
+            if self.first:
+                result = result[0]
+            elif self.join is not None:
+                result = self.join.join(result)
+        if self.strip and isinstance(result, str):
+            result = result.strip()
+        if self.process:
+            result = self.process(result)
+        return result
+
+
+class Extractor:
+    """Extracts a set of declared fields from HTML sources
+
+    Parameters
+    ----
+    fields : dict
+        A dictionary of `fieldname : Field`. A plain string is interpreted
+        as `Field(string, first=True)`.
+
+    Calling the extractor with an HTML source returns a dictionary with
+    the extracted fields, or an empty dictionary if the source cannot be
+    parsed.
+    """
+
+    def __init__(self, fields):
+        self.fields = {
+            name: field if isinstance(field, Field) else Field(field, first=True)
+            for name, field in fields.items()
+        }
+
+    def parse(self, htmlsource):
+        """Parses an HTML source into a tree, returns None if unparsable"""
+        try:
+            return fromstring(htmlsource)
+        except Exception as e:
+            logger.warning("Could not parse HTML tree: {e}".format(e=e))
+            return None
+
+    def extract(self, tree):
+        """Evaluates all fields against an already parsed tree"""
+        extracted = {}
+        for name, field in self.fields.items():
+            try:
+                extracted[name] = field.evaluate(tree)
+            except Exception as e:
+                logger.debug("Could not parse {name}: {e}".format(name=name, e=e))
+                extracted[name] = field.default
+        return extracted
+
+    def __call__(self, htmlsource):
+        tree = self.parse(htmlsource)
+        if tree is None:
+            return {}
+        return self.extract(tree)
+
+
+def _call_parser(parse_function, htmlsource):
+    """Calls an extractor, a bound method or a scraper's `parsehtml`
+
+    Unbound `parsehtml` methods taken from a scraper class (such as
+    `news_scraper.nu.parsehtml`) are called with `None` as `self`, as done
+    by `database.reparse`.
+    """
+    qualname = getattr(parse_function, "__qualname__", "")
+    if (
+        inspect.isfunction(parse_function)
+        and "." in qualname
+        and "<locals>" not in qualname
+    ):
+        return parse_function(None, htmlsource)
+    return parse_function(htmlsource)
+
+
+class _Parser:
+    """Picklable callable to run a parse function in a worker process"""
+
+    def __init__(self, parse_function):
+        self.parse_function = parse_function
+
+    def __call__(self, htmlsource):
+        try:
+            return _call_parser(self.parse_function, htmlsource)
+        except Exception as e:
+            logger.warning("Failed to parse document: {e}".format(e=e))
+            return None
+
+
+def _htmlsource(document):
+    return document["_source"]["htmlsource"]
+
+
+def _parse_batches(parse_function, batches, processes=None, chunksize=20, key=None):
+    """Yields (batch, parsed results) tuples, using one pool for all batches
+
+    If `key` is given, it is used to get the HTML source of each item.
+    """
+    parser = _Parser(parse_function)
+    if processes == 1:
+        for batch in batches:
+            sources = map(key, batch) if key else batch
+            yield batch, [parser(htmlsource) for htmlsource in sources]
+        return
+    with Pool(processes) as pool:
+        for batch in batches:
+            sources = list(map(key, batch)) if key else batch
+            yield batch, pool.map(parser, sources, chunksize=chunksize)
+
+
+def parse_many(parse_function, htmlsources, processes=None, chunksize=20):
+    """Parses many HTML sources in a pool of worker processes
+
+    Parameters
+    ----
+    parse_function : callable
+        An `Extractor`, a function taking the HTML source or an unbound
+        scraper method such as `news_scraper.nu.parsehtml`
+    htmlsources : iterable
+        The HTML sources to parse, can be a generator
+    processes : int (default=None)
+        Number of worker processes, defaults to the number of CPUs. Set to
+        1 to parse in the current process.
+    chunksize : int (default=20)
+        Number of sources sent to a worker at once
+
+    Yields
+    ----
+    dict or None
+        The parsed fields per source, in input order. None if parsing raised
+        an exception.
+    """
+    # Feed the pool batch-wise, so generators are not consumed at once
+    for batch, results in _parse_batches(
+        parse_function,
+        batches(htmlsources, BATCHSIZE),
+        processes=processes,
+        chunksize=chunksize,
+    ):
+        for parsed in results:
+            yield parsed
+
+
+def reparse_documents(documents, parse_function, processes=None, chunksize=20):
+    """Parses the `htmlsource` of stored documents in a pool of workers
+
+    Parameters
+    ----
+    documents : iterable
+        Elasticsearch documents, for instance from `document_generator`
+    parse_function : callable
+        See `parse_many`
+    processes : int (default=None)
+        Number of worker processes, defaults to the number of CPUs
+    chunksize : int (default=20)
+        Number of documents sent to a worker at once
+
+    Yields
+    ----
+    tuple
+        (document, parsed) for every document with an `htmlsource`.
+    """
+    with_source = (
+        doc for doc in documents if doc.get("_source", {}).get("htmlsource")
+    )
+    for docs, results in _parse_batches(
+        parse_function,
+        batches(with_source, BATCHSIZE),
+        processes=processes,
+        chunksize=chunksize,
+        key=_htmlsource,
+    ):
+        for doc, parsed in zip(docs, results):
+            yield doc, parsed
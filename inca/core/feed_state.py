@@ -0,0 +1,153 @@
+"""
+This file provides a persistent, per-feed state store for RSS scrapers.
+
+For every feed URL the store remembers the HTTP validators (ETag and
+Last-Modified), a hash of the last feed body and the ids of recently seen
+entries. Scrapers use it to skip feeds that did not change since the last
+run and to limit database lookups to entries that were not seen before.
+
+States are stored as small JSON files, one per feed, in the directory
+configured as `feedstate_dir` in the `[rss]` section of settings.cfg.
+"""
+
+import os
+import json
+import logging
+import datetime
+from hashlib import md5
+from collections import OrderedDict
+
+from .database import config
+from .filenames import id2filename
+
+logger = logging.getLogger("INCA")
+
+FEEDSTATE_DIR = os.path.expanduser(
+    config.get("rss", "feedstate_dir", fallback="~/.inca/feedstate")
+)
+MAX_SEEN = 2000  # number of entry ids remembered per feed
+
+
+class FeedState:
+    """State of a single feed between scraper runs
+
+    Parameters
+    ----
+    feedurl : string
+        The URL of the feed, used as key of the state
+    statedir : string (default=FEEDSTATE_DIR)
+        Directory in which states are stored
+    max_seen : int (default=MAX_SEEN)
+        The number of most recently seen entry ids to remember. Should
+        comfortably exceed the number of entries in the feed.
+    """
+
+    def __init__(self, feedurl, statedir=FEEDSTATE_DIR, max_seen=MAX_SEEN):
+        self.feedurl = feedurl
+        self.statedir = statedir
+        self.max_seen = max_seen
+        self.etag = None
+        self.modified = None
+        self.content_hash = None
+        self.last_checked = None
+        self.seen = OrderedDict()
+        self.load()
+
+    @property
+    def filename(self):
+        return os.path.join(self.statedir, id2filename(self.feedurl) + ".json")
+
+    def load(self):
+        """Loads the stored state of the feed, if any"""
+        if not os.path.exists(self.filename):
+            return self
+        try:
+            with open(self.filename) as f:
+                stored = json.load(f)
+        except Exception as e:
+            logger.warning(
+                "Unable to read feed state for {self.feedurl}: {e}".format(**locals())
+            )
+            return self
+        self.etag = stored.get("etag")
+        self.modified = stored.get("modified")
+        self.content_hash = stored.get("content_hash")
+        self.last_checked = stored.get("last_checked")
+        self.seen = OrderedDict((_id, True) for _id in stored.get("seen", []))
+        return self
+
+    def save(self):
+        """Writes the state to disk, replacing the previous state atomically"""
+        os.makedirs(self.statedir, exist_ok=True)
+        self.last_checked = datetime.datetime.now().isoformat()
+        state = dict(
+            feedurl=self.feedurl,
+            etag=self.etag,
+            modified=self.modified,
+            content_hash=self.content_hash,
+            last_checked=self.last_checked,
+            seen=list(self.seen.keys()),
+        )
+        tmpname = self.filename + ".tmp"
+        with open(tmpname, "w") as f:
+            json.dump(state, f)
+        os.replace(tmpname, self.filename)
+
+    def request_headers(self):
+        """Returns the headers for a conditional GET of the feed"""
+        headers = {}
+        if self.etag:
+            headers["If-None-Match"] = self.etag
+        if self.modified:
+            headers["If-Modified-Since"] = self.modified
+        return headers
+
+    def update_validators(self, response_headers):
+        """Stores the ETag and Last-Modified headers of a feed response"""
+        self.etag = response_headers.get("ETag", self.etag)
+        self.modified = response_headers.get("Last-Modified", self.modified)
+
+    def body_changed(self, body):
+        """Checks whether the feed body differs from the previous run and
+        remembers the hash of the new body.
+
+        Parameters
+        ----
+        body : string or bytes
+            The body of the feed as retrieved
+
+        Returns
+        ----
+        bool
+            False if the body is identical to the previous run
+        """
+        if type(body) == str:
+            body = body.encode("utf-8")
+        body_hash = md5(body).hexdigest()
+        if body_hash == self.content_hash:
+            return False
+        self.content_hash = body_hash
+        return True
+
+    def unseen(self, ids):
+        """Returns the ids that were not seen in previous runs, in input order"""
+        return [_id for _id in ids if _id not in self.seen]
+
+    def mark_seen(self, ids):
+        """Remembers ids as seen, forgetting the oldest beyond `max_seen`"""
+        if type(ids) == str:
+            ids = [ids]
+        for _id in ids:
+            self.seen.pop(_id, None)
+            self.seen[_id] = True
+        while len(self.seen) > self.max_seen:
+            self.seen.popitem(last=False)
+
+    def reset(self):
+        """Forgets everything known about the feed"""
+        self.etag = None
+        self.modified = None
+        self.content_hash = None
+        self.seen = OrderedDict()
+        if os.path.exists(self.filename):
+            os.remove(self.filename)
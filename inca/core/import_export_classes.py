@@ -6,6 +6,8 @@ from .document_class import Document
 from collections import Counter
 from .search_utils import document_generator
 from .filenames import id2filename
+from .blobstore import resolve_document
+from .basic_utils import flatten
 import zipfile
 import gzip
 import tarfile
@@ -13,6 +15,11 @@ import bz2
 import os
 import re
 
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
 logger = logging.getLogger("INCA:" + __name__)
 
 
@@ -30,7 +37,7 @@ class BaseImportExport(Document):
 
     def _detect_zip(self, path):
         filename = os.path.basename(path)
-        for zip_ext in ["gz", "bz2"]:
+        for zip_ext in ["gz", "bz2", "zst"]:
             if filename[-len(zip_ext) :] == zip_ext:
                 return zip_ext
         return False
@@ -44,13 +51,17 @@ class BaseImportExport(Document):
             compression = self._detect_zip(filename)
         if not compression:
             return open(filename, mode=mode)
-        else:
+        elif not filename.endswith("." + compression):
             filename += "." + compression
 
         if compression == "gz":
             return gzip.open(filename, mode=mode)
         if compression == "bz2":
             return bz2.open(filename, mode=mode)
+        if compression == "zst":
+            if zstandard is None:
+                raise ImportError("zstandard is required for {}".format(filename))
+            return zstandard.open(filename, mode=mode)
         return fileobj
 
     def open_dir(
@@ -244,30 +255,17 @@ class Exporter(BaseImportExport):
             merged by '.'
 
         """
-        flat_dict = {}
-        for k, v in document.items():
-            if k == "META" and not include_meta:
-                continue
-            if k == "htmlsource" and not include_html:
-                continue
-            if type(v) == str:
-                flat_dict[k] = v
-            elif type(v) == list:
-                flat_dict[k] = str(v)
-            elif type(v) == dict:
-                for kk, vv in self._flatten_doc(v).items():
-                    flat_dict["{k}.{kk}".format(k=k, kk=kk)] = vv
-            else:
-                try:
-                    flat_dict[k] = str(v)
-                except:
-                    logger.warning("Unable to ready field {k} for writing".format(k=k))
-        return flat_dict
+        skip = [
+            key
+            for key, include in (("META", include_meta), ("htmlsource", include_html))
+            if not include
+        ]
+        return flatten(document, skip=skip, skip_nested=("META", "htmlsource"))
 
     def _retrieve(self, query):
         for doc in document_generator(query):
             self.processed += 1
-            yield doc
+            yield resolve_document(doc)
 
     def _makefile(self, filename, mode="wt", force=False, compression=False):
         filepath = os.path.dirname(filename)
@@ -342,3 +340,4 @@ class Exporter(BaseImportExport):
             self.save(docbatch, destination=destination, *args, **kwargs)
         if self.fileobj:
             self.fileobj.close()
+            self.fileobj = None
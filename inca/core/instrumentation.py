@@ -0,0 +1,263 @@
+"""
+This file provides counters and latency histograms for INCA jobs.
+
+Core functions record how often they are called, how many documents they
+handle and how long they take:
+
+- `inca_database_seconds{function}`: database round trips by function
+- `inca_documents_total{functiontype, task}`: documents saved by scrapers,
+  clients and importers, and documents processed by processors
+- `inca_process_seconds{task}`: latency of `process()` per processor
+- `inca_http_fetch_seconds{task}`: HTTP fetch latency in scrapers
+- `inca_elasticsearch_*{operation}`: requests made by the elasticsearch
+  client, including retries (see core.connection)
+
+Recording a value takes a dictionary update under a lock, so the
+instrumentation is always on. Metrics are exposed in the Prometheus text
+format, either by an HTTP endpoint or in files written periodically, or
+as JSON:
+
+```
+from inca.core import instrumentation
+instrumentation.start_http_server(9100)   # http://localhost:9100/metrics
+instrumentation.start_dumper("/tmp/inca_metrics.json", interval=60)
+print(instrumentation.render())
+```
+"""
+
+import os
+import json
+import time
+import bisect
+import logging
+import threading
+import functools
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+logger = logging.getLogger("INCA")
+
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+
+class _Histogram:
+    __slots__ = ("counts", "count", "sum")
+
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(BUCKETS, value)] += 1
+        self.count += 1
+        self.sum += value
+
+
+class Registry:
+    """Thread-safe store of counters and histograms, keyed by metric name
+    and labels"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters = {}
+        self._histograms = {}
+        self._collectors = []
+
+    @staticmethod
+    def _key(name, labels):
+        return name, tuple(sorted(labels.items()))
+
+    def increment(self, name, amount=1, **labels):
+        key = self._key(name, labels)
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + amount
+
+    def observe(self, name, value, **labels):
+        key = self._key(name, labels)
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = _Histogram()
+            histogram.observe(value)
+
+    def add_collector(self, collector):
+        """Adds a function returning `(name, labels, value)` counter samples
+        that are collected when metrics are rendered"""
+        self._collectors.append(collector)
+
+    def reset(self):
+        with self._lock:
+            self._counters = {}
+            self._histograms = {}
+
+    def snapshot(self):
+        """Returns all metrics as a JSON-serializable dictionary"""
+        with self._lock:
+            counters = dict(self._counters)
+            histograms = {
+                key: (list(h.counts), h.count, h.sum)
+                for key, h in self._histograms.items()
+            }
+        for collector in self._collectors:
+            try:
+                for name, labels, value in collector():
+                    counters[self._key(name, labels)] = value
+            except Exception as e:
+                logger.debug("Unable to collect metrics: {e}".format(e=e))
+        snapshot = dict(time=time.time(), counters=[], histograms=[])
+        for (name, labels), value in sorted(counters.items()):
+            snapshot["counters"].append(
+                dict(name=name, labels=dict(labels), value=value)
+            )
+        for (name, labels), (counts, count, total) in sorted(histograms.items()):
+            snapshot["histograms"].append(
+                dict(
+                    name=name,
+                    labels=dict(labels),
+                    buckets=dict(zip([str(b) for b in BUCKETS] + ["+Inf"], counts)),
+                    count=count,
+                    sum=total,
+                )
+            )
+        return snapshot
+
+
+registry = Registry()
+increment = registry.increment
+observe = registry.observe
+
+
+@contextmanager
+def timer(name, **labels):
+    """Records the duration of a block in the histogram `name`"""
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        registry.observe(name, time.perf_counter() - started, **labels)
+
+
+def timed(name, **labels):
+    """Decorator recording the duration of each call in the histogram `name`"""
+
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                registry.observe(name, time.perf_counter() - started, **labels)
+
+        return wrapper
+
+    return decorator
+
+
+def observe_response(response, **labels):
+    """Records the latency of a `requests` response as HTTP fetch time"""
+    registry.observe(
+        "inca_http_fetch_seconds", response.elapsed.total_seconds(), **labels
+    )
+    return response
+
+
+def _labels(labels, extra=None):
+    labels = dict(labels, **(extra or {}))
+    if not labels:
+        return ""
+    return "{%s}" % ",".join(
+        '{}="{}"'.format(k, str(v).replace("\\", "\\\\").replace('"', '\\"'))
+        for k, v in sorted(labels.items())
+    )
+
+
+def render(snapshot=None):
+    """Returns the metrics in the Prometheus text exposition format"""
+    snapshot = snapshot or registry.snapshot()
+    lines = []
+    declared = set()
+    for counter in snapshot["counters"]:
+        if counter["name"] not in declared:
+            lines.append("# TYPE {} counter".format(counter["name"]))
+            declared.add(counter["name"])
+        lines.append(
+            "{}{} {}".format(
+                counter["name"], _labels(counter["labels"]), counter["value"]
+            )
+        )
+    for histogram in snapshot["histograms"]:
+        name = histogram["name"]
+        if name not in declared:
+            lines.append("# TYPE {} histogram".format(name))
+            declared.add(name)
+        cumulative = 0
+        for bucket, count in histogram["buckets"].items():
+            cumulative += count
+            lines.append(
+                "{}_bucket{} {}".format(
+                    name, _labels(histogram["labels"], dict(le=bucket)), cumulative
+                )
+            )
+        labels = _labels(histogram["labels"])
+        lines.append("{}_count{} {}".format(name, labels, histogram["count"]))
+        lines.append("{}_sum{} {}".format(name, labels, histogram["sum"]))
+    return "\n".join(lines) + "\n"
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?")[0] == "/metrics.json":
+            body = json.dumps(registry.snapshot()).encode("utf-8")
+            content_type = "application/json"
+        else:
+            body = render().encode("utf-8")
+            content_type = "text/plain; version=0.0.4"
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+def start_http_server(port=9100, host=""):
+    """Serves the metrics at /metrics (Prometheus) and /metrics.json in a
+    background thread, returns the server"""
+    server = HTTPServer((host, port), _MetricsHandler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    logger.info("Serving metrics on port {port}".format(port=server.server_port))
+    return server
+
+
+def dump(filename):
+    """Writes the current metrics to a JSON file, or in the Prometheus text
+    format if the filename does not end with .json"""
+    if filename.endswith(".json"):
+        content = json.dumps(registry.snapshot())
+    else:
+        content = render()
+    tmpname = filename + ".tmp"
+    with open(tmpname, "w") as f:
+        f.write(content)
+    os.replace(tmpname, filename)
+
+
+def start_dumper(filename, interval=60):
+    """Dumps the metrics to `filename` every `interval` seconds in a
+    background thread. Returns an event that stops the dumper when set."""
+    stopped = threading.Event()
+
+    def run():
+        while not stopped.wait(interval):
+            try:
+                dump(filename)
+            except Exception as e:
+                logger.warning("Unable to dump metrics: {e}".format(e=e))
+
+    threading.Thread(target=run, daemon=True).start()
+    return stopped
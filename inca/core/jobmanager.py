@@ -1,18 +1,27 @@
 """
+The jobmanager provides a thin interface to schedule INCA tasks and to
+run them with the scheduler in `core.scheduler`.
 """
 
+from . import taskmanager
+from .scheduler import Scheduler, run_statistics
+
 
 class jobmanager:
-    def __init__(self, client):
+    def __init__(self, client=None, inca=None):
         """
         starts a new jobmanager instance
-        
+
         input
         ---
         client : ElasticSearch()
-            Client object for database access
+            Client object for database access (currently unused)
+        inca : Inca()
+            INCA instance through which jobs are run
         """
         self.client = client
+        self.inca = inca
+        self.scheduler = None
 
     def add_job(
         self,
@@ -26,7 +35,7 @@ class jobmanager:
     ):
         """
         Adds jobs to the the job scheduler
-        
+
         input
         ---
         function: string
@@ -34,7 +43,7 @@ class jobmanager:
         task: string
             INCA task available under function
         timing: string
-            string specifying every hour (hourly), every day (daily) etc
+            interval from taskmanager.TASK_INTERVALS, e.g. '1hour' or '24hour'
         as_batch: Boolean
             True/False value expressing whether the task should call 'batch_do'
             instead of 'do'
@@ -42,22 +51,39 @@ class jobmanager:
             Specification of documents to run the job on. Can be empty (for scrapers) or contain
             either a string (denoting the doctype), list (with documents) or dict (elasticsearch query)
         """
-        # TODO
+        if input_documents is not None:
+            args = (input_documents,) + args
+        if as_batch:
+            kwargs["action"] = "batch"
+        job = dict(
+            name="{function}_{task}_{timing}".format(**locals()),
+            schedule=timing,
+            function=function,
+            task=task,
+            args=args,
+            kwargs=kwargs,
+        )
+        return taskmanager.add_task(job)
 
     def list_jobs(self):
         """Lists all jobs currently pending"""
-        # TODO
+        return taskmanager.get_tasks()
 
     def remove_job(self, job_id):
         """removes a job from the scheduler
-        
+
         input
         ---
         job_id: string
             job_id to remove from database
         """
-        # TODO
+        return taskmanager.remove_task(job_id)
+
+    def job_statistics(self):
+        """Returns the recorded durations and document counts per job"""
+        return run_statistics()
 
-    def run_jobs(self):
+    def run_jobs(self, max_workers=4):
         """Run jobs in scheduler"""
-        # TODO
+        self.scheduler = Scheduler.from_inca(self.inca, max_workers=max_workers)
+        self.scheduler.run_forever()
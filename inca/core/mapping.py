@@ -0,0 +1,249 @@
+"""
+This file provides the mapping manager for the INCA index.
+
+By default, `schema.json` maps every unknown string field to analyzed text
+with an additional `exact` subfield. That is wasteful for fields that are
+never searched (raw HTML, META descriptions) or only filtered and counted
+(identifiers, labels). The mapping manager generates a mapping from
+declarations instead:
+
+- Scrapers and other documents can declare `field_types`, a dictionary of
+  `field : type`, with types from `FIELD_TYPES`.
+- Processors can declare an `output_type` for the fields they add
+  (`<field>_<processor>`).
+
+The resulting mapping can be installed as an index template, used to create
+a new index, and the existing index can be reindexed into it.
+
+Example:
+```
+from inca.core import mapping
+mapping.create_index("inca_v2")
+task = mapping.reindex("inca_v2")
+mapping.reindex_status(task)
+```
+"""
+
+import os
+import json
+import copy
+import logging
+
+from .database import client, elastic_index
+
+logger = logging.getLogger("INCA")
+
+SCHEMA = os.path.join(os.path.dirname(os.path.dirname(__file__)), "schema.json")
+
+FIELD_TYPES = {
+    # analyzed, searchable text
+    "text": {"type": "text"},
+    # values that are filtered on and aggregated, such as labels or outlets
+    "keyword": {"type": "keyword"},
+    # values that are filtered on, but never aggregated or sorted, such as
+    # hashes; `id` is left to schema.json, as documents are sorted on it
+    "identifier": {"type": "keyword", "doc_values": False},
+    "date": {"type": "date"},
+    "number": {"type": "float"},
+    "boolean": {"type": "boolean"},
+    # raw content that is stored, but never searched
+    "payload": {"type": "text", "index": False, "norms": False},
+    # objects that are stored, but not indexed at all
+    "disabled": {"type": "object", "enabled": False},
+}
+
+BASE_FIELD_TYPES = {
+    "doctype": "keyword",
+    "functiontype": "keyword",
+    "url": "identifier",
+    "source": "keyword",
+    "feedurl": "keyword",
+    "publication_date": "date",
+    "htmlsource": "payload",
+    "xml_content": "payload",
+    "htmlsource_blob": "identifier",
+    "xml_content_blob": "identifier",
+}
+
+# Per-field META entries describe the function that added a field. They
+# are only ever read back, so they are not indexed. META.ADDED stays a date,
+# as it is used to sort and filter documents.
+META_TEMPLATE = {
+    "meta_details": {
+        "path_match": "META.*",
+        "match_mapping_type": "object",
+        "mapping": FIELD_TYPES["disabled"],
+    }
+}
+
+
+def load_schema(filename=SCHEMA):
+    """Returns the default index settings and mapping"""
+    with open(filename) as f:
+        return json.load(f)
+
+
+def _field_mapping(fieldtype):
+    if fieldtype not in FIELD_TYPES:
+        raise ValueError(
+            "Unknown field type {fieldtype}, use one of {types}".format(
+                fieldtype=fieldtype, types=", ".join(FIELD_TYPES)
+            )
+        )
+    return copy.deepcopy(FIELD_TYPES[fieldtype])
+
+
+def collect_declarations(tasks):
+    """Collects field declarations from tasks
+
+    Parameters
+    ----
+    tasks : iterable
+        Task instances or classes, for instance `Inca._taskmaster.tasks.values()`
+        after `registry.import_all()`
+
+    Returns
+    ----
+    tuple
+        A dictionary of `field : type` and a dictionary of
+        `processor name : output type`
+    """
+    field_types = {}
+    output_types = {}
+    for task in tasks:
+        for field, fieldtype in (getattr(task, "field_types", None) or {}).items():
+            if field_types.get(field, fieldtype) != fieldtype:
+                logger.warning(
+                    "{field} is declared as {fieldtype} by {task} and as {other} "
+                    "elsewhere, using {other}".format(
+                        field=field,
+                        fieldtype=fieldtype,
+                        task=task.__name__,
+                        other=field_types[field],
+                    )
+                )
+                continue
+            field_types[field] = fieldtype
+        output_type = getattr(task, "output_type", None)
+        if output_type:
+            output_types[task.__name__] = output_type
+    return field_types, output_types
+
+
+def build_mapping(field_types=None, output_types=None, schema=None):
+    """Generates index settings and mappings from declarations
+
+    Parameters
+    ----
+    field_types : dict (default=None)
+        `field : type` declarations, added to `BASE_FIELD_TYPES`
+    output_types : dict (default=None)
+        `processor name : type` declarations for processor output fields
+    schema : dict (default=None)
+        The index body to start from, defaults to `schema.json`
+
+    Returns
+    ----
+    dict
+        An index body with `settings` and `mappings`
+    """
+    body = copy.deepcopy(schema or load_schema())
+    doc = body["mappings"]["doc"]
+    declared = dict(BASE_FIELD_TYPES)
+    declared.update(field_types or {})
+
+    properties = doc.setdefault("properties", {})
+    for field, fieldtype in declared.items():
+        properties[field] = _field_mapping(fieldtype)
+    properties["META"] = {"properties": {"ADDED": {"type": "date"}}}
+
+    templates = [META_TEMPLATE]
+    for processor, fieldtype in sorted((output_types or {}).items()):
+        templates.append(
+            {
+                "processor_" + processor: {
+                    "match": "*_" + processor,
+                    "match_mapping_type": "string",
+                    "mapping": _field_mapping(fieldtype),
+                }
+            }
+        )
+    existing = [
+        template
+        for template in doc.get("dynamic_templates", [])
+        if list(template.keys())[0] not in ["meta_details"]
+    ]
+    doc["dynamic_templates"] = templates + existing
+    return body
+
+
+def declared_mapping(taskmaster):
+    """Builds the mapping from the declarations of all registered tasks"""
+    from . import registry
+
+    registry.import_all()
+    tasks = [
+        task for name, task in taskmaster.tasks.items() if name.startswith("inca.")
+    ]
+    return build_mapping(*collect_declarations(tasks))
+
+
+def put_template(body=None, name="inca"):
+    """Installs a mapping as index template for indices named like the
+    INCA index, so new indices get it automatically"""
+    body = copy.deepcopy(body or build_mapping())
+    body["index_patterns"] = [elastic_index + "*"]
+    return client.indices.put_template(name=name, body=body)
+
+
+def create_index(index, body=None):
+    """Creates a new index with the given (or generated) mapping"""
+    if client.indices.exists(index):
+        raise ValueError("Index {index} already exists".format(index=index))
+    return client.indices.create(index, body=body or build_mapping())
+
+
+def reindex(target_index, source_index=None, slices="auto", query=None):
+    """Copies all documents into another index, for instance one created with
+    an optimized mapping, using a sliced reindex in the background
+
+    Parameters
+    ----
+    target_index : string
+        The index to copy documents to. Create it first with `create_index`.
+    source_index : string (default=None)
+        The index to copy from, defaults to the INCA index
+    slices : int or "auto" (default="auto")
+        The number of parallel slices. "auto" uses one per shard.
+    query : dict (default=None)
+        Optionally, only reindex documents matching this query
+
+    Returns
+    ----
+    string
+        The id of the elasticsearch task, see `reindex_status`
+
+    Note
+    ----
+    After reindexing, point the `document_index` setting to the new index
+    or remove the old index and add its name as alias to the new one.
+    """
+    source = {"index": source_index or elastic_index}
+    if query:
+        source["query"] = query
+    response = client.reindex(
+        body={"source": source, "dest": {"index": target_index}},
+        slices=slices,
+        wait_for_completion=False,
+    )
+    logger.info(
+        "Reindexing {source[index]} to {target_index} as task {task}".format(
+            source=source, target_index=target_index, task=response["task"]
+        )
+    )
+    return response["task"]
+
+
+def reindex_status(task_id):
+    """Returns the progress of a reindex task"""
+    return client.tasks.get(task_id=task_id)
@@ -11,8 +11,20 @@ yields a key:value pair per document, but does not need to return the old docume
 """
 
 import logging
+from importlib import import_module
+from celery import Task, chord
 from .document_class import Document
-from .database import get_document, update_document, check_exists, config
+from .database import (
+    get_document,
+    update_document,
+    check_exists,
+    bulk_update_fields,
+    failed_ids,
+    config,
+)
+from . import blobstore
+from . import instrumentation
+from .basic_utils import batches
 
 # from . import *
 from inca import core
@@ -22,6 +34,12 @@ from collections import OrderedDict
 logger = logging.getLogger("INCA")
 logger.setLevel("DEBUG")
 
+BULKSIZE = 500  # default number of documents per batch
+# default number of slices of a query processed in celery, and of celery
+# tasks running at the same time
+SLICES = config.getint("celery", "slices", fallback=16)
+IN_FLIGHT = config.getint("celery", "in_flight", fallback=8)
+
 
 class Processer(Document):
     """
@@ -34,11 +52,14 @@ class Processer(Document):
     """
 
     functiontype = "processing"
+    output_type = None  # type of the fields this processor adds, see core.mapping
 
     def __init__(self, test=True, async_=True):
         """Override test to save results and return an ID list instead of updated documents"""
         self.test = test
         self.async_ = async_
+        self.failed_ids = []  # documents whose results could not be saved
+        self.batch_counts = {}  # what the last `run_batch` did, see there
 
     def _test_function(self):
         """OVERWRITE THIS METHOD, should yield True (if it works) or False (if it doesn't) """
@@ -48,6 +69,12 @@ class Processer(Document):
         """CHANGE THIS METHOD, should return the changed document"""
         return updated_field
 
+    def process_batch(self, document_fields, *args, **kwargs):
+        """Processes the fields of a batch of documents, returns a list with
+        the result per field. OVERWRITE THIS METHOD if a processor can handle
+        many fields faster at once than one by one (for instance models)."""
+        return [self.process(field, *args, **kwargs) for field in document_fields]
+
     def runwrap(
         self,
         docs_or_query,
@@ -67,10 +94,22 @@ class Processer(Document):
         ---
         docs_or_query:
             either a list of documents, an elasticsearch query or a string specifying the doctype
-        action: on of ['run','delay', 'batch' ]
+        action: on of ['run','delay', 'batch', 'celery_batch']
+            'batch' processes `bulksize` (default 500) documents at once with
+            `process_batch` and saves them with bulk updates
+            'celery_batch' splits the documents in `slices` (default 16) and
+            processes them in the celery cluster, with at most `in_flight`
+            (default 8) tasks at a time, always saving the results. Yields a
+            summary per group of tasks, see `_celery_batch`
 
         """
-        documents = _doctype_query_or_list(docs_or_query, field=field, force=force)
+        documents = _doctype_query_or_list(
+            docs_or_query,
+            field=field,
+            force=force,
+            task=self.__name__,
+            new_key=new_key,
+        )
 
         if action == "run":
             for doc in documents:
@@ -86,34 +125,78 @@ class Processer(Document):
                 for placeholder in self.delay(doc, *args, **kwargs):
                     yield placeholder
         elif action == "batch":
-            for num, batch in enumerate(_batcher(documents, batchsize=bulksize)):
-                core.database.bulk_upsert().run(
-                    documents=[
-                        target_func.run(
-                            document=doc, field=field, force=force, *args, **kwargs
-                        )
-                        for doc in batch
-                    ]
+            bulksize = kwargs.pop("bulksize", BULKSIZE)
+            for num, batch in enumerate(batches(documents, bulksize)):
+                batch = self.run_batch(
+                    batch, field, new_key, save, force, *args, **kwargs
                 )
-                now = datetime.datetime.now()
-                logger.info("processed batch {num} {now}".format(**locals()))
-                yield batch
+                logger.info("processed batch {num}".format(num=num))
+                if not save:
+                    for doc in batch:
+                        yield doc
 
         elif action == "celery_batch":
-            for batch in _batcher(documents, batchsize=bulksize):
-                if not batch:
-                    continue  # ignore empty batches
-                batch_tasks = [
-                    target_func.s(
-                        document=doc, field=field, force=force, *args, **kwargs
-                    )
-                    for doc in batch
-                ]
-                batch_chord = chord(batch_tasks)
-                batch_result = batch_chord(
-                    taskmaster.tasks["core.database.bulk_upsert"].s()
+            for summary in self._celery_batch(
+                docs_or_query, field, new_key, force, args, kwargs
+            ):
+                yield summary
+
+    def _celery_batch(self, docs_or_query, field, new_key, force, args, kwargs):
+        """
+        Processes documents in the celery cluster, see `runwrap`. A query is
+        split in sliced scrolls (on elasticsearch), a list of documents in
+        batches of `bulksize`. Groups of `in_flight` tasks are sent as chords
+        that add up their results; the summary of each group is yielded.
+        """
+        bulksize = kwargs.pop("bulksize", BULKSIZE)
+        slices = kwargs.pop("slices", SLICES)
+        in_flight = kwargs.pop("in_flight", IN_FLIGHT)
+        processor = "{}.{}".format(type(self).__module__, type(self).__name__)
+        common = dict(
+            processor=processor,
+            field=field,
+            new_key=new_key,
+            force=force,
+            bulksize=bulksize,
+            args=args,
+            kwargs=kwargs,
+        )
+        if type(docs_or_query) == list:
+            signatures = [
+                process_slice().s(slice_id=num, documents=batch, **common)
+                for num, batch in enumerate(batches(docs_or_query, bulksize))
+            ]
+        else:
+            query = _query(
+                docs_or_query,
+                force=force,
+                field=field,
+                task=self.__name__,
+                new_key=new_key,
+            )
+            if core.database.backend.name != "elasticsearch":
+                slices = 1  # see database.scroll_query_slice
+            signatures = [
+                process_slice().s(
+                    query=query, slice_id=num, slices=slices, **common
+                )
+                for num in range(slices)
+            ]
+        total = dict(processed=0, skipped=0, failed=0)
+        for start in range(0, len(signatures), in_flight):
+            window = signatures[start : start + in_flight]
+            summary = chord(window)(summarize_slices().s()).get()
+            for key in total:
+                total[key] += summary[key]
+            for error in summary["errors"]:
+                logger.warning("Error in celery worker: {}".format(error))
+            logger.info(
+                "{done} of {n} tasks done: {processed} documents processed, "
+                "{skipped} skipped, {failed} failed".format(
+                    done=start + len(window), n=len(signatures), **total
                 )
-                yield batch
+            )
+            yield summary
 
     def run(
         self, document, field, new_key=None, save=False, force=False, *args, **kwargs
@@ -160,6 +243,8 @@ class Processer(Document):
         if not force and new_key in document["_source"].keys():
             return document
         # 3. return None if key is missing
+        if field in blobstore.PAYLOAD_FIELDS:
+            blobstore.resolve(document["_source"], [field])
         if not field in document["_source"].keys():
             print(document["_source"].keys())
             logger.warning("Key not found in document")
@@ -168,17 +253,24 @@ class Processer(Document):
             return document
         # 4. process document
         # if extra_fields were supplied, then replace the list of field names with a dict containing their values
-        if "extra_fields" in kwargs:
-            extra_fields = OrderedDict()
-            for fieldname in kwargs.pop("extra_fields"):
-                extra_fields[fieldname] = document["_source"].get(fieldname)
-            document["_source"][new_key] = self.process(
-                document["_source"][field], *args, extra_fields=extra_fields, **kwargs
-            )
-        else:
-            document["_source"][new_key] = self.process(
-                document["_source"][field], *args, **kwargs
-            )
+        with instrumentation.timer(
+            "inca_process_seconds", task=self.__class__.__name__
+        ):
+            if "extra_fields" in kwargs:
+                extra_fields = OrderedDict()
+                for fieldname in kwargs.pop("extra_fields"):
+                    extra_fields[fieldname] = document["_source"].get(fieldname)
+                document["_source"][new_key] = self.process(
+                    document["_source"][field],
+                    *args,
+                    extra_fields=extra_fields,
+                    **kwargs
+                )
+            else:
+                document["_source"][new_key] = self.process(
+                    document["_source"][field], *args, **kwargs
+                )
+        self._count_documents(1)
         # 3. add metadata
         # document['_source'] = self._add_metadata(document['_source'])
         # 4. check metadata
@@ -193,8 +285,163 @@ class Processer(Document):
             document = document["_source"]
         return document
 
+    def run_batch(
+        self, documents, field, new_key=None, save=False, force=False, *args, **kwargs
+    ):
+        """
+        Run a processor on a batch of documents with a single call to
+        `process_batch`. See `run` for the input; documents that are not
+        dicts are retrieved from the database. Without `force`, results are
+        saved with partial bulk updates. Documents without an `_id` cannot be
+        saved and are skipped when saving. Returns the list of documents;
+        the ids of documents whose results could not be saved are added to
+        `failed_ids`, and the number of documents `processed`, `skipped`
+        (already processed, or without `field`), `unsaveable` and `failed`
+        is kept in `batch_counts`.
+        """
+        if not new_key:
+            new_key = "%s_%s" % (field, self.__name__)
+        documents = [
+            get_document(doc) if type(doc) != dict else doc for doc in documents
+        ]
+        masked = [not "_source" in doc for doc in documents]
+        documents = [
+            {"_source": doc} if mask else doc for doc, mask in zip(documents, masked)
+        ]
+        todo = [
+            doc
+            for doc in documents
+            if (force or new_key not in doc["_source"])
+            and field in doc["_source"]
+        ]
+        unsaveable = []
+        if save:
+            unsaveable = [doc for doc in todo if "_id" not in doc]
+            if unsaveable:
+                logger.warning(
+                    "Not saving {n} documents without an _id".format(n=len(unsaveable))
+                )
+        failed = []
+        if "extra_fields" in kwargs:
+            # extra fields are passed per document
+            for doc in todo:
+                self.run(
+                    doc, field, new_key, save and "_id" in doc, force, *args, **kwargs
+                )
+        else:
+            if field in blobstore.PAYLOAD_FIELDS:
+                for doc in todo:
+                    blobstore.resolve(doc["_source"], [field])
+            with instrumentation.timer(
+                "inca_process_seconds", task=self.__class__.__name__
+            ):
+                results = self.process_batch(
+                    [doc["_source"][field] for doc in todo], *args, **kwargs
+                )
+            for doc, result in zip(todo, results):
+                doc["_source"][new_key] = result
+            self._count_documents(len(todo))
+            saveable = [doc for doc in todo if "_id" in doc]
+            if save and force:
+                for doc in saveable:
+                    update_document(doc, force=force)
+            elif save:
+                success, errors = bulk_update_fields(
+                    (doc["_id"], {new_key: doc["_source"][new_key]})
+                    for doc in saveable
+                )
+                if errors:
+                    failed = failed_ids(errors)
+                    logger.warning(
+                        "Unable to save {n} results: {ids}".format(
+                            n=len(failed), ids=", ".join(failed)
+                        )
+                    )
+                    self.failed_ids.extend(failed)
+        self.batch_counts = dict(
+            processed=len(todo) - len(unsaveable) - len(failed),
+            skipped=len(documents) - len(todo),
+            unsaveable=len(unsaveable),
+            failed=len(failed),
+        )
+        return [
+            doc["_source"] if mask else doc for doc, mask in zip(documents, masked)
+        ]
+
+
+class process_slice(Task):
+    """Runs a processor in a celery worker on a slice of the documents
+    matching a query, or on a list of documents, saving the results in bulk.
+    Returns the number of documents processed, skipped and failed."""
+
+    def run(
+        self,
+        processor,
+        field,
+        new_key=None,
+        force=False,
+        query=None,
+        slice_id=0,
+        slices=1,
+        documents=None,
+        bulksize=BULKSIZE,
+        args=(),
+        kwargs=None,
+    ):
+        module, classname = processor.rsplit(".", 1)
+        task = getattr(import_module(module), classname)()
+        if documents is None:
+            documents = core.database.scroll_query_slice(query, slice_id, slices)
+        result = dict(slice=slice_id, processed=0, skipped=0, failed=0, errors=[])
+        for batch in batches(documents, bulksize):
+            before = len(task.failed_ids)
+            try:
+                task.run_batch(
+                    batch, field, new_key, True, force, *args, **(kwargs or {})
+                )
+                counts = task.batch_counts
+                result["processed"] += counts["processed"]
+                result["skipped"] += counts["skipped"]
+                result["failed"] += counts["failed"] + counts["unsaveable"]
+                if counts["failed"]:
+                    result["errors"].append(
+                        "Could not save {n} documents: {ids}".format(
+                            n=counts["failed"], ids=", ".join(task.failed_ids[before:])
+                        )
+                    )
+                if counts["unsaveable"]:
+                    result["errors"].append(
+                        "Could not save {n} documents without _id".format(
+                            n=counts["unsaveable"]
+                        )
+                    )
+            except Exception as e:
+                logger.warning(
+                    "Failed to process {n} documents: {e!r}".format(n=len(batch), e=e)
+                )
+                result["failed"] += len(batch)
+                result["errors"].append(repr(e))
+        return result
+
 
-def _doctype_query_or_list(doctype_query_or_list, force=False, field=None, task=None):
+class summarize_slices(Task):
+    """Adds up the results of `process_slice` tasks, used as chord callback"""
+
+    def run(self, results):
+        summary = dict(
+            slices=len(results), processed=0, skipped=0, failed=0, errors=[]
+        )
+        for result in results:
+            summary["processed"] += result["processed"]
+            summary["skipped"] += result["skipped"]
+            summary["failed"] += result["failed"]
+            summary["errors"].extend(result["errors"])
+        return summary
+
+
+def _doctype_query_or_list(
+    doctype_query_or_list, force=False, field=None, task=None, new_key=None
+):
     """
     This function helps other functions dynamically interpret the argument for document selection.
     It allows for either a list of documents, an elasticsearch query, a string-query or a doctype
@@ -215,6 +462,8 @@ def _doctype_query_or_list(doctype_query_or_list, force=False, field=None, task=
     task: string (default=None)
         Function for which the documents are used. Argument is used only to generate the expected outcome
         fieldname, i.e. <field>_<function>
+    new_key: string (default=None)
+        The outcome fieldname, if it is not <field>_<function>
 
     Returns
     -------
@@ -222,78 +471,63 @@ def _doctype_query_or_list(doctype_query_or_list, force=False, field=None, task=
     """
 
     if type(doctype_query_or_list) == list:
-        documents = doctype_query_or_list
-    elif type(doctype_query_or_list) == str:
-        if doctype_query_or_list in core.search_utils.list_doctypes():
+        return doctype_query_or_list
+    return core.database.scroll_query(
+        _query(
+            doctype_query_or_list, force=force, field=field, task=task, new_key=new_key
+        )
+    )
+
+
+def _query(doctype_or_query, force=False, field=None, task=None, new_key=None):
+    """Returns the elasticsearch query for a doctype, query string or query,
+    see `_doctype_query_or_list`"""
+    if not new_key:
+        new_key = "{}_{}".format(field, task)
+    if type(doctype_or_query) == str:
+        if doctype_or_query in core.search_utils.list_doctypes():
             logger.info("assuming documents of given type should be processed")
             if force or not field:
-                documents = core.database.scroll_query(
-                    {"query": {"term": {"doctype": "%s" % doctype_query_or_list}}}
-                )
-            elif not force and field:
-                logger.info(
-                    "force=False, ignoring documents where the result key exists (and has non-NULL value)"
-                )
-                # documents = core.database.scroll_query(
-                #    {'filter':{'and': [
-                #            {'match':{doctypefield:doctype_query_or_list}},
-                #            {'missing':{'field': '%s_%s' %(field, task)}}]
-                #               }})
-                q = {
-                    "query": {
-                        "bool": {
-                            "must_not": {
-                                "exists": {"field": "{}_{}".format(field, task)}
-                            },
-                            "filter": {"term": {"doctype": doctype_query_or_list}},
-                        }
+                return {"query": {"term": {"doctype": "%s" % doctype_or_query}}}
+            logger.info(
+                "force=False, ignoring documents where the result key exists (and has non-NULL value)"
+            )
+            # documents = core.database.scroll_query(
+            #    {'filter':{'and': [
+            #            {'match':{doctypefield:doctype_query_or_list}},
+            #            {'missing':{'field': '%s_%s' %(field, task)}}]
+            #               }})
+            q = {
+                "query": {
+                    "bool": {
+                        "must_not": {"exists": {"field": new_key}},
+                        "filter": {"term": {"doctype": doctype_or_query}},
                     }
                 }
-                logger.debug(q)
-                documents = core.database.scroll_query(q)
-
-        else:
-            logger.info("assuming input is a query_string")
-            if force or not field:
-                documents = core.database.scroll_query(
-                    {"query": {"query_string": {"query": doctype_query_or_list}}}
-                )
-            elif not force and field:
-                logger.info(
-                    "force=False, ignoring documents where the result key exists (and has non-NULL value)"
-                )
-                # documents = core.database.scroll_query({'query':{'and':[
-                #    {'missing':{'field':'%s_%s' %(field, task)}},
-                #    {'query_string':{'query':doctype_query_or_list}}
-                # ]}})
-                documents = core.database.scroll_query(
-                    {
-                        "query": {
-                            "query_string": {
-                                "query": "({}) AND NOT _exists_:{}_{}".format(
-                                    doctype_query_or_list, field, task
-                                )
-                            }
-                        }
-                    }
-                )
+            }
+            logger.debug(q)
+            return q
+
+        logger.info("assuming input is a query_string")
+        if force or not field:
+            return {"query": {"query_string": {"query": doctype_or_query}}}
+        logger.info(
+            "force=False, ignoring documents where the result key exists (and has non-NULL value)"
+        )
+        # documents = core.database.scroll_query({'query':{'and':[
+        #    {'missing':{'field':'%s_%s' %(field, task)}},
+        #    {'query_string':{'query':doctype_query_or_list}}
+        # ]}})
+        return {
+            "query": {
+                "query_string": {
+                    "query": "({}) AND NOT _exists_:{}".format(
+                        doctype_or_query, new_key
+                    )
+                }
+            }
+        }
 
-    else:
-        if not force and field and task and not doctype_query_or_list:
-            field = "%s_%s" % (field, task)
-            doctype_query_or_list.update({"query": {"missing": {"field": field}}})
-        documents = core.database.scroll_query(doctype_query_or_list)
-    return documents
-
-
-def _batcher(stuff, batchsize=10):
-    batch = []
-    for num, thing in enumerate(stuff):
-        batch.append(thing)
-        if (num + 1) % batchsize == 0:
-            logger.debug("processing batch %s" % (num + 1))
-            yield_batch = batch
-            batch = []
-            yield yield_batch
-    if batch:
-        yield batch
+    if not force and field and task and not doctype_or_query:
+        doctype_or_query.update({"query": {"missing": {"field": new_key}}})
+    return doctype_or_query
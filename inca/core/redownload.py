@@ -0,0 +1,256 @@
+"""
+This file provides a resumable engine to re-download the pages of stored
+documents, for instance after a scraper suffered from a new cookie wall.
+
+The URLs of all documents matching a query are retrieved in a scroll and
+fetched concurrently, using the `getlink` and `get_page_body` methods of
+the scraper of the outlet. Requests to each domain are limited by a token
+bucket, and the downloaded pages are stored with bulk partial updates.
+
+Ids of documents that are done are appended to a progress log, so an
+interrupted run can be restarted with the same log and skips them.
+Failed downloads are not logged and are retried on a restart.
+
+Example:
+```
+from inca.core.redownload import redownload
+from inca.rssscrapers.news_scraper import trouw
+
+query = {"query": {"bool": {"filter": [
+    {"term": {"doctype": "trouw (www)"}},
+    {"range": {"publication_date": {"gte": "2015-02-01", "lte": "2015-06-01"}}},
+]}}}
+redownload(query, trouw(), progress_log="trouw_2015.log", rate=0.5)
+```
+"""
+
+import os
+import time
+import logging
+import threading
+from urllib.parse import urlparse
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+from .database import config, sliced_scroll_query, bulk_update_fields, failed_ids
+
+logger = logging.getLogger("INCA")
+
+REDOWNLOAD_DIR = os.path.expanduser(
+    config.get("rss", "redownload_dir", fallback="~/.inca/redownload")
+)
+
+
+class TokenBucket:
+    """Limits the rate of requests, allowing short bursts
+
+    Parameters
+    ----
+    rate : float
+        Number of requests per second
+    burst : int (default=1)
+        Number of requests that can be made at once after a quiet period
+    """
+
+    def __init__(self, rate, burst=1):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """Waits until a request can be made"""
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self.tokens = min(
+                    self.burst, self.tokens + (now - self.updated) * self.rate
+                )
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+class ProgressLog:
+    """Ids of documents that are done, kept in an append-only file
+
+    Parameters
+    ----
+    filename : string
+        The log file. Relative names are placed in the `redownload_dir`
+        configured in the `[rss]` section of settings.cfg.
+    """
+
+    def __init__(self, filename):
+        self.filename = os.path.join(REDOWNLOAD_DIR, os.path.expanduser(filename))
+        self.done = set()
+        if os.path.exists(self.filename):
+            with open(self.filename) as f:
+                self.done = set(line.rstrip("\n") for line in f if line.strip())
+        logger.info(
+            "{n} documents done according to {self.filename}".format(
+                n=len(self.done), self=self
+            )
+        )
+
+    def __contains__(self, document_id):
+        return document_id in self.done
+
+    def add(self, document_ids):
+        """Appends the ids to the log"""
+        document_ids = [str(_id) for _id in document_ids]
+        if not document_ids:
+            return
+        os.makedirs(os.path.dirname(self.filename) or ".", exist_ok=True)
+        with open(self.filename, "a") as f:
+            f.write("".join(_id + "\n" for _id in document_ids))
+        self.done.update(document_ids)
+
+
+class Downloader:
+    """Fetches pages of an outlet like its scraper does, rate limited per
+    domain
+
+    Parameters
+    ----
+    scraper : Scraper
+        The (rss) scraper of the outlet, whose `getlink` and
+        `get_page_body` are used
+    rate : float (default=0.2)
+        Number of requests per second per domain
+    burst : int (default=1)
+        Number of requests per domain that can be made at once
+    """
+
+    def __init__(self, scraper, rate=0.2, burst=1):
+        self.scraper = scraper
+        self.rate = rate
+        self.burst = burst
+        self._buckets = {}
+        self._lock = threading.Lock()
+
+    def _bucket(self, link):
+        domain = urlparse(link).netloc
+        with self._lock:
+            if domain not in self._buckets:
+                self._buckets[domain] = TokenBucket(self.rate, self.burst)
+            return self._buckets[domain]
+
+    def fetch(self, url):
+        """Returns the page of `url`, raising an exception on failure"""
+        from ..scrapers.rss_scraper import rss, set_cookies, REQUEST_TIMEOUT
+
+        link = url
+        if hasattr(self.scraper, "getlink"):
+            link = self.scraper.getlink(url)
+        self._bucket(link).acquire()
+        if type(self.scraper).get_page_body is not rss.get_page_body:
+            return self.scraper.get_page_body(link)
+        # the default page body does not pass cookie walls, so fetch as rss.get
+        request = requests.get(
+            link,
+            headers={"User-Agent": "Wget/1.9"},
+            cookies=set_cookies(link),
+            timeout=REQUEST_TIMEOUT,
+        )
+        request.raise_for_status()
+        return request.text
+
+
+def redownload(
+    query,
+    scraper,
+    progress_log=None,
+    field="url",
+    new_key="url_redownload",
+    rate=0.2,
+    burst=1,
+    max_workers=8,
+    bulk_size=100,
+):
+    """Re-downloads the pages of all documents matching a query
+
+    Parameters
+    ----
+    query : dict
+        An elasticsearch query for the documents to re-download
+    scraper : Scraper
+        The scraper of the outlet, see `Downloader`
+    progress_log : string (default=None)
+        File to keep the ids of documents that are done in. Restarting with
+        the same file skips them. Without a file, nothing is skipped.
+    field : string (default='url')
+        The field with the URL of a document
+    new_key : string (default='url_redownload')
+        The field in which the page is stored, as the `redownload`
+        processor does
+    rate : float (default=0.2)
+        Number of requests per second per domain
+    burst : int (default=1)
+        Number of requests per domain that can be made at once
+    max_workers : int (default=8)
+        Number of pages downloaded at the same time
+    bulk_size : int (default=100)
+        Number of pages stored per bulk request
+
+    Returns
+    ----
+    dict
+        The number of documents `downloaded`, `failed` and `skipped`
+    """
+    log = ProgressLog(progress_log) if progress_log else None
+    downloader = Downloader(scraper, rate=rate, burst=burst)
+    counts = dict(downloaded=0, failed=0, skipped=0)
+
+    def download(item):
+        document_id, url = item
+        try:
+            return document_id, downloader.fetch(url)
+        except Exception as e:
+            logger.warning(
+                "Could not download {url} ({document_id}): {e!r}".format(**locals())
+            )
+            return document_id, None
+
+    def store(results):
+        updates = [(_id, {new_key: page}) for _id, page in results if page]
+        counts["failed"] += len(results) - len(updates)
+        if not updates:
+            return
+        success, errors = bulk_update_fields(updates, chunk_size=bulk_size)
+        failed = set(failed_ids(errors))
+        if errors:
+            logger.warning("{n} pages could not be stored".format(n=len(errors)))
+        done = [_id for _id, fields in updates if str(_id) not in failed]
+        counts["downloaded"] += len(done)
+        counts["failed"] += len(updates) - len(done)
+        if log is not None:
+            log.add(done)
+
+    def items():
+        for doc in sliced_scroll_query(query, source=[field]):
+            url = doc["_source"].get(field)
+            if (log is not None and str(doc["_id"]) in log) or not url:
+                counts["skipped"] += 1
+                continue
+            yield doc["_id"], url
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        batch = []
+        for item in items():
+            batch.append(item)
+            if len(batch) == bulk_size:
+                store(list(executor.map(download, batch)))
+                batch = []
+        if batch:
+            store(list(executor.map(download, batch)))
+    logger.info(
+        "Re-downloaded {downloaded} documents, {failed} failed, "
+        "{skipped} skipped".format(**counts)
+    )
+    return counts
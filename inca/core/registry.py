@@ -0,0 +1,165 @@
+"""
+This file provides a lazy registry of INCA tasks.
+
+Importing every scraper, processor, client, analysis and importer module
+pulls in heavy dependencies (spaCy models, gensim, sklearn, ...) that a
+single task rarely needs. The registry describes all tasks in a manifest
+(task names, modules and docstrings) that is cached on disk. The `Inca`
+class builds its endpoints from this manifest and a task's module is only
+imported when the task is first called.
+
+The manifest is rebuilt, importing all modules once, whenever a module is
+added, removed or changed.
+"""
+
+import os
+import json
+import logging
+from importlib import import_module
+
+from .database import config
+
+logger = logging.getLogger("INCA")
+
+INCADIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+MANIFEST = os.path.expanduser(
+    config.get("inca", "manifest", fallback="~/.inca/task_manifest.json")
+)
+
+FUNCTIONS = [
+    "scrapers",
+    "rssscrapers",
+    "processing",
+    "clients",
+    "analysis",
+    "importers_exporters",
+]
+
+CLIENT_METHODS = [
+    ("create_app", "add_application"),
+    ("remove_app", "remove_application"),
+    ("create_credentials", "add_credentials"),
+]
+
+
+def import_all(functions=FUNCTIONS):
+    """Imports all task modules, registering their tasks with celery"""
+    for function in functions:
+        import_module("inca." + function).import_all()
+
+
+def source_signature(functions=FUNCTIONS):
+    """Returns the modification times of all task modules"""
+    signature = {}
+    for function in functions:
+        package = import_module("inca." + function)
+        for filename in package.__all__:
+            path = os.path.join(INCADIR, function, filename)
+            signature[function + "/" + filename] = os.path.getmtime(path)
+    return signature
+
+
+def _docstring(function, task):
+    """The docstring shown for a task endpoint"""
+    if function in ["scrapers", "rssscrapers"]:
+        return task.get.__doc__
+    if function == "processing":
+        return task.process.__doc__
+    if function == "importers_exporters":
+        if hasattr(task, "load"):
+            return task.load.__doc__
+        return task.save.__doc__
+    return task.__doc__
+
+
+def build_manifest(taskmaster, functions=FUNCTIONS):
+    """Imports all task modules and describes their tasks
+
+    Parameters
+    ----
+    taskmaster : Celery
+        The celery app with which tasks are registered
+
+    Returns
+    ----
+    list
+        A dictionary per task with its registered name, function type,
+        task name, module, class name and docstring
+    """
+    import_all(functions)
+    manifest = []
+    for name, task in taskmaster.tasks.items():
+        parts = name.split(".")
+        if len(parts) < 3 or parts[1] not in functions:
+            continue
+        entry = dict(
+            name=name,
+            function=parts[1],
+            taskname=parts[-1],
+            module=task.__module__,
+            classname=task.__name__,
+            doc=_docstring(parts[1], task),
+            classdoc=task.__doc__,
+        )
+        if hasattr(task, "service_name") and task.__name__ == task.service_name:
+            entry["service_name"] = task.service_name
+        manifest.append(entry)
+    return manifest
+
+
+def load_manifest(taskmaster, filename=MANIFEST, rebuild=False):
+    """Returns the cached manifest, rebuilding it if modules changed
+
+    Parameters
+    ----
+    taskmaster : Celery
+        The celery app with which tasks are registered
+    filename : string
+        Location of the cached manifest
+    rebuild : bool (default=False)
+        Rebuild the manifest even if the cache is up to date
+    """
+    signature = source_signature()
+    if not rebuild and os.path.exists(filename):
+        try:
+            with open(filename) as f:
+                cached = json.load(f)
+            if cached.get("signature") == signature:
+                return cached["tasks"]
+        except Exception as e:
+            logger.warning("Unable to read task manifest: {e}".format(e=e))
+    logger.info("Building task manifest, this imports all modules once")
+    tasks = build_manifest(taskmaster)
+    try:
+        os.makedirs(os.path.dirname(filename), exist_ok=True)
+        tmpname = filename + ".tmp"
+        with open(tmpname, "w") as f:
+            json.dump(dict(signature=signature, tasks=tasks), f)
+        os.replace(tmpname, filename)
+    except OSError as e:
+        logger.warning("Unable to cache task manifest: {e}".format(e=e))
+    return tasks
+
+
+def load_task(taskmaster, entry, prompt=None):
+    """Imports the module of a task and returns the registered task"""
+    if entry["name"] not in taskmaster.tasks:
+        logger.debug("importing {module}".format(**entry))
+        import_module(entry["module"])
+    task = taskmaster.tasks[entry["name"]]
+    if prompt is not None:
+        task.prompt = prompt
+    return task
+
+
+def lazy_method(taskmaster, entry, method, prompt=None):
+    """Returns a function that calls `method` of a task, importing the
+    task's module on the first call"""
+
+    def endpoint(*args, **kwargs):
+        task = load_task(taskmaster, entry, prompt)
+        return getattr(task, method)(*args, **kwargs)
+
+    endpoint.__name__ = entry["classname"]
+    return endpoint
@@ -0,0 +1,364 @@
+"""
+This file provides the scheduler worker that executes scheduled tasks.
+
+Tasks are added with `taskmanager.add_task`. A scheduler keeps an in-memory
+index of these tasks keyed by their next run time and starts them in a pool
+of worker threads when they are due. It caps the number of simultaneous
+runs per task (`max_concurrent` in the task, default 1) and per host (the
+`max_workers` of the scheduler). A run that is still in progress when the
+task is due again is not started a second time; the task simply waits for
+its next interval. This keeps slow sites from piling up runs.
+
+To prevent overlap between scheduler workers on different hosts, runs hold
+one of `max_concurrent` lock files of the task in `lockdir`, which should be
+on a shared filesystem if multiple hosts run a scheduler.
+
+Every run is recorded with its duration and the number of documents it
+returned or saved in a run log (JSON lines), summarized by `run_statistics`.
+
+Example:
+```
+from inca import Inca
+from inca.core.scheduler import Scheduler
+
+myinca = Inca()
+Scheduler.from_inca(myinca, max_workers=8).run_forever()
+```
+"""
+
+import os
+import json
+import time
+import heapq
+import socket
+import logging
+import datetime
+import threading
+import types
+from concurrent.futures import ThreadPoolExecutor
+
+from . import taskmanager
+from .database import config
+
+logger = logging.getLogger("INCA")
+
+RUNLOG = os.path.expanduser(
+    config.get("scheduler", "runlog", fallback="~/.inca/scheduler_runs.json")
+)
+LOCKDIR = os.path.expanduser(
+    config.get("scheduler", "lockdir", fallback="~/.inca/scheduler_locks")
+)
+HOSTNAME = socket.gethostname()
+
+
+class ScheduleIndex:
+    """In-memory index of tasks keyed by their next run time"""
+
+    def __init__(self):
+        self._heap = []
+        self._next_run = {}
+
+    def __len__(self):
+        return len(self._next_run)
+
+    def update(self, tasks, now):
+        """Adds new tasks (due immediately) and forgets removed tasks"""
+        for name in list(self._next_run):
+            if name not in tasks:
+                self._next_run.pop(name)
+        for name in tasks:
+            if name not in self._next_run:
+                self.schedule(name, now)
+
+    def schedule(self, name, when):
+        self._next_run[name] = when
+        heapq.heappush(self._heap, (when, name))
+
+    def next_run_time(self):
+        """Returns the earliest next run time, or None if nothing is scheduled"""
+        self._drop_stale()
+        return self._heap[0][0] if self._heap else None
+
+    def pop_due(self, now):
+        """Removes and returns the names of all tasks due at `now`"""
+        due = []
+        self._drop_stale()
+        while self._heap and self._heap[0][0] <= now:
+            when, name = heapq.heappop(self._heap)
+            if self._next_run.get(name) == when:
+                due.append(name)
+            self._drop_stale()
+        return due
+
+    def _drop_stale(self):
+        # entries of removed or rescheduled tasks are left in the heap
+        while self._heap and self._next_run.get(self._heap[0][1]) != self._heap[0][0]:
+            heapq.heappop(self._heap)
+
+
+class RunLog:
+    """Records task runs as JSON lines for capacity planning"""
+
+    def __init__(self, filename=RUNLOG):
+        self.filename = filename
+        self._lock = threading.Lock()
+
+    def record(self, run):
+        with self._lock:
+            directory = os.path.dirname(self.filename)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            with open(self.filename, "a") as f:
+                f.write(json.dumps(run) + "\n")
+
+    def runs(self, task=None):
+        if not os.path.exists(self.filename):
+            return
+        with open(self.filename) as f:
+            for line in f:
+                run = json.loads(line)
+                if task is None or run["task"] == task:
+                    yield run
+
+
+def run_statistics(runlog=None):
+    """Summarizes recorded runs per task
+
+    Returns
+    ----
+    dict
+        `{taskname : summary}` where each summary contains the number of
+        runs and failures, the mean and maximum duration in seconds, the
+        mean number of documents and the start of the last run.
+    """
+    runlog = runlog or RunLog()
+    stats = {}
+    for run in runlog.runs():
+        s = stats.setdefault(
+            run["task"],
+            dict(runs=0, failures=0, total_duration=0.0, max_duration=0.0, documents=0),
+        )
+        s["runs"] += 1
+        s["failures"] += run["status"] != "ok"
+        s["total_duration"] += run["duration"]
+        s["max_duration"] = max(s["max_duration"], run["duration"])
+        s["documents"] += run.get("documents") or 0
+        s["last_run"] = run["started"]
+    for s in stats.values():
+        s["mean_duration"] = s["total_duration"] / s["runs"]
+        s["mean_documents"] = s["documents"] / s["runs"]
+    return stats
+
+
+class _RunLock:
+    """Lock files that limit the runs of a task across hosts to `slots`
+    (the `max_concurrent` of the task), one file per slot"""
+
+    def __init__(self, lockdir, name, stale_after, slots=1):
+        self.lockdir = lockdir
+        self.filenames = [
+            os.path.join(lockdir, "{}.{}.lock".format(name, slot))
+            for slot in range(max(slots, 1))
+        ]
+        self.filename = None  # the file of the acquired slot
+        self.stale_after = stale_after
+
+    def acquire(self):
+        """Takes the first free slot, returns False if all slots are taken"""
+        os.makedirs(self.lockdir, exist_ok=True)
+        for filename in self.filenames:
+            if self._acquire(filename):
+                self.filename = filename
+                return True
+        return False
+
+    def _acquire(self, filename):
+        try:
+            age = time.time() - os.path.getmtime(filename)
+            if age > self.stale_after:
+                logger.warning("Removing stale lock {}".format(filename))
+                os.remove(filename)
+        except OSError:
+            pass
+        try:
+            fd = os.open(filename, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except FileExistsError:
+            return False
+        with os.fdopen(fd, "w") as f:
+            f.write("{}:{}".format(HOSTNAME, os.getpid()))
+        return True
+
+    def release(self):
+        if self.filename is None:
+            return
+        try:
+            os.remove(self.filename)
+        except OSError:
+            pass
+        self.filename = None
+
+
+def _count_documents(result):
+    """Number of documents returned by a task, consuming generators"""
+    if isinstance(result, types.GeneratorType):
+        return sum(1 for _ in result)
+    if type(result) == list:
+        return len(result)
+    if type(result) == int:
+        return result  # scrapers return the number of saved documents
+    return None
+
+
+class Scheduler:
+    """Executes scheduled tasks with concurrency limits
+
+    Parameters
+    ----
+    runner : callable
+        Function that executes a task specification (a dict as stored by
+        `taskmanager.add_task`) and returns its result
+    max_workers : int (default=4)
+        Maximum number of tasks running at the same time on this host
+    runlog : RunLog (default=None)
+        Where to record runs, defaults to the configured run log
+    lockdir : string (default=LOCKDIR)
+        Directory for lock files, set to None to only prevent overlap
+        within this scheduler
+    stale_after : int (default=86400)
+        Seconds after which a lock file is considered stale
+    poll_interval : float (default=1)
+        Maximum number of seconds between checks for due tasks
+    """
+
+    def __init__(
+        self,
+        runner,
+        max_workers=4,
+        runlog=None,
+        lockdir=LOCKDIR,
+        stale_after=86400,
+        poll_interval=1,
+    ):
+        self.runner = runner
+        self.max_workers = max_workers
+        self.runlog = runlog or RunLog()
+        self.lockdir = lockdir
+        self.stale_after = stale_after
+        self.poll_interval = poll_interval
+        self.index = ScheduleIndex()
+        self.tasks = {}
+        self.running = {}
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=max_workers)
+        self._stopped = threading.Event()
+
+    @classmethod
+    def from_inca(cls, inca, **kwargs):
+        """Creates a scheduler that runs tasks through an `Inca` instance"""
+
+        def runner(task):
+            function = getattr(getattr(inca, task["function"]), task["task"])
+            return function(*task.get("args", ()), **task.get("kwargs", {}))
+
+        return cls(runner, **kwargs)
+
+    def refresh(self, now=None):
+        """Synchronizes the schedule index with the task file"""
+        self.tasks = taskmanager.get_tasks()
+        self.index.update(self.tasks, now or time.time())
+
+    def _running_total(self):
+        return sum(self.running.values())
+
+    def tick(self, now=None):
+        """Starts all due tasks that are within the concurrency limits
+
+        Returns
+        ----
+        list
+            names of the tasks that were started
+        """
+        now = now or time.time()
+        self.refresh(now)
+        started = []
+        for name in self.index.pop_due(now):
+            task = self.tasks[name]
+            interval = taskmanager.get_interval(task).total_seconds()
+            with self._lock:
+                host_full = self._running_total() >= self.max_workers
+                task_full = self.running.get(name, 0) >= task.get("max_concurrent", 1)
+            if host_full:
+                # retry as soon as a worker is available
+                self.index.schedule(name, now + self.poll_interval)
+                continue
+            # the next run is planned relative to this one, not to its end
+            self.index.schedule(name, now + interval)
+            if task_full:
+                logger.warning(
+                    "{name} is still running, skipping this run".format(name=name)
+                )
+                continue
+            lock = None
+            if self.lockdir:
+                lock = _RunLock(
+                    self.lockdir,
+                    name,
+                    self.stale_after,
+                    slots=task.get("max_concurrent", 1),
+                )
+                if not lock.acquire():
+                    logger.warning(
+                        "{name} is running on other hosts, skipping".format(name=name)
+                    )
+                    continue
+            with self._lock:
+                self.running[name] = self.running.get(name, 0) + 1
+            self._executor.submit(self._execute, name, task, lock)
+            started.append(name)
+        return started
+
+    def _execute(self, name, task, lock=None):
+        started = time.time()
+        status, documents = "ok", None
+        try:
+            documents = _count_documents(self.runner(task))
+        except Exception as e:
+            status = "failed: {e}".format(e=e)
+            logger.exception("Scheduled task {name} failed".format(name=name))
+        finally:
+            if lock:
+                lock.release()
+            with self._lock:
+                self.running[name] -= 1
+        duration = time.time() - started
+        self.runlog.record(
+            dict(
+                task=name,
+                host=HOSTNAME,
+                started=datetime.datetime.fromtimestamp(started).isoformat(),
+                duration=duration,
+                documents=documents,
+                status=status,
+            )
+        )
+        logger.info(
+            "{name} finished in {duration:.1f}s ({documents} documents)".format(
+                **locals()
+            )
+        )
+
+    def run_forever(self):
+        """Runs due tasks until `stop` is called"""
+        logger.info("Scheduler started on {}".format(HOSTNAME))
+        while not self._stopped.is_set():
+            self.tick()
+            next_run = self.index.next_run_time()
+            wait = self.poll_interval
+            if next_run is not None:
+                wait = min(max(next_run - time.time(), 0), self.poll_interval)
+            self._stopped.wait(wait)
+
+    def stop(self, wait=True):
+        """Stops scheduling new runs, optionally waiting for running tasks"""
+        self._stopped.set()
+        self._executor.shutdown(wait=wait)
@@ -0,0 +1,269 @@
+"""
+This file provides an entry point to run many scrapers at once.
+
+`run_scrapers` runs scrapers in a pool of worker threads, so one slow
+outlet does not delay the others. Scrapers of the same host do not run at
+the same time (or at most `per_host` of them), and a scraper that runs
+longer than `timeout` seconds stops after its current document. All
+documents are saved through one `BulkWriter` in bulk requests shared by
+all scrapers. The state of a feed (see core.feed_state) is only stored
+after the documents of the feed are saved, so entries of a failed bulk
+request are retrieved again in the next run.
+
+For each scraper a result is returned:
+
+- `status`: 'ok', 'timeout' or 'error' (with the `error` message), also
+  when documents of the scraper could not be saved
+- `found`: documents retrieved, `new`: documents saved that did not exist
+- `fetches` and `fetch_seconds`: number and total time of HTTP requests
+- `parse_failures`: fetched pages from which no fields could be parsed
+- `seconds`: duration of the run
+
+Example, running all RSS scrapers (as in scripts/scrapejob_hourly.py):
+```
+from inca.core.scrape_runner import run_all_rssscrapers
+for result in run_all_rssscrapers(max_workers=16):
+    print(result)
+```
+"""
+
+import time
+import inspect
+import logging
+import threading
+from importlib import import_module
+from urllib.parse import urlparse
+from concurrent.futures import ThreadPoolExecutor
+
+from .database import insert_documents
+from . import blobstore
+
+logger = logging.getLogger("INCA")
+
+
+class BulkWriter:
+    """Saves documents of many scrapers in shared bulk requests
+
+    Parameters
+    ----
+    bulk_size : int (default=500)
+        Number of documents per bulk request
+    """
+
+    def __init__(self, bulk_size=500):
+        self.bulk_size = bulk_size
+        self.saved = {}  # scraper name : number of new documents
+        self.errors = {}  # scraper name : error of a failed bulk request
+        self._buffer = []
+        self._lock = threading.Lock()
+
+    def add(self, scraper, document):
+        """Adds a document of a scraper, saving a batch when it is full"""
+        with self._lock:
+            self._buffer.append((scraper, document))
+            if len(self._buffer) < self.bulk_size:
+                return
+            batch, self._buffer = self._buffer, []
+        self._write(batch)
+
+    def flush(self, scraper=None):
+        """Saves the remaining documents, or those of one scraper. Returns
+        whether all documents of the scraper were saved."""
+        with self._lock:
+            if scraper is None:
+                batch, self._buffer = self._buffer, []
+            else:
+                batch = [(s, doc) for s, doc in self._buffer if s is scraper]
+                self._buffer = [(s, doc) for s, doc in self._buffer if s is not scraper]
+        if batch:
+            self._write(batch)
+        return scraper is None or scraper.__class__.__name__ not in self.errors
+
+    def _write(self, batch):
+        with_id = [(s, doc) for s, doc in batch if doc.get("_id")]
+        without_id = [(s, doc) for s, doc in batch if not doc.get("_id")]
+        try:
+            if with_id:
+                # documents that already exist get an `_id` of {}
+                insert_documents(
+                    [doc for s, doc in with_id],
+                    identifiers=[doc["_id"] for s, doc in with_id],
+                )
+            if without_id:
+                insert_documents([doc for s, doc in without_id])
+        except Exception as e:
+            logger.warning(
+                "Unable to save {n} documents: {e!r}".format(n=len(batch), e=e)
+            )
+            with self._lock:
+                for scraper, doc in batch:
+                    self.errors[scraper.__class__.__name__] = repr(e)
+            return
+        new = {}
+        for scraper, doc in batch:
+            if doc.get("_id") != {}:
+                new.setdefault(scraper, []).append(doc)
+        with self._lock:
+            for scraper, docs in new.items():
+                name = scraper.__class__.__name__
+                self.saved[name] = self.saved.get(name, 0) + len(docs)
+        for scraper, docs in new.items():
+            scraper._count_documents(len(docs))
+
+
+def _host(scraper):
+    url = getattr(scraper, "rss_url", None) or ""
+    if type(url) is list:
+        url = url and url[0] or ""
+    return urlparse(url).netloc or scraper.__class__.__name__
+
+
+def _run_scraper(scraper, writer, host_lock, timeout):
+    name = scraper.__class__.__name__
+    result = dict(
+        scraper=name,
+        doctype=getattr(scraper, "doctype", None),
+        status="ok",
+        error=None,
+        found=0,
+        new=0,
+        fetches=0,
+        fetch_seconds=0.0,
+        parse_failures=0,
+        seconds=0.0,
+    )
+    observe_fetch = getattr(scraper, "_observe_fetch", None)
+    parsehtml = getattr(scraper, "parsehtml", None)
+    save_feedstate = getattr(scraper, "_save_feedstate", None)
+
+    def _observe_fetch(response):
+        result["fetches"] += 1
+        result["fetch_seconds"] += response.elapsed.total_seconds()
+        return observe_fetch(response)
+
+    def _parsehtml(htmlsource):
+        parsed = parsehtml(htmlsource)
+        if not parsed:
+            result["parse_failures"] += 1
+        return parsed
+
+    def _save_feedstate(state):
+        # entries are only marked as seen once their documents are saved
+        if writer.flush(scraper):
+            save_feedstate(state)
+        else:
+            logger.warning(
+                "Not saving the state of {feed}, its documents were not saved".format(
+                    feed=state.feedurl
+                )
+            )
+
+    # count fetches and parse failures of this scraper instance
+    if observe_fetch:
+        scraper._observe_fetch = _observe_fetch
+    if parsehtml:
+        scraper.parsehtml = _parsehtml
+    if save_feedstate:
+        scraper._save_feedstate = _save_feedstate
+    with host_lock:
+        started = time.time()
+        try:
+            documents = scraper.get(save=True)
+            for batch in documents:
+                # scrapers can yield single documents or lists of them
+                batch = scraper._add_metadata(batch)
+                for doc in batch if type(batch) == list else [batch]:
+                    blobstore.offload(doc)
+                    scraper._verify(doc)
+                    writer.add(scraper, doc)
+                    result["found"] += 1
+                if time.time() - started > timeout:
+                    result["status"] = "timeout"
+                    documents.close()
+                    break
+        except Exception as e:
+            logger.warning("Error running {name}: {e!r}".format(name=name, e=e))
+            result["status"] = "error"
+            result["error"] = repr(e)
+        finally:
+            scraper.__dict__.pop("_observe_fetch", None)
+            scraper.__dict__.pop("parsehtml", None)
+            scraper.__dict__.pop("_save_feedstate", None)
+        result["seconds"] = time.time() - started
+    return result
+
+
+def run_scrapers(scrapers, max_workers=8, per_host=1, timeout=900, bulk_size=500):
+    """Runs scrapers concurrently and saves their documents
+
+    Parameters
+    ----
+    scrapers : list
+        Scraper classes or instances
+    max_workers : int (default=8)
+        Number of scrapers running at the same time
+    per_host : int (default=1)
+        Number of scrapers of the same host running at the same time
+    timeout : int (default=900)
+        Seconds after which a scraper is stopped. Scrapers are stopped
+        between documents, so requests should have a timeout as well.
+    bulk_size : int (default=500)
+        Number of documents per bulk request
+
+    Returns
+    ----
+    list
+        A result dictionary per scraper, see the description of this file
+    """
+    scrapers = [s() if inspect.isclass(s) else s for s in scrapers]
+    host_locks = {}
+    for scraper in scrapers:
+        host_locks.setdefault(_host(scraper), threading.BoundedSemaphore(per_host))
+    writer = BulkWriter(bulk_size)
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = [
+            executor.submit(
+                _run_scraper, scraper, writer, host_locks[_host(scraper)], timeout
+            )
+            for scraper in scrapers
+        ]
+        results = [future.result() for future in futures]
+    writer.flush()
+    for result in results:
+        result["new"] = writer.saved.get(result["scraper"], 0)
+        if result["scraper"] in writer.errors:
+            result["status"] = "error"
+            result["error"] = result["error"] or writer.errors[result["scraper"]]
+    logger.info(
+        "Ran {n} scrapers: {new} new documents, {failed} failed".format(
+            n=len(results),
+            new=sum(r["new"] for r in results),
+            failed=sum(r["status"] != "ok" for r in results),
+        )
+    )
+    return results
+
+
+def rssscrapers():
+    """Returns the classes of all RSS scrapers"""
+    from .registry import import_all
+    from .. import rssscrapers as package
+    from ..scrapers.rss_scraper import rss
+
+    import_all(["rssscrapers"])
+    classes = []
+    for filename in package.__all__:
+        module = import_module("." + filename[: -len(".py")], package.__name__)
+        for name, value in sorted(vars(module).items()):
+            if (
+                inspect.isclass(value)
+                and issubclass(value, rss)
+                and value.__module__ == module.__name__
+            ):
+                classes.append(value)
+    return classes
+
+
+def run_all_rssscrapers(**kwargs):
+    """Runs all RSS scrapers concurrently, see `run_scrapers`"""
+    return run_scrapers(rssscrapers(), **kwargs)
@@ -22,7 +22,7 @@ language  : If you can safely assume the language of specified documents, please
 """
 import logging
 from .document_class import Document
-from .database import check_exists, client, elastic_index
+from .database import check_exists, backend
 
 logger = logging.getLogger("INCA")
 
@@ -69,26 +69,26 @@ class Scraper(Document):
         DO NOT OVERWRITE THIS METHOD
 
         This is an internal function that calls the 'get' method and saves the
-        resulting documents.
+        resulting documents. When saving, the number of saved documents is
+        returned.
         """
 
         logger.info("Started scraping")
+        saved = 0
         if save == True:
             for doc in self.get(save, *args, **kwargs):
                 if (
                     check_if_url_exists == False
-                    or client.search(
-                        index=elastic_index,
-                        body={"query": {"term": {"url": doc["url"]}}},
-                    )["hits"]["total"]
-                    == 0
+                    or backend.count({"query": {"term": {"url": doc["url"]}}}) == 0
                 ):
                     if type(doc) == dict:
                         doc = self._add_metadata(doc)
                         self._save_document(doc)
+                        saved += 1
                     else:
                         doc = self._add_metadata(doc)
                         self._save_documents(doc)
+                        saved += len(doc)
                 else:
                     logger.info(
                         "A document with this URL already existed - did not save the new one."
@@ -97,6 +97,7 @@ class Scraper(Document):
             return [self._add_metadata(doc) for doc in self.get(save, *args, **kwargs)]
 
         logger.info("Done scraping")
+        return saved
 
     def _test_function(self):
         """tests whether a scraper works by seeing if it returns at least one document
@@ -5,10 +5,12 @@ from .database import client as _client
 from .database import scroll_query as _scroll_query
 from .database import elastic_index as _elastic_index
 from .database import DATABASE_AVAILABLE as _DATABASE_AVAILABLE
+from .database import backend as _backend
 from .database import delete_doctype, delete_document, insert_document, insert_documents
-from .database import deduplicate, reparse
+from .database import deduplicate, reparse, bulk_reparse
 import logging as _logging
-from .basic_utils import dotkeys as _dotkeys
+from .basic_utils import compile_path as _compile_path
+from .basic_utils import extract_columns as _extract_columns
 import _datetime as _datetime
 import json as _json
 from collections import defaultdict
@@ -21,17 +23,7 @@ def list_doctypes():
         _logger.warning("Could not list documents: No database instance available")
         return {"NO DOCUMENTS: DATABASE UNAVAILABLE": 0}
 
-    existing_doctypes = _client.search(
-        _elastic_index,
-        body={
-            "size": 0,
-            "aggs": {"doctypes": {"terms": {"field": "doctype", "size": 1000}}},
-        },
-    )["aggregations"]["doctypes"]["buckets"]
-    overview = {}
-    for item in existing_doctypes:
-        overview[item["key"]] = item["doc_count"]
-    return overview
+    return dict(_backend.terms("doctype", size=1000))
 
 
 def doctype_generator(doctype):
@@ -193,30 +185,86 @@ def doctype_examples(doctype, field=None, seed=42, num=10):
     if not field:
         return docs["hits"]["hits"]
     elif type(field) == str:
-        return [_dotkeys(doc, field) for doc in docs["hits"]["hits"]]
+        get = _compile_path(field)
+        return [get(doc) for doc in docs["hits"]["hits"]]
     else:
-        return [{fi: _dotkeys(doc, fi) for fi in field} for doc in docs["hits"]["hits"]]
+        columns = _extract_columns(docs["hits"]["hits"], field)
+        return [dict(zip(field, values)) for values in zip(*columns)]
 
 
-def doctype_fields(doctype):
-    """
-    returns a summary of fields for documents of `doctype`:
-    field : type - count (coverage)
+_FIELDS_PER_REQUEST = 500
+_stats_cache = {}
 
-    note:
-        As elasticsearch does not natively support an 'all fields' query,
-        this function runs a 1000 document sample and takes the union of
-        found keys as a proxy of fields shared by all documents.
-    """
-    if not _DATABASE_AVAILABLE:
-        _logger.warning(
-            "Could not get document information: No database instance available"
+
+def _doctype_state(doctype):
+    """Returns the number of documents of a doctype and their last META.ADDED,
+    which together identify whether cached statistics are still valid"""
+    response = _client.search(
+        index=_elastic_index,
+        body={
+            "size": 0,
+            "query": {"term": {"doctype": doctype}},
+            "aggs": {
+                "first": {"min": {"field": "META.ADDED"}},
+                "last": {"max": {"field": "META.ADDED"}},
+            },
+        },
+    )
+    aggregations = response.get("aggregations", {})
+    added = lambda agg: aggregations.get(agg, {}).get(
+        "value_as_string", aggregations.get(agg, {}).get("value")
+    )
+    return dict(
+        total=response["hits"]["total"], first=added("first"), last=added("last")
+    )
+
+
+def _field_coverage(doctype, fields, batchsize=_FIELDS_PER_REQUEST):
+    """Counts the documents of a doctype that have each of `fields`, using
+    `filters` aggregations of `batchsize` fields each, sent in a single
+    multi-search request"""
+    fields = list(fields)
+    requests = []
+    for start in range(0, len(fields), batchsize):
+        filters = {
+            field: {"exists": {"field": field}}
+            for field in fields[start : start + batchsize]
+        }
+        requests.append({"index": _elastic_index})
+        requests.append(
+            {
+                "size": 0,
+                "query": {"term": {"doctype": doctype}},
+                "aggs": {"coverage": {"filters": {"filters": filters}}},
+            }
         )
-        return []
+    if not requests:
+        return {}
+    coverage = {}
+    for response in _client.msearch(body=requests)["responses"]:
+        if "error" in response:
+            raise Exception(
+                "Unable to count fields: {error}".format(error=response["error"])
+            )
+        buckets = response["aggregations"]["coverage"]["buckets"]
+        coverage.update(
+            {field: bucket["doc_count"] for field, bucket in buckets.items()}
+        )
+    return coverage
 
-    doc_num = _client.search(
-        index=_elastic_index, body={"query": {"term": {"doctype": doctype}}}
-    )["hits"]["total"]
+
+def _doctype_statistics(doctype, refresh=False):
+    """Returns (cached) statistics of a doctype
+
+    Statistics are recomputed only when documents of the doctype were added
+    or removed since they were cached, or if `refresh` is True. Fields
+    added by processors do not change META.ADDED, so use `refresh` to see
+    them right away.
+    """
+    state = _doctype_state(doctype)
+    cached = _stats_cache.get(doctype)
+    if cached and cached["state"] == state and not refresh:
+        return cached
     mappings = (
         _client.indices.get_mapping(_elastic_index)
         .get(_elastic_index, {})
@@ -224,34 +272,37 @@ def doctype_fields(doctype):
         .get("doc", {})
         .get("properties", {})
     )
-    coverage = {
-        key: _client.search(
-            _elastic_index,
-            body={
-                "query": {
-                    "bool": {
-                        "filter": [
-                            {"exists": {"field": key}},
-                            {"term": {"doctype": doctype}},
-                        ]
-                    }
-                }
-            },
-        )
-        .get("hits", {})
-        .get("total", 0)
-        for key in mappings.keys()
-        if key != "META"
-    }
+    fields = [key for key in mappings.keys() if key != "META"]
+    coverage = state["total"] and _field_coverage(doctype, fields) or {}
     summary = {
         k: {
-            "coverage": coverage.get(k, "unknown") / float(doc_num),
+            "coverage": coverage[k] / float(state["total"]),
             "type": mappings[k].get("type", "unknown"),
         }
-        for k in mappings.keys()
-        if k != "META" and coverage.get(k, "unknown") != 0
+        for k in fields
+        if coverage.get(k, 0) != 0
     }
-    return summary
+    _stats_cache[doctype] = dict(state=state, fields=summary)
+    return _stats_cache[doctype]
+
+
+def doctype_fields(doctype, refresh=False):
+    """
+    returns a summary of fields for documents of `doctype`:
+    field : type - count (coverage)
+
+    note:
+        Coverage is counted for all mapped fields with a few aggregation
+        requests. Results are cached until documents of `doctype` are
+        added or removed, set `refresh` to recompute them.
+    """
+    if not _DATABASE_AVAILABLE:
+        _logger.warning(
+            "Could not get document information: No database instance available"
+        )
+        return []
+
+    return _doctype_statistics(doctype, refresh)["fields"]
 
 
 def missing_field(doctype=None, field="_source", stats_only=True):
@@ -280,13 +331,15 @@ def missing_field(doctype=None, field="_source", stats_only=True):
         return stats
 
 
-def doctype_inspect(doctype):
+def doctype_inspect(doctype, refresh=False):
     """Show some information about documents of a specified type
 
     Parameters
     ----------
     doctype : string
         string specifying the doctype to examine (see list_doctypes for available documents)
+    refresh : bool (default=False)
+        recompute the field coverage even if the cached summary is up to date
 
     Returns
     -------
@@ -309,19 +362,13 @@ def doctype_inspect(doctype):
 
     """
 
-    firstdocs = doctype_first(doctype, by_field="META.ADDED")
-    lastdocs = doctype_last(doctype, by_field="META.ADDED")
+    statistics = _doctype_statistics(doctype, refresh)
 
     summary = dict(
-        total_collected=_client.search(
-            index=_elastic_index, body={"query": {"term": {"doctype": doctype}}}
-        )["hits"]["total"],
-        first_collected=firstdocs
-        and firstdocs[0].get("_source", {}).get("META", {}).get("ADDED", None)
-        or None,
-        last_collected=lastdocs
-        and lastdocs[0].get("_source", {}).get("META", {}).get("ADDED", None),
-        keys=doctype_fields(doctype),
+        total_collected=statistics["state"]["total"],
+        first_collected=statistics["state"]["first"],
+        last_collected=statistics["state"]["last"],
+        keys=statistics["fields"],
     )
 
     return summary
@@ -345,14 +392,25 @@ def list_apps(service_name=None):
 
     """
     res = _client.search(index=".apps", doc_type=service_name, size=10000)
-    get_num_credentials = lambda app: _client.search(
-        index=".credentials", doc_type=app["_type"] + "_" + app["_id"], size=0
-    )["hits"]["total"]
+    registered = [
+        app
+        for app in res["hits"]["hits"]
+        if not service_name or service_name == app["_type"]
+    ]
+    # count the credentials of all apps in a single request
+    requests = []
+    for app in registered:
+        requests.append(
+            {"index": ".credentials", "type": app["_type"] + "_" + app["_id"]}
+        )
+        requests.append({"size": 0})
+    counts = requests and _client.msearch(body=requests)["responses"] or []
     apps = {}
-    for app in res["hits"]["hits"]:
-        if service_name and service_name != app["_type"]:
-            continue
-        app_ob = {"name": app["_id"], "credentials": get_num_credentials(app)}
+    for app, count in zip(registered, counts):
+        app_ob = {
+            "name": app["_id"],
+            "credentials": count.get("hits", {}).get("total", 0),
+        }
         if not apps.get(app["_type"]):
             apps[app["_type"]] = [app_ob]
         else:
@@ -377,6 +435,6 @@ def list_credentials(service_name, app_name):
     ----
     A list of credentials belonging to the application
     """
-    # app_type = service_name + "_" + app_name
-    # credentials = _client.search(index = ".credentials", doc_type=app_type)
-    # return credentials['hits']['hits']
+    app_type = service_name + "_" + app_name
+    credentials = _client.search(index=".credentials", doc_type=app_type, size=10000)
+    return credentials["hits"]["hits"]
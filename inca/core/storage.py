@@ -0,0 +1,615 @@
+"""
+This file provides the storage backends of the INCA database.
+
+A storage backend implements the primitive operations that `core.database`
+needs to store and retrieve documents: inserting (one or in bulk), getting
+(one or many), updating, deleting, scrolling through the results of a query,
+counting and two aggregations (term counts and date histograms).
+
+Two backends are available:
+
+`ElasticsearchBackend`
+    The default, storing documents in the elasticsearch index configured in
+    the `[elasticsearch]` section of settings.cfg.
+
+`SQLiteBackend`
+    An embedded store in a single SQLite file, for running scrapers,
+    processors and exporters without an elasticsearch cluster (for instance
+    on collection machines or in tests). Enable it with `storage = sqlite` in
+    the `[inca]` section and optionally set its location as `path` in a
+    `[sqlite]` section.
+
+The SQLite backend understands a subset of the elasticsearch query DSL:
+`match_all`, `term`, `terms`, `exists`, `missing`, `range`, `match`,
+`query_string` and `bool` queries. Free text in `query_string` queries is
+matched with a full-text index (if SQLite has FTS5); `field:value`,
+`field:[a TO b]` and `_exists_:field` clauses combined with AND are
+matched on the fields themselves.
+"""
+
+import os
+import re
+import json
+import uuid
+import sqlite3
+import logging
+import datetime
+import threading
+from collections import OrderedDict
+
+logger = logging.getLogger("INCA")
+
+TEXT_EXCLUDED = ["META", "htmlsource", "xml_content"]
+DATE_PREFIXES = {"year": 4, "month": 7, "day": 10, "hour": 13, "minute": 16}
+
+
+class StorageBackend:
+    """The operations every storage backend provides
+
+    Documents are returned in the format of elasticsearch results, i.e. as
+    dictionaries with the `_id` and `_source` of the document. Queries are
+    elasticsearch query bodies, such as `{"query": {"term": {"doctype": "nu"}}}`.
+    """
+
+    name = ""
+
+    def insert(self, source, document_id=None):
+        """Stores a document and returns its id"""
+        raise NotImplementedError
+
+    def bulk(self, documents, chunk_size=500):
+        """Stores documents that may contain an `_id` and either a `_source`
+        or the fields themselves. Returns the number of stored documents and
+        a list of errors."""
+        raise NotImplementedError
+
+    def get(self, document_id):
+        """Returns a document, or None if it does not exist"""
+        raise NotImplementedError
+
+    def mget(self, document_ids):
+        """Returns the existing documents of a list of ids"""
+        return [doc for doc in map(self.get, document_ids) if doc is not None]
+
+    def existing(self, document_ids):
+        """Returns the set of ids in a list of ids that are stored"""
+        return {doc["_id"] for doc in self.mget(document_ids)}
+
+    def update(self, document_id, fields):
+        """Adds or replaces fields of a stored document"""
+        raise NotImplementedError
+
+    def bulk_update(self, updates, chunk_size=500):
+        """Applies (document_id, fields) updates. Returns the number of
+        successful updates and a list of errors."""
+        raise NotImplementedError
+
+    def delete(self, document_id):
+        """Deletes a document"""
+        raise NotImplementedError
+
+    def scroll(self, query, size=500, source=None, scroll_time="30m"):
+        """Yields all documents matching a query"""
+        raise NotImplementedError
+
+    def count(self, query=None):
+        """Returns the number of documents matching a query"""
+        raise NotImplementedError
+
+    def terms(self, field, query=None, size=1000):
+        """Returns `{value : count}` of the most frequent values of a field"""
+        raise NotImplementedError
+
+    def date_histogram(self, field, interval="day", query=None):
+        """Returns `{period : count}` of a date field, ordered by period"""
+        raise NotImplementedError
+
+
+class ElasticsearchBackend(StorageBackend):
+    """Stores documents in an elasticsearch index"""
+
+    name = "elasticsearch"
+
+    def __init__(self, client, index):
+        self.client = client
+        self.index = index
+
+    def insert(self, source, document_id=None):
+        kwargs = document_id and dict(id=document_id) or {}
+        response = self.client.index(
+            index=self.index, doc_type="doc", body=source, **kwargs
+        )
+        return response["_id"]
+
+    def bulk(self, documents, chunk_size=500):
+        from elasticsearch import helpers
+
+        def actions():
+            for doc in documents:
+                doc.setdefault("_index", self.index)
+                doc.setdefault("_type", "doc")
+                yield doc
+
+        return helpers.bulk(self.client, actions(), chunk_size=chunk_size)
+
+    def get(self, document_id):
+        from elasticsearch import NotFoundError
+
+        try:
+            return self.client.get(self.index, doc_type="doc", id=document_id)
+        except NotFoundError:
+            return None
+
+    def mget(self, document_ids):
+        response = self.client.mget(
+            index=self.index, doc_type="doc", body={"ids": list(document_ids)}
+        )
+        return [doc for doc in response["docs"] if doc.get("found")]
+
+    def existing(self, document_ids):
+        document_ids = list(document_ids)
+        if not document_ids:
+            return set()
+        response = self.client.mget(
+            index=self.index,
+            doc_type="doc",
+            body={"ids": document_ids},
+            _source=False,
+        )
+        return {doc["_id"] for doc in response["docs"] if doc.get("found")}
+
+    def update(self, document_id, fields):
+        self.client.update(
+            index=self.index, doc_type="doc", id=document_id, body={"doc": fields}
+        )
+
+    def bulk_update(self, updates, chunk_size=500):
+        from elasticsearch import helpers
+
+        actions = (
+            {
+                "_op_type": "update",
+                "_index": self.index,
+                "_type": "doc",
+                "_id": document_id,
+                "doc": fields,
+            }
+            for document_id, fields in updates
+        )
+        return helpers.bulk(
+            self.client, actions, chunk_size=chunk_size, raise_on_error=False
+        )
+
+    def delete(self, document_id):
+        self.client.delete(index=self.index, doc_type="doc", id=document_id)
+
+    def scroll(self, query, size=500, source=None, scroll_time="30m"):
+        from elasticsearch import helpers
+
+        if source is not None:
+            query = dict(query, _source=source)
+        return helpers.scan(
+            self.client, index=self.index, query=query, scroll=scroll_time, size=size
+        )
+
+    def count(self, query=None):
+        body = {"query": (query or {}).get("query", {"match_all": {}})}
+        return self.client.search(index=self.index, body=body, size=0)["hits"][
+            "total"
+        ]
+
+    def _aggregate(self, aggregation, query):
+        body = {
+            "size": 0,
+            "query": (query or {}).get("query", {"match_all": {}}),
+            "aggs": {"result": aggregation},
+        }
+        response = self.client.search(index=self.index, body=body)
+        return response["aggregations"]["result"]["buckets"]
+
+    def terms(self, field, query=None, size=1000):
+        buckets = self._aggregate({"terms": {"field": field, "size": size}}, query)
+        return OrderedDict((b["key"], b["doc_count"]) for b in buckets)
+
+    def date_histogram(self, field, interval="day", query=None):
+        buckets = self._aggregate(
+            {"date_histogram": {"field": field, "interval": interval}}, query
+        )
+        return OrderedDict(
+            (b.get("key_as_string", b["key"]), b["doc_count"]) for b in buckets
+        )
+
+
+def _json_default(value):
+    if isinstance(value, (datetime.datetime, datetime.date)):
+        return value.isoformat()
+    return str(value)
+
+
+def _dumps(source):
+    return json.dumps(source, default=_json_default)
+
+
+def _path(field):
+    return "$." + ".".join('"{}"'.format(part) for part in field.split("."))
+
+
+def _merge(old, new):
+    """Merges `new` into `old` like an elasticsearch partial update"""
+    for key, value in new.items():
+        if type(value) == dict and type(old.get(key)) == dict:
+            _merge(old[key], value)
+        else:
+            old[key] = value
+    return old
+
+
+def _fulltext(source):
+    """The text of a document that is added to the full-text index"""
+    texts = []
+    for key, value in source.items():
+        if key in TEXT_EXCLUDED:
+            continue
+        if type(value) == str:
+            texts.append(value)
+        elif type(value) == list:
+            texts.extend(v for v in value if type(v) == str)
+    return "\n".join(texts)
+
+
+class SQLiteBackend(StorageBackend):
+    """Stores documents in a SQLite database
+
+    Parameters
+    ----
+    path : string
+        Location of the database file, ":memory:" for a temporary store
+    table : string (default="documents")
+        The table in which documents are stored
+    """
+
+    name = "sqlite"
+
+    def __init__(self, path, table="documents"):
+        self.path = path
+        self.table = table
+        if path != ":memory:":
+            path = os.path.expanduser(path)
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self._lock = threading.RLock()
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS {} "
+            "(id TEXT PRIMARY KEY, doctype TEXT, source TEXT)".format(table)
+        )
+        self._connection.execute(
+            "CREATE INDEX IF NOT EXISTS {0}_doctype ON {0} (doctype)".format(table)
+        )
+        try:
+            self._connection.execute(
+                "CREATE VIRTUAL TABLE IF NOT EXISTS {}_fts "
+                "USING fts5(id UNINDEXED, content)".format(table)
+            )
+            self.fulltext = True
+        except sqlite3.OperationalError:
+            logger.info("SQLite has no FTS5, full-text queries will be slow")
+            self.fulltext = False
+        self._connection.commit()
+
+    def _execute(self, sql, params=()):
+        """Runs a statement in which `{table}` is the document table, which
+        is available as `documents` in conditions, and `{fts}` the full-text
+        index"""
+        sql = sql.format(table=self.table + " AS documents", fts=self.table + "_fts")
+        with self._lock:
+            return self._connection.execute(sql, params).fetchall()
+
+    def _store(self, document_id, source):
+        source = json.loads(_dumps(source))
+        self._connection.execute(
+            "INSERT OR REPLACE INTO {} (id, doctype, source) VALUES (?, ?, ?)".format(
+                self.table
+            ),
+            (document_id, source.get("doctype"), json.dumps(source)),
+        )
+        if self.fulltext:
+            self._connection.execute(
+                "DELETE FROM {}_fts WHERE id = ?".format(self.table), (document_id,)
+            )
+            self._connection.execute(
+                "INSERT INTO {}_fts (id, content) VALUES (?, ?)".format(self.table),
+                (document_id, _fulltext(source)),
+            )
+
+    @staticmethod
+    def _document(document_id, source, fields=None):
+        source = json.loads(source)
+        if fields is not None:
+            source = {k: v for k, v in source.items() if k in fields}
+        return {"_id": document_id, "_type": "doc", "_source": source}
+
+    def insert(self, source, document_id=None):
+        document_id = document_id or uuid.uuid4().hex
+        with self._lock:
+            self._store(document_id, source)
+            self._connection.commit()
+        return document_id
+
+    def bulk(self, documents, chunk_size=500):
+        stored, errors = 0, []
+        with self._lock:
+            for doc in documents:
+                doc = dict(doc)
+                document_id = doc.pop("_id", None) or uuid.uuid4().hex
+                source = doc.pop("_source", None)
+                if source is None:
+                    source = {k: v for k, v in doc.items() if not k.startswith("_")}
+                try:
+                    self._store(document_id, source)
+                    stored += 1
+                except Exception as e:
+                    errors.append({"_id": document_id, "error": str(e)})
+            self._connection.commit()
+        return stored, errors
+
+    def get(self, document_id):
+        rows = self._execute(
+            "SELECT id, source FROM {table} WHERE id = ?", (document_id,)
+        )
+        return rows and self._document(*rows[0]) or None
+
+    def mget(self, document_ids):
+        document_ids = list(document_ids)
+        if not document_ids:
+            return []
+        rows = self._execute(
+            "SELECT id, source FROM {{table}} WHERE id IN ({})".format(
+                ",".join("?" * len(document_ids))
+            ),
+            document_ids,
+        )
+        return [self._document(*row) for row in rows]
+
+    def existing(self, document_ids):
+        document_ids = list(document_ids)
+        if not document_ids:
+            return set()
+        rows = self._execute(
+            "SELECT id FROM {{table}} WHERE id IN ({})".format(
+                ",".join("?" * len(document_ids))
+            ),
+            document_ids,
+        )
+        return {row[0] for row in rows}
+
+    def _update(self, document_id, fields):
+        rows = self._connection.execute(
+            "SELECT source FROM {} WHERE id = ?".format(self.table), (document_id,)
+        ).fetchall()
+        if not rows:
+            raise KeyError("Document {} does not exist".format(document_id))
+        self._store(document_id, _merge(json.loads(rows[0][0]), fields))
+
+    def update(self, document_id, fields):
+        with self._lock:
+            self._update(document_id, fields)
+            self._connection.commit()
+
+    def bulk_update(self, updates, chunk_size=500):
+        success, errors = 0, []
+        with self._lock:
+            for document_id, fields in updates:
+                try:
+                    self._update(document_id, fields)
+                    success += 1
+                except Exception as e:
+                    errors.append({"_id": document_id, "error": str(e)})
+            self._connection.commit()
+        return success, errors
+
+    def delete(self, document_id):
+        with self._lock:
+            self._connection.execute(
+                "DELETE FROM {} WHERE id = ?".format(self.table), (document_id,)
+            )
+            if self.fulltext:
+                self._connection.execute(
+                    "DELETE FROM {}_fts WHERE id = ?".format(self.table), (document_id,)
+                )
+            self._connection.commit()
+
+    def scroll(self, query, size=500, source=None, scroll_time=None):
+        where, params = self._where((query or {}).get("query", {"match_all": {}}))
+        last = 0
+        while True:
+            rows = self._execute(
+                "SELECT rowid, id, source FROM {{table}} "
+                "WHERE rowid > ? AND ({}) ORDER BY rowid LIMIT ?".format(where),
+                [last] + params + [size],
+            )
+            for rowid, document_id, document in rows:
+                yield self._document(document_id, document, source)
+            if len(rows) < size:
+                break
+            last = rows[-1][0]
+
+    def count(self, query=None):
+        where, params = self._where((query or {}).get("query", {"match_all": {}}))
+        return self._execute(
+            "SELECT COUNT(*) FROM {{table}} WHERE {}".format(where), params
+        )[0][0]
+
+    def terms(self, field, query=None, size=1000):
+        where, params = self._where((query or {}).get("query", {"match_all": {}}))
+        rows = self._execute(
+            "SELECT value, COUNT(DISTINCT documents.id) AS n "
+            "FROM {{table}}, json_each(documents.source, ?) "
+            "WHERE {} GROUP BY value ORDER BY n DESC LIMIT ?".format(where),
+            [_path(field)] + params + [size],
+        )
+        return OrderedDict(rows)
+
+    def date_histogram(self, field, interval="day", query=None):
+        if interval not in DATE_PREFIXES:
+            raise ValueError(
+                "interval should be one of {}".format(", ".join(DATE_PREFIXES))
+            )
+        where, params = self._where((query or {}).get("query", {"match_all": {}}))
+        rows = self._execute(
+            "SELECT substr(json_extract(source, ?), 1, ?) AS period, COUNT(*) "
+            "FROM {{table}} WHERE period IS NOT NULL AND ({}) "
+            "GROUP BY period ORDER BY period".format(where),
+            [_path(field), DATE_PREFIXES[interval]] + params,
+        )
+        return OrderedDict(rows)
+
+    ######################
+    # Query translation
+    ######################
+
+    def _where(self, query):
+        """Translates an elasticsearch query into a SQL condition"""
+        if not query:
+            return "1", []
+        if len(query) != 1:
+            raise ValueError("Expected a single query type in {}".format(query))
+        (kind, arguments), = query.items()
+        translate = getattr(self, "_where_" + kind, None)
+        if translate is None:
+            raise ValueError(
+                "{} queries are not supported by the {} backend".format(
+                    kind, self.name
+                )
+            )
+        return translate(arguments)
+
+    def _where_match_all(self, arguments):
+        return "1", []
+
+    @staticmethod
+    def _field_value(arguments, key="value"):
+        (field, value), = arguments.items()
+        if type(value) == dict:
+            value = value[key]
+        return field, value
+
+    def _where_term(self, arguments):
+        field, value = self._field_value(arguments)
+        if field == "doctype":
+            return "doctype = ?", [value]
+        return (
+            "EXISTS (SELECT 1 FROM json_each(documents.source, ?) WHERE value = ?)",
+            [_path(field), value],
+        )
+
+    def _where_terms(self, arguments):
+        (field, values), = arguments.items()
+        values = list(values)
+        return (
+            "EXISTS (SELECT 1 FROM json_each(documents.source, ?) "
+            "WHERE value IN ({}))".format(",".join("?" * len(values))),
+            [_path(field)] + values,
+        )
+
+    def _where_exists(self, arguments):
+        return (
+            "COALESCE(json_type(documents.source, ?), 'null') != 'null'",
+            [_path(arguments["field"])],
+        )
+
+    def _where_missing(self, arguments):
+        where, params = self._where_exists(arguments)
+        return "NOT ({})".format(where), params
+
+    def _where_range(self, arguments):
+        (field, bounds), = arguments.items()
+        operators = dict(gt=">", gte=">=", lt="<", lte="<=")
+        conditions, params = [], [_path(field)]
+        for bound, value in bounds.items():
+            if bound in operators:
+                conditions.append("value {} ?".format(operators[bound]))
+                params.append(value)
+        return (
+            "EXISTS (SELECT 1 FROM json_each(documents.source, ?) WHERE {})".format(
+                " AND ".join(conditions) or "1"
+            ),
+            params,
+        )
+
+    def _where_match(self, arguments):
+        field, text = self._field_value(arguments, key="query")
+        words = str(text).split()
+        return (
+            " AND ".join(["json_extract(documents.source, ?) LIKE ?"] * len(words))
+            or "1",
+            [p for word in words for p in (_path(field), "%" + word + "%")],
+        )
+
+    def _where_text(self, text):
+        if self.fulltext:
+            return (
+                "documents.id IN (SELECT id FROM {fts} WHERE {fts} MATCH ?)",
+                [text],
+            )
+        return "documents.source LIKE ?", ["%" + text.strip('"') + "%"]
+
+    def _where_query_string(self, arguments):
+        conditions, params = [], []
+        for part in re.split(r"\s+AND\s+", arguments["query"].strip()):
+            part = part.strip()
+            negate = part.startswith("NOT ")
+            part = part[4:].strip() if negate else part
+            while part.startswith("(") and part.endswith(")"):
+                part = part[1:-1].strip()
+            field_clause = re.match(r"^([\w.]+):(.+)$", part)
+            if field_clause and field_clause.group(1) == "_exists_":
+                where, p = self._where_exists({"field": field_clause.group(2)})
+            elif field_clause:
+                field, value = field_clause.groups()
+                bounds = re.match(r"^\[(\S+) TO (\S+)\]$", value)
+                if bounds:
+                    where, p = self._where_range(
+                        {field: dict(gte=bounds.group(1), lte=bounds.group(2))}
+                    )
+                elif value.startswith('"'):
+                    where, p = self._where_term({field: value.strip('"')})
+                else:
+                    where, p = self._where_match({field: value})
+            elif part in ("*", ""):
+                where, p = "1", []
+            else:
+                where, p = self._where_text(part)
+            conditions.append("NOT ({})".format(where) if negate else where)
+            params.extend(p)
+        return " AND ".join("({})".format(c) for c in conditions), params
+
+    def _where_bool(self, arguments):
+        def clauses(key):
+            value = arguments.get(key, [])
+            return [self._where(q) for q in (value if type(value) == list else [value])]
+
+        conditions, params = [], []
+        for where, p in clauses("must") + clauses("filter"):
+            conditions.append("({})".format(where))
+            params.extend(p)
+        for where, p in clauses("must_not"):
+            conditions.append("NOT ({})".format(where))
+            params.extend(p)
+        should = clauses("should")
+        if should and not conditions:
+            conditions.append(" OR ".join("({})".format(w) for w, p in should))
+            params.extend(p for w, ps in should for p in ps)
+        return " AND ".join(conditions) or "1", params
+
+
+def get_backend(config, client=None, index=None):
+    """Returns the storage backend configured in settings.cfg"""
+    storage = config.get("inca", "storage", fallback="elasticsearch")
+    if storage == "sqlite":
+        path = config.get("sqlite", "path", fallback="~/.inca/documents.sqlite")
+        logger.info("Storing documents in {}".format(path))
+        return SQLiteBackend(path)
+    if storage != "elasticsearch":
+        raise ValueError("Unknown storage backend {}".format(storage))
+    return ElasticsearchBackend(client, index)
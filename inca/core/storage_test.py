@@ -0,0 +1,162 @@
+"""
+TESTS FOR the SQLite storage backend and its translation of elasticsearch queries
+"""
+import pytest
+
+from .storage import SQLiteBackend
+
+documents = [
+    {
+        "_id": "a",
+        "doctype": "nu",
+        "text": "Het kabinet valt",
+        "publication_date": "2019-01-01T10:00:00",
+        "category": ["politiek", "binnenland"],
+        "user": {"screen_name": "Alice"},
+        "score": 3,
+    },
+    {
+        "_id": "b",
+        "doctype": "nu",
+        "text": "Ajax wint weer",
+        "publication_date": "2019-01-02T11:00:00",
+        "category": ["sport"],
+        "score": 5,
+    },
+    {
+        "_id": "c",
+        "doctype": "telegraaf",
+        "text": "Het kabinet blijft",
+        "publication_date": "2019-02-01T12:00:00",
+        "category": ["politiek"],
+        "user": {"screen_name": "Bob"},
+    },
+]
+
+
+@pytest.fixture
+def store():
+    store = SQLiteBackend(":memory:")
+    store.bulk(documents)
+    return store
+
+
+def ids(store, query):
+    return sorted(doc["_id"] for doc in store.scroll({"query": query}))
+
+
+def test_match_all(store):
+    assert ids(store, {"match_all": {}}) == ["a", "b", "c"]
+    assert store.count() == 3
+
+
+def test_term(store):
+    assert ids(store, {"term": {"doctype": "nu"}}) == ["a", "b"]
+    assert ids(store, {"term": {"user.screen_name": "Bob"}}) == ["c"]
+    assert ids(store, {"term": {"category": {"value": "sport"}}}) == ["b"]
+
+
+def test_terms(store):
+    assert ids(store, {"terms": {"category": ["sport", "binnenland"]}}) == ["a", "b"]
+
+
+def test_exists_and_missing(store):
+    assert ids(store, {"exists": {"field": "user.screen_name"}}) == ["a", "c"]
+    assert ids(store, {"missing": {"field": "score"}}) == ["c"]
+
+
+def test_range(store):
+    query = {"range": {"publication_date": {"gte": "2019-01-02", "lt": "2019-02-01"}}}
+    assert ids(store, query) == ["b"]
+    assert ids(store, {"range": {"score": {"gt": 3}}}) == ["b"]
+
+
+def test_match(store):
+    assert ids(store, {"match": {"text": "kabinet"}}) == ["a", "c"]
+    assert ids(store, {"match": {"text": {"query": "kabinet valt"}}}) == ["a"]
+
+
+def test_query_string(store):
+    assert ids(store, {"query_string": {"query": "kabinet"}}) == ["a", "c"]
+    assert ids(store, {"query_string": {"query": "doctype:nu AND kabinet"}}) == [
+        "a"
+    ]
+    assert ids(store, {"query_string": {"query": 'category:"politiek"'}}) == [
+        "a",
+        "c",
+    ]
+    assert ids(
+        store, {"query_string": {"query": "(doctype:nu) AND NOT _exists_:user"}}
+    ) == ["b"]
+    query = "publication_date:[2019-01-01 TO 2019-01-31]"
+    assert ids(store, {"query_string": {"query": query}}) == ["a", "b"]
+
+
+def test_bool(store):
+    query = {
+        "bool": {
+            "filter": [{"term": {"doctype": "nu"}}],
+            "must_not": {"exists": {"field": "user"}},
+        }
+    }
+    assert ids(store, query) == ["b"]
+    query = {
+        "bool": {
+            "should": [
+                {"term": {"doctype": "telegraaf"}},
+                {"range": {"score": {"gte": 5}}},
+            ]
+        }
+    }
+    assert ids(store, query) == ["b", "c"]
+
+
+def test_unsupported_query(store):
+    with pytest.raises(ValueError):
+        ids(store, {"fuzzy": {"text": "kabinet"}})
+
+
+def test_scroll(store):
+    docs = list(store.scroll({"query": {"term": {"doctype": "nu"}}}, size=1))
+    assert [doc["_id"] for doc in docs] == ["a", "b"]
+    docs = list(store.scroll(None, source=["doctype"]))
+    assert [doc["_source"] for doc in docs] == [
+        {"doctype": "nu"},
+        {"doctype": "nu"},
+        {"doctype": "telegraaf"},
+    ]
+
+
+def test_bulk_update(store):
+    success, errors = store.bulk_update(
+        [("a", {"user": {"followers": 10}}), ("b", {"score": 6}), ("x", {"score": 1})]
+    )
+    assert success == 2
+    assert [error["_id"] for error in errors] == ["x"]
+    assert store.get("a")["_source"]["user"] == {
+        "screen_name": "Alice",
+        "followers": 10,
+    }
+    assert store.get("b")["_source"]["score"] == 6
+    assert store.get("x") is None
+
+
+def test_bulk_update_reindexes_text(store):
+    store.bulk_update([("b", {"text": "Het kabinet wint"})])
+    assert ids(store, {"query_string": {"query": "kabinet"}}) == ["a", "b", "c"]
+
+
+def test_terms_aggregation(store):
+    assert store.terms("category") == {"politiek": 2, "binnenland": 1, "sport": 1}
+    assert store.terms("category", size=1) == {"politiek": 2}
+    query = {"query": {"term": {"doctype": "nu"}}}
+    assert store.terms("doctype", query=query) == {"nu": 2}
+
+
+def test_date_histogram(store):
+    assert store.date_histogram("publication_date", interval="month") == {
+        "2019-01": 2,
+        "2019-02": 1,
+    }
+    with pytest.raises(ValueError):
+        store.date_histogram("publication_date", interval="week")
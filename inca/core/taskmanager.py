@@ -2,6 +2,9 @@
 The taskmanager provides task-scheduling and execution functionality. 
 
 CURRENT IMPLEMENTATION IN JSON dump !
+
+The task file is kept in memory and only re-read when it changes on disk.
+Scheduled tasks are executed by the worker in `core.scheduler`.
 """
 
 import json
@@ -18,7 +21,19 @@ config.read("settings.cfg")
 
 taskfile = config.get("celery", "taskfile")
 
-TASK_INTERVALS = ["1sec", "30sec", "1min", "30min", "1hour", "24hour", "week"]
+INTERVALS = {
+    "1sec": timedelta(seconds=1),
+    "30sec": timedelta(seconds=30),
+    "1min": timedelta(minutes=1),
+    "30min": timedelta(minutes=30),
+    "1hour": timedelta(hours=1),
+    "24hour": timedelta(hours=24),
+    "week": timedelta(weeks=1),
+}
+
+TASK_INTERVALS = list(INTERVALS.keys())
+
+_cache = {"mtime": None, "tasks": {}}
 
 
 def verify_task(task):
@@ -37,20 +52,43 @@ def verify_task(task):
     return all_checks_out
 
 
-def get_tasks(interval="all"):
-    if taskfile in os.listdir("."):
+def _load_tasks():
+    """Returns all tasks, re-reading the task file only if it changed"""
+    try:
+        mtime = os.path.getmtime(taskfile)
+    except OSError:
+        _cache.update(mtime=None, tasks={})
+        return _cache["tasks"]
+    if mtime != _cache["mtime"]:
         try:
-            tasks = json.load(open(taskfile))
-            return {
-                taskname: task
-                for taskname, task in tasks.items()
-                if interval == "all" or task.get("schedule", "") == interval
-            }
+            with open(taskfile) as f:
+                tasks = json.load(f)
         except Exception as e:
             logger.warn("could not import tasks, empty file? {e}".format(**locals()))
-            return {}
-    else:
-        return {}
+            tasks = {}
+        _cache.update(mtime=mtime, tasks=tasks)
+    return _cache["tasks"]
+
+
+def _write_tasks(tasks):
+    tmpname = taskfile + ".tmp"
+    with open(tmpname, "w") as f:
+        json.dump(tasks, f)
+    os.replace(tmpname, taskfile)
+    _cache.update(mtime=os.path.getmtime(taskfile), tasks=tasks)
+
+
+def get_tasks(interval="all"):
+    return {
+        taskname: task
+        for taskname, task in _load_tasks().items()
+        if interval == "all" or task.get("schedule", "") == interval
+    }
+
+
+def get_interval(task):
+    """Returns the time between runs of a task as a timedelta"""
+    return INTERVALS[task["schedule"]]
 
 
 def add_task(task):
@@ -67,6 +105,8 @@ def add_task(task):
             task    : required task, e.g. 'proceedings_NL'
             args    : tuple of optional positional arguments
             kwargs  : dict of optional keyword arguments
+            max_concurrent : optional maximum number of simultaneous runs
+                      of this task (default=1, so runs never overlap)
 
     Returns
     -------
@@ -81,7 +121,7 @@ def add_task(task):
         if task["name"] in tasks.keys():
             return "task already exists"
         tasks.update({task["name"]: task})
-        json.dump(tasks, open(taskfile, "w"))
+        _write_tasks(tasks)
     else:
         return "task not scheduled"
     return "task scheduled"
@@ -91,7 +131,7 @@ def remove_task(taskname):
     tasks = get_tasks()
     if taskname in tasks.keys():
         tasks.pop(taskname)
-        json.dump(tasks, open(taskfile, "w"))
+        _write_tasks(tasks)
     else:
         return "task [{taskname}]not found".format(**locals())
     return "task [{taskname}] removed from schedule".format(**locals())
@@ -2,10 +2,8 @@ import os
 import nltk
 from nltk.corpus import stopwords
 from gensim.utils import tokenize
-import configparser
 
-config = configparser.ConfigParser()
-config.read("settings.cfg")
+from ..core.database import config
 
 DEFAULTLANGUAGE = config.get("inca", "default_data_language")
 
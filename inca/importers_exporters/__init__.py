@@ -1,3 +1,9 @@
+"""
+Modules in this package are imported on first access (for instance
+`inca.importers_exporters.<module>`) or all at once with `import_all`, which registers
+their tasks with celery. See `core.registry`.
+"""
+
 import os as _os
 from importlib import import_module
 
@@ -5,11 +11,20 @@ _expected_file_end = ".py"
 
 __all__ = [
     fname
-    for fname in _os.listdir("importers_exporters")
+    for fname in _os.listdir(_os.path.dirname(__file__))
     if fname[-len(_expected_file_end) :] == _expected_file_end
     and not fname.startswith(".")
+    and not fname.startswith("_")
 ]
 
-for module in __all__:
-    # __import__('.'.join(['importers_exporters',module.replace('.py','')]))
-    import_module("." + module.replace(".py", ""), package="inca.importers_exporters")
+
+def import_all():
+    """Imports all modules in this package"""
+    for module in __all__:
+        import_module("." + module.replace(".py", ""), package=__name__)
+
+
+def __getattr__(name):
+    if name + ".py" in __all__:
+        return import_module("." + name, package=__name__)
+    raise AttributeError("module {} has no attribute {}".format(__name__, name))
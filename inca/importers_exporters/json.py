@@ -8,15 +8,53 @@ JSON a nice and easy format for data exchange.
 """
 
 from ..core.import_export_classes import Importer, Exporter, id2filename
+from ..core.database import scroll_query_slice
+from ..core.blobstore import resolve_document
 import os
 import json
 import re
+import time
 import logging
+import datetime
 from glob import glob
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
 logger = logging.getLogger("INCA." + __name__)
 
 
+def _default(value):
+    """Serializes values that are not JSON types, such as datetimes"""
+    if isinstance(value, (datetime.datetime, datetime.date)):
+        return value.isoformat()
+    raise TypeError("{} is not JSON serializable".format(type(value).__name__))
+
+
+def dumps(document):
+    """Returns a document as a line of JSON, in bytes. Uses orjson if it is
+    installed, which is several times faster than the json module."""
+    if orjson is not None:
+        return orjson.dumps(
+            document,
+            default=_default,
+            option=orjson.OPT_APPEND_NEWLINE | orjson.OPT_NON_STR_KEYS,
+        )
+    return (json.dumps(document, default=_default) + "\n").encode("utf-8")
+
+
+def _exported(document, include_meta):
+    """The part of a document that is exported"""
+    if include_meta == False:
+        if "_source" in document.keys():
+            document = document["_source"]
+        document = {k: v for k, v in document.items() if not k == "META"}
+    return document
+
+
 class import_json(Importer):
     """imports json from from file(s)"""
 
@@ -66,9 +104,9 @@ class import_json(Importer):
 
 
 class export_json_file(Exporter):
-    """Dump documents to JSON file"""
+    """Dump documents to JSON file, one document per line"""
 
-    version = 0.1
+    version = 0.2
 
     def save(
         self, batch_of_documents, destination, compression=None, include_meta=False
@@ -82,30 +120,117 @@ class export_json_file(Exporter):
         destination : string
             The file in which to store the output
         compression : string (default=None)
-            What compression to use when writing output file
+            What compression to use when writing output file: 'gz', 'bz2'
+            or 'zst' (requires zstandard)
         include_meta : Boolean (default=False)
             Whether to include META information. If set to False,
             Only the keys within the '_source' key will be saved
             and META will be excluded.
         """
         self.extension = "json"
-        self.fileobj = self._makefile(destination, mode="at", compression=compression)
+        # the file is opened for the first batch and closed by `run`
+        if not self.fileobj:
+            self._makefile(destination, mode="ab", compression=compression)
+            if not self.fileobj:
+                return
         for document in batch_of_documents:
-            if include_meta == False:
-                if "_source" in document.keys():
-                    document = document["_source"]
-                document = {k: v for k, v in document.items() if not k == "META"}
+            document_id = document.get("_id")
             try:
-                doc_dump = json.dumps(document)
-                self.fileobj.write(doc_dump + "\n")
-            except:
+                self.fileobj.write(dumps(_exported(document, include_meta)))
+            except Exception:
                 self.failed += 1
-                self.failed_ids.append(document["_id"])
+                self.failed_ids.append(str(document_id))
         if self.failed:
             logger.warning("Failed to export {num} documents".format(num=self.failed))
             logger.info("Failed ids: {ids}".format(ids=", ".join(self.failed_ids)))
 
 
+class export_json_shards(Exporter):
+    """Dump documents to JSON files, one document per line, writing shards
+    of the documents in parallel"""
+
+    version = 0.1
+
+    def run(
+        self,
+        query="*",
+        destination="exports/",
+        shards=4,
+        compression="gz",
+        include_meta=False,
+    ):
+        """Export documents to `shards` JSON files in parallel
+
+        Unlike other exporters, this exporter does not save batches: each
+        shard is a slice of a sliced scroll (see
+        core.database.scroll_query_slice), written to its own file by its
+        own thread. Only elasticsearch can slice scrolls, with other
+        backends all documents end up in the first shard.
+
+        Parameters
+        ---
+        query : string or dict
+            The query to select elasticsearch records to export
+        destination : string
+            The directory in which to store the shards
+        shards : int (default=4)
+            The number of files to write in parallel. Preferably not more
+            than the number of shards of the index.
+        compression : string (default='gz')
+            What compression to use when writing output files: 'gz', 'bz2',
+            'zst' (requires zstandard) or None
+        include_meta : Boolean (default=False)
+            Whether to include META information. If set to False,
+            Only the keys within the '_source' key will be saved
+            and META will be excluded.
+
+        Returns
+        ---
+        list
+            The filenames of the shards
+        """
+        self.extension = "json"
+        if type(query) == str:
+            query = {"query": {"bool": {"must": {"query_string": {"query": query}}}}}
+        os.makedirs(destination, exist_ok=True)
+        name = time.strftime("INCA_export_%Y_%m_%d_%H_%M_%S")
+        filenames = [
+            os.path.join(destination, "{}_{}_of_{}.json".format(name, num, shards))
+            for num in range(1, shards + 1)
+        ]
+
+        def write_shard(slice_id):
+            processed, failed_ids = 0, []
+            with self.open_file(
+                filenames[slice_id], mode="wb", compression=compression
+            ) as fileobj:
+                for document in scroll_query_slice(query, slice_id, shards):
+                    processed += 1
+                    try:
+                        document = resolve_document(document)
+                        fileobj.write(dumps(_exported(document, include_meta)))
+                    except Exception:
+                        failed_ids.append(str(document.get("_id")))
+            return processed, failed_ids
+
+        with ThreadPoolExecutor(max_workers=shards) as executor:
+            for processed, failed_ids in executor.map(write_shard, range(shards)):
+                self.processed += processed
+                self.failed += len(failed_ids)
+                self.failed_ids.extend(failed_ids)
+        logger.info(
+            "Exported {n} documents to {shards} shards in {destination}".format(
+                n=self.processed, shards=shards, destination=destination
+            )
+        )
+        if self.failed:
+            logger.warning("Failed to export {num} documents".format(num=self.failed))
+            logger.info("Failed ids: {ids}".format(ids=", ".join(self.failed_ids)))
+        if compression:
+            filenames = [f + "." + compression for f in filenames]
+        return filenames
+
+
 class export_json_files(Exporter):
     """Dump documents to JSON files, one-per-document (NOT RECOMMENDED)"""
 
@@ -131,20 +256,17 @@ class export_json_files(Exporter):
         """
         self.extension = "json"
         for document in batch_of_documents:
-            filename = id2filename(document.get("_id"))
+            document_id = document.get("_id")
+            filename = id2filename(document_id)
             location = os.path.join(destination, filename)
-            fileobj = self._makefile(location, mode="wt", compression=compression)
-            if include_meta == False:
-                if "_source" in document.keys():
-                    document = document["_source"]
-                document = {k: v for k, v in document.items() if not k == "META"}
-
+            fileobj = self._makefile(location, mode="wb", compression=compression)
             try:
-                json.dump(document, fileobj)
-            except:
+                fileobj.write(dumps(_exported(document, include_meta)))
+            except Exception:
                 self.failed += 1
-                self.failed_ids.append(document["_id"])
+                self.failed_ids.append(str(document_id))
             fileobj.close()
+        self.fileobj = None  # all files are closed already
         if self.failed:
             logger.warning("Failed to export {num} documents".format(num=self.failed))
             logger.info("Failed ids: {ids}".format(ids=", ".join(self.failed_ids)))
@@ -14,7 +14,7 @@ import logging
 import string
 import shlex
 import json
-import pandas
+from multiprocessing import Pool
 from ..core.database import config
 
 logger = logging.getLogger("INCA")
@@ -446,6 +446,75 @@ SPEACH_VERBS = [
 ANAPHORAS = ["hij", "zij", "hun"]
 
 
+class Sentence:
+    """Tokens and dependencies of one parsed sentence
+
+    Tokens are kept in parallel lists in the order of the parse, with
+    `index` mapping token ids to positions. Dependencies are adjacency
+    lists of `(token id, relation)` pairs, so relations of a token are
+    found without scanning the whole sentence.
+    """
+
+    def __init__(self, alpino_parse):
+        tokens = alpino_parse.get("tokens", [])
+        self.ids = [t["id"] for t in tokens]
+        self.offsets = [t["offset"] for t in tokens]
+        self.words = [t["word"] for t in tokens]
+        self.lemmas = [t["lemma"] for t in tokens]
+        self.pos = [t["pos"] for t in tokens]
+        self.index = {id: position for position, id in enumerate(self.ids)}
+        self.children = {}
+        self.parents = {}
+        self.dependencies = []
+        for dependency in alpino_parse.get("dependencies", []) if tokens else []:
+            child, parent = dependency["child"], dependency["parent"]
+            if child not in self.index or parent not in self.index:
+                continue
+            relation = dependency["relation"]
+            self.dependencies.append((child, relation, parent))
+            self.children.setdefault(parent, []).append((child, relation))
+            self.parents.setdefault(child, []).append((parent, relation))
+
+    def __len__(self):
+        return len(self.ids)
+
+    def word(self, id):
+        return self.words[self.index[id]]
+
+    def lemma(self, id):
+        return self.lemmas[self.index[id]]
+
+    def select(self, lemmas=None, pos=None, exclude=()):
+        """Returns the ids of tokens with one of `lemmas` and part of speech
+        `pos`, in the order of the parse"""
+        return [
+            id
+            for id, lemma, p in zip(self.ids, self.lemmas, self.pos)
+            if (lemmas is None or lemma in lemmas)
+            and (pos is None or p == pos)
+            and id not in exclude
+        ]
+
+    def in_order(self, ids):
+        """Returns the positions of tokens `ids`, sorted by offset"""
+        positions = {self.index[id] for id in ids if id in self.index}
+        return sorted(positions, key=self.offsets.__getitem__)
+
+
+def _id_list(ids):
+    if isinstance(ids, (list, tuple, set)):
+        return list(ids)
+    return [ids]
+
+
+def _matches(value, token_id, token_lemma):
+    if type(value) == bool:
+        return True
+    if type(value) == str:
+        return token_lemma == value
+    return token_id == int(value)
+
+
 class alpino_to_quote(Processer):
     """Takes alpino output and extracts quotes"""
 
@@ -454,13 +523,13 @@ class alpino_to_quote(Processer):
 
         quotes = []
         for num, line in enumerate(alpino_result):
-            mapped, tokens = self.map_parse(line)
+            sentence = self.map_parse(line)
             line_quotes = []
-            line_quotes.extend(self.type_a(mapped, tokens))
-            line_quotes.extend(self.type_b(mapped, tokens))
-            line_quotes.extend(self.type_c(mapped, tokens))
-            line_quotes.extend(self.type_d(mapped, tokens))
-            line_quotes.extend(self.type_e(mapped, tokens))
+            line_quotes.extend(self.type_a(sentence))
+            line_quotes.extend(self.type_b(sentence))
+            line_quotes.extend(self.type_c(sentence))
+            line_quotes.extend(self.type_d(sentence))
+            line_quotes.extend(self.type_e(sentence))
             [q.update({"line": num}) for q in line_quotes]
             if line_quotes:
                 quotes.append(line_quotes[0])
@@ -468,81 +537,42 @@ class alpino_to_quote(Processer):
 
     # map dependency & token list
     def map_parse(self, alpino_parse):
-        if not alpino_parse.get("tokens", []):
-            return pandas.DataFrame(), pandas.DataFrame()
-        tokens = pandas.DataFrame(alpino_parse["tokens"])
-        dependencies = pandas.DataFrame(alpino_parse["dependencies"])
-        mapped = dependencies.merge(
-            tokens[["id", "lemma"]],
-            left_on="child",
-            right_on="id",
-            suffixes=("", "lemma"),
-        )
-        mapped.columns = ["child", "parent", "relation", "child_id", "child_lemma"]
-        mapped = mapped.merge(
-            tokens[["id", "lemma"]],
-            left_on="parent",
-            right_on="id",
-            suffixes=("", "lemma"),
-        )
-        mapped.columns = [
-            "child",
-            "parent",
-            "relation",
-            "child_id",
-            "child_lemma",
-            "parent_id",
-            "parent_lemma",
-        ]
-        return mapped, tokens
+        return Sentence(alpino_parse)
 
     # relational parser
-    def get_relation(self, mapped, child=True, relation=True, parent=True):
-        id_type = lambda x: type(x) != str
+    def get_relation(self, sentence, child=True, relation=True, parent=True):
+        """Returns the (child, relation, parent) dependencies of a sentence
+        matching a child and parent (a token id or lemma) and relation(s)"""
         if type(relation) not in [list, bool]:
             relation = [relation]
-        if id_type(child):
-            child_condition = (
-                type(child) == bool and (True) or (mapped.child_id == int(child))
-            )
-        else:
-            child_condition = (
-                type(child) == bool and True or (mapped.child_lemma == child)
-            )
-
-        relation_condition = (
-            type(relation) == bool and True or (mapped.relation.isin(relation))
-        )
-
-        if id_type(parent):
-            parent_condition = (
-                type(parent) == bool and (True) or (mapped.parent_id == int(parent))
-            )
+        if type(parent) not in [bool, str]:
+            candidates = [
+                (c, r, int(parent)) for c, r in sentence.children.get(int(parent), [])
+            ]
+        elif type(child) not in [bool, str]:
+            candidates = [
+                (int(child), r, p) for p, r in sentence.parents.get(int(child), [])
+            ]
         else:
-            parent_condition = (
-                type(parent) == bool and True or (mapped.parent_lemma == parent)
-            )
-
-        return mapped[
-            (mapped.child == mapped.child)
-            & child_condition
-            & relation_condition
-            & parent_condition
+            candidates = sentence.dependencies
+        return [
+            (c, r, p)
+            for c, r, p in candidates
+            if (relation is True or r in relation)
+            and _matches(child, c, sentence.lemma(c))
+            and _matches(parent, p, sentence.lemma(p))
         ]
 
-    def get_literal(self, tokens):
-        if tokens.empty:
+    def get_literal(self, sentence):
+        if not len(sentence):
             return []
         r = re.compile(r'["“”„:]|,{2,2}\'|\'[^s]')
-        tokens["hasquote"] = [
-            getattr(r.search(w), "group", lambda: None)() for w in tokens.word
-        ]
-        quotes = [
-            q
-            for q in tokens[[hq != None for hq in tokens.hasquote]]
-            .sort_values("offset")[["offset", "hasquote", "word"]]
-            .itertuples()
-        ]
+        quotes = []
+        for position in sentence.in_order(sentence.ids):
+            word = sentence.words[position]
+            hasquote = getattr(r.search(word), "group", lambda: None)()
+            if hasquote != None:
+                quotes.append((position, sentence.offsets[position], hasquote, word))
         indices = []
         startq = None
         colpos = None
@@ -566,262 +596,273 @@ class alpino_to_quote(Processer):
                 indices.append((startq[1], q[1]))
                 startq = None
         if colpos:
-            indices.append((colpos, max(tokens.offset)))
-        get_indices = lambda start, stop: list(range(start, stop + 1))
-        get_ids = lambda start, stop: list(
-            tokens.id[tokens.offset.isin(get_indices(start, stop))]
-        )
+            indices.append((colpos, max(sentence.offsets)))
+        get_ids = lambda start, stop: [
+            id
+            for id, offset in zip(sentence.ids, sentence.offsets)
+            if start <= offset <= stop
+        ]
         quote_lists = [get_ids(*indi) for indi in indices]
         return quote_lists
 
-    def get_series(self, tokens, start=0, end=False):
+    def get_series(self, sentence, start=0, end=False):
         if not end:
-            end = max(tokens.offset)
+            end = max(sentence.offsets)
         return " ".join(
-            tokens.sort_values("offset")[
-                (tokens.offset >= start) & (tokens.offset <= end)
-            ].word
+            sentence.words[position]
+            for position in sentence.in_order(sentence.ids)
+            if start <= sentence.offsets[position] <= end
         )
 
-    def get_list(self, tokens, indices, pos_major=""):
-        return tokens[tokens.id.isin(indices)].sort_values("offset").word
+    def get_list(self, sentence, indices, pos_major=""):
+        """Returns the words of tokens `indices`, sorted by offset"""
+        return [sentence.words[position] for position in sentence.in_order(indices)]
 
-    def tracer(self, mapped, wordid, direction="up", relations=True, prev=[]):
+    def tracer(self, sentence, wordid, direction="up", relations=True):
+        """Returns the ids of all tokens that can be reached from token(s)
+        `wordid` by following dependencies up (to parents) or down"""
+        if type(relations) not in [list, bool]:
+            relations = [relations]
+        adjacency = sentence.parents if direction == "up" else sentence.children
         trace = []
-        if direction == "up":
-            parent = self.get_relation(
-                mapped, relation=relations, child=wordid
-            ).parent.values
-        else:
-            parent = self.get_relation(
-                mapped, relation=relations, parent=wordid
-            ).child.values
-        if parent.any():
-            trace.extend([p for p in parent])
-            [
-                trace.extend(
-                    self.tracer(
-                        mapped, p, direction, relations=relations, prev=trace + prev
-                    )
-                )
-                for p in parent
-                if p not in prev
-            ]
+        seen = set()
+        stack = _id_list(wordid)[::-1]
+        while stack:
+            for related, relation in adjacency.get(stack.pop(), []):
+                if relations is not True and relation not in relations:
+                    continue
+                if related not in seen:
+                    seen.add(related)
+                    trace.append(related)
+                    stack.append(related)
         return trace
 
     # extract relations where necessary
-    def get_source(self, mapped, tokens, verb_id):
-        subject = tokens[
-            tokens.id.isin(
-                self.get_relation(mapped, relation="su", parent=verb_id).child
-            )
+    def get_source(self, sentence, verb_id):
+        subjects = [
+            c for c, r, p in self.get_relation(sentence, relation="su", parent=verb_id)
         ]
-        if subject.empty:
+        subjects = [id for id in sentence.ids if id in subjects]
+        if not subjects:
             return ""
-        elif subject.lemma.values[0] == "en":
+        elif sentence.lemma(subjects[0]) == "en":
             return ";".join(
-                self.get_list(tokens, self.tracer(mapped, subject.id, "down"))
+                self.get_list(sentence, self.tracer(sentence, subjects, "down"))
             )
         else:
-            return "".join(subject.word)
+            return "".join(sentence.word(id) for id in subjects)
 
-    def type_c(self, mapped, tokens):
-        if mapped.empty or tokens.empty:
+    def type_c(self, sentence):
+        if not sentence.dependencies:
             return []
-        verbs = tokens[tokens.lemma.isin(SPEACH_VERBS)]
         quotes = []
-        for verb_id in verbs.id:
+        for verb_id in sentence.select(lemmas=SPEACH_VERBS):
             type_c_relation = self.get_relation(
-                mapped, child="dat", relation="vc", parent=verb_id
+                sentence, child="dat", relation="vc", parent=verb_id
             )
-            if type_c_relation.empty:
+            if not type_c_relation:
                 return []
-            #    type_c_2_relation  = self.get_relation(mapped, child='hoop', relation='obj1', parent=verb_id)
-            #    if type_c_2_relation.empty: continue
-            #    type_c_2b_relation = self.get_relation(mapped, child='dat', relation='vc', parent=type_c_2_relation.child)
-            #    if type_c_2b_relation.empty:continue
-            #    body = self.get_list(diltokens,self.tracer(mapped,type_c_2b_relation.child,'down'))
-            # else:
-            body = self.get_list(
-                tokens, self.tracer(mapped, type_c_relation.child, "down")
-            )
-            verb_word = tokens[tokens.id == verb_id].word.values[0]
-            verb_lemma = tokens[tokens.id == verb_id].lemma.values[0]
-            source = self.get_source(mapped, tokens, verb_id)
+            children = [c for c, r, p in type_c_relation]
+            body = self.get_list(sentence, self.tracer(sentence, children, "down"))
+            source = self.get_source(sentence, verb_id)
             quotes.append(
                 {
                     "type": "C",
                     "literal": "no",
-                    "verb_lemma": verb_lemma,
-                    "verb_word": verb_word,
+                    "verb_lemma": sentence.lemma(verb_id),
+                    "verb_word": sentence.word(verb_id),
                     "source": source,
                     "body": " ".join(body),
                 }
             )
         return quotes
 
-    def type_a(self, mapped, tokens):
-        if tokens.empty or mapped.empty:
+    def type_a(self, sentence):
+        if not sentence.dependencies:
             return []
         quotes = []
-        verbs = tokens[tokens.lemma == "blijk"]
-        if verbs.empty:
+        verbs = sentence.select(lemmas=["blijk"])
+        if not verbs:
             return []
         type_a_relation = self.get_relation(
-            mapped, child="uit", relation="pc", parent=verbs.id.values[0]
+            sentence, child="uit", relation="pc", parent=verbs[0]
         )
-        if type_a_relation.empty:
+        if not type_a_relation:
             return []
         source = " ".join(
             self.get_list(
-                tokens, self.tracer(mapped, type_a_relation.child.values[0], "down")
+                sentence, self.tracer(sentence, type_a_relation[0][0], "down")
             )
         )
         type_a_body_relation = self.get_relation(
-            mapped, relation="su", parent=verbs.id.values[0]
+            sentence, relation="su", parent=verbs[0]
         )
-        if type_a_body_relation.empty:
-            body = ""
-        else:
-            body = self.get_list(
-                tokens, self.tracer(mapped, type_a_body_relation.child, "down")
-            )
-            if body.empty:
-                body = ""
-                pass  # Should solve for 'dat' reference
-            else:
-                body = " ".join(body)
+        body = self.get_list(
+            sentence,
+            self.tracer(sentence, [c for c, r, p in type_a_body_relation], "down"),
+        )
+        # Should solve for 'dat' reference if there is no body
+        body = " ".join(body)
         quotes.append(
             {
                 "type": "A",
                 "literal": "no",
                 "verb_lemma": "blijk",
-                "verb_word": verbs.word.values[0],
+                "verb_word": sentence.word(verbs[0]),
                 "source": source,
                 "body": body,
             }
         )
         return quotes
 
-    def pivot(self, mapped, series):
+    def pivot(self, sentence, series):
         pivots = set()
         for element in series:
             if not pivots:
-                pivots = set(self.tracer(mapped, element, "up"))
+                pivots = set(self.tracer(sentence, element, "up"))
             else:
-                pivots = pivots.intersection(set(self.tracer(mapped, element, "up")))
+                pivots = pivots.intersection(set(self.tracer(sentence, element, "up")))
         return pivots
 
-    def type_b(self, mapped, tokens):
-        if mapped.empty or tokens.empty:
-            return []
-        accordings = tokens[tokens.lemma.isin(["volgens", "aldus"])]
-        if accordings.empty:
+    def type_b(self, sentence):
+        if not sentence.dependencies:
             return []
+        accordings = sentence.select(lemmas=["volgens", "aldus"])
         quotes = []
-        for acc in accordings.id:
-            type_b_quote_relation = pandas.concat(
-                [
-                    self.get_relation(mapped, relation="tag", child=acc),
-                    self.get_relation(mapped, relation="mod", child=acc),
-                ]
-            )
-            source_ids = self.tracer(mapped, acc, "down")
-            pivot = set(self.tracer(mapped, acc, "up")).intersection(
-                set(self.tracer(mapped, type_b_quote_relation.parent, "up"))
+        for acc in accordings:
+            type_b_quote_relation = self.get_relation(
+                sentence, relation="tag", child=acc
+            ) + self.get_relation(sentence, relation="mod", child=acc)
+            source_ids = self.tracer(sentence, acc, "down")
+            pivot = set(self.tracer(sentence, acc, "up")).intersection(
+                set(
+                    self.tracer(
+                        sentence, [p for c, r, p in type_b_quote_relation], "up"
+                    )
+                )
             )
             quote_ids = [
                 id
-                for id in self.tracer(mapped, min(pivot), "down")
+                for id in self.tracer(sentence, min(pivot), "down")
                 if id not in source_ids + [acc]
             ]
             quotes.append(
                 {
                     "type": "B",
                     "literal": "no",
-                    "verb_lemma": tokens.lemma[tokens.id == acc].values[0],
-                    "verb_word": tokens.word[tokens.id == acc].values[0],
-                    "source": " ".join(self.get_list(tokens, source_ids)),
-                    "body": " ".join(self.get_list(tokens, quote_ids)),
+                    "verb_lemma": sentence.lemma(acc),
+                    "verb_word": sentence.word(acc),
+                    "source": " ".join(self.get_list(sentence, source_ids)),
+                    "body": " ".join(self.get_list(sentence, quote_ids)),
                 }
             )
         return quotes
 
-    def type_d(self, mapped, tokens):
+    def type_d(self, sentence):
         quotes = []
-        literals = self.get_literal(tokens)
-        merged_literals = []
+        literals = self.get_literal(sentence)
+        merged_literals = set()
         for literal in literals:
-            merged_literals.extend(literal)
+            merged_literals.update(literal)
         for literal in literals:
-            name = tokens.word[
-                (tokens.pos == "name") & (tokens.id.isin(merged_literals) == False)
-            ]
-            pron = tokens.word[
-                (tokens.pos == "pron") & (tokens.id.isin(merged_literals) == False)
-            ]
-
-            verb = tokens[
-                (tokens.lemma.isin(SPEACH_VERBS))
-                & (tokens.id.isin(merged_literals) == False)
-            ]
+            name = sentence.select(pos="name", exclude=merged_literals)
+            pron = sentence.select(pos="pron", exclude=merged_literals)
+            verb = sentence.select(lemmas=SPEACH_VERBS, exclude=merged_literals)
 
-            if not name.empty:
-                source = " ".join(name)
+            if name:
+                source = " ".join(sentence.word(id) for id in name)
             else:
-                source = " ".join(pron)
+                source = " ".join(sentence.word(id) for id in pron)
             quotes.append(
                 {
                     "type": "D",
                     "literal": "yes",
-                    "verb_lemma": " ".join(verb.lemma),
-                    "verb_word": " ".join(verb.word),
+                    "verb_lemma": " ".join(sentence.lemma(id) for id in verb),
+                    "verb_word": " ".join(sentence.word(id) for id in verb),
                     "source": source,
-                    "body": " ".join(self.get_list(tokens, literal)),
+                    "body": " ".join(self.get_list(sentence, literal)),
                 }
             )
         return quotes
 
-    def type_e(self, mapped, tokens):
-        if mapped.empty or tokens.empty:
+    def type_e(self, sentence):
+        if not sentence.dependencies:
             return []
         quotes = []
-        verbs = tokens[(tokens.lemma.isin(SPEACH_VERBS)) & (tokens.pos == "verb")]
-        for token in verbs.id:
-            verb = tokens[(tokens.lemma.isin(SPEACH_VERBS))]
+        verbs = sentence.select(lemmas=SPEACH_VERBS, pos="verb")
+        for token in verbs:
+            verb = sentence.select(lemmas=SPEACH_VERBS)
 
-            verb_sub = self.get_relation(mapped, relation="su", parent=token)
-            if verb_sub.empty:
+            verb_sub = self.get_relation(sentence, relation="su", parent=token)
+            verb_sub = [c for c, r, p in verb_sub]
+            if not verb_sub:
                 return []
-            verb_source = self.tracer(
-                mapped, verb_sub.child, "down", relations=["det", "de", "mod"]
-            ) + list(verb_sub.child)
-
-            verb_obj = self.get_relation(mapped, relation="obj1", parent=token)
-            if verb_obj.empty:
-                verb_obj = self.get_relation(mapped, relation="nucl", parent=token)
-            if verb_obj.empty:
-                verb_obj = self.get_relation(mapped, relation="dp", parent=token)
-            if not verb_obj.empty:
-                verb_body = self.tracer(mapped, verb_obj.child, "down") + list(
-                    verb_obj.child
-                )
-            else:
-                verb_body = []
+            verb_source = (
+                self.tracer(sentence, verb_sub, "down", relations=["det", "de", "mod"])
+                + verb_sub
+            )
+
+            for relation in ["obj1", "nucl", "dp"]:
+                verb_obj = [
+                    c
+                    for c, r, p in self.get_relation(
+                        sentence, relation=relation, parent=token
+                    )
+                ]
+                if verb_obj:
+                    break
+            verb_body = self.tracer(sentence, verb_obj, "down") + verb_obj
 
             quotes.append(
                 {
                     "type": "E",
                     "literal": "no",
-                    "verb_lemma": " ".join(verb.lemma),
-                    "verb_word": " ".join(verb.word),
-                    "source": " ".join(self.get_list(tokens, verb_source)),
-                    "body": " ".join(self.get_list(tokens, verb_body)),
+                    "verb_lemma": " ".join(sentence.lemma(id) for id in verb),
+                    "verb_word": " ".join(sentence.word(id) for id in verb),
+                    "source": " ".join(self.get_list(sentence, verb_source)),
+                    "body": " ".join(self.get_list(sentence, verb_body)),
                 }
             )
         return quotes
 
 
+def _extract_quotes(alpino_result):
+    try:
+        return alpino_to_quote().process(alpino_result)
+    except Exception as e:
+        logger.warning("Unable to extract quotes: {e}".format(e=e))
+        return None
+
+
+def extract_quotes(alpino_results, processes=None, chunksize=20):
+    """Extracts quotes from many parsed documents in a pool of worker processes
+
+    Parameters
+    ----
+    alpino_results : iterable
+        The alpino results (as returned by the `alpino` processor) of each
+        document, can be a generator
+    processes : int (default=None)
+        Number of worker processes, defaults to the number of CPUs. Set to
+        1 to extract quotes in the current process.
+    chunksize : int (default=20)
+        Number of documents sent to a worker at once
+
+    Yields
+    ----
+    list or None
+        The quotes per document, in input order. None if extraction raised
+        an exception.
+    """
+    if processes == 1:
+        for alpino_result in alpino_results:
+            yield _extract_quotes(alpino_result)
+        return
+    with Pool(processes) as pool:
+        for quotes in pool.imap(_extract_quotes, alpino_results, chunksize=chunksize):
+            yield quotes
+
+
 def alpino_to_quote_tests():
     testset = json.load(open("processing/testdata/parsed_DE_8.json"))
 
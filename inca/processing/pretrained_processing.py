@@ -4,27 +4,59 @@ from ..core.basic_utils import dotkeys
 import logging
 import re
 import sys
+import threading
 
 import joblib
-from numpy import ndarray, int64
+from numpy import ndarray, generic
+
+logger = logging.getLogger("INCA")
+
+_models = {}  # path : model, loaded once per process
+_lock = threading.Lock()
+
+
+def load_model(path_to_model, mmap_mode="r"):
+    """Returns the model saved with joblib at `path_to_model`
+
+    Models are loaded once per (worker) process and cached by path. Numpy
+    arrays in the model are memory-mapped read-only if the file is not
+    compressed, so processes on the same machine share them.
+    """
+    model = _models.get(path_to_model)
+    if model is None:
+        with _lock:
+            model = _models.get(path_to_model)
+            if model is None:
+                logger.info("Loading model {path}".format(path=path_to_model))
+                model = _models[path_to_model] = joblib.load(
+                    path_to_model, mmap_mode=mmap_mode
+                )
+    return model
+
+
+def _python_value(prediction):
+    if type(prediction) is ndarray:
+        return prediction.tolist()
+    if isinstance(prediction, generic):
+        return prediction.item()
+    return prediction
 
 
 class pretrained(Processer):
     """annotated based on pretrained model"""
 
+    output_type = "keyword"
+
     def process(self, document_field, path_to_model):
         """classification based on pretrained model"""
-        try:
-            prediction = self.clf.predict([document_field])
-        except AttributeError:
-            self.load_model(path_to_model)
-            prediction = self.clf.predict([document_field])
-
-        if type(prediction) is ndarray and len(prediction) == 1:
-            prediction = prediction[0]
-        if type(prediction) is int64:
-            prediction = int(prediction)
-        return prediction
+        return self.process_batch([document_field], path_to_model)[0]
+
+    def process_batch(self, document_fields, path_to_model):
+        """classification of a batch of documents based on pretrained model"""
+        if not document_fields:
+            return []
+        self.load_model(path_to_model)
+        return [_python_value(p) for p in self.clf.predict(document_fields)]
 
     def load_model(self, path_to_model):
-        self.clf = joblib.load(path_to_model)
+        self.clf = load_model(path_to_model)
@@ -50,6 +50,9 @@ class redownload(Processer):
     Sometimes, content is not correctly downloaded, for instance due to
     a new cookie wall. This allows to re-download the content
     by specifiying the new function to download the content
+
+    To re-download many documents, see core.redownload, which downloads
+    concurrently and can be resumed.
     """
 
     def process(
@@ -1,3 +1,9 @@
+"""
+Modules in this package are imported on first access (for instance
+`inca.rssscrapers.<module>`) or all at once with `import_all`, which registers
+their tasks with celery. See `core.registry`.
+"""
+
 import os as _os
 from importlib import import_module
 
@@ -5,15 +11,19 @@ _expected_file_end = "_scraper.py"
 
 __all__ = [
     fname
-    for fname in _os.listdir("rssscrapers")
+    for fname in _os.listdir(_os.path.dirname(__file__))
     if fname[-len(_expected_file_end) :] == _expected_file_end
     and not fname.startswith(".")
 ]
 
-# print (__all__)
-for module in __all__:
-    __import__(".".join(["inca.rssscrapers", module.replace(".py", "")]))
-    # import_module(module.replace('.py',''), package='inca.rssscrapers')
 
-# from . import taz_scraper
-# __import__('taz_scraper')
+def import_all():
+    """Imports all modules in this package"""
+    for module in __all__:
+        import_module("." + module.replace(".py", ""), package=__name__)
+
+
+def __getattr__(name):
+    if name + ".py" in __all__:
+        return import_module("." + name, package=__name__)
+    raise AttributeError("module {} has no attribute {}".format(__name__, name))
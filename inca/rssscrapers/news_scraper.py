@@ -3,6 +3,7 @@ from lxml.html import fromstring
 from inca.core.scraper_class import Scraper
 from inca.scrapers.rss_scraper import rss
 from inca.core.database import check_exists
+from inca.core.extraction import Extractor, Field
 import feedparser
 import re
 import logging
@@ -299,9 +300,48 @@ class nu(rss):
         return images
 
 
+def _element_text(element):
+    return (element.text or "").strip()
+
+
+def _single_line(text):
+    return text.replace("\n", " ")
+
+
+def _nos_images(img_list):
+    img = img_list[0]
+    return [{"url": img.attrib["src"], "alt": img.attrib["alt"]}]
+
+
 class nos(rss):
     """Scrapes nos.nl """
 
+    extractor = Extractor(
+        {
+            "title": Field("//h1", first=True, process=_element_text),
+            "category": Field(
+                '//*/a[@id="link-grey"]//text()',
+                '//*[@id="content"]/article/header/div/div/div/div/div/div/span/a/text()',
+                join="",
+            ),
+            "teaser": Field('//*[@class="article_textwrap"]/p/em//text()', first=True),
+            "text": Field(
+                '//*[@class="article_textwrap"]/p//text()', join=" ", process=polish
+            ),
+            "byline": Field(
+                '//*[@id="content"]/article/section/div/div/div/span/text()',
+                first=True,
+                strip=False,
+                process=_single_line,
+            ),
+            "images": Field(
+                '//figure[@class="article_head_image block_largecenter"]//img',
+                default=[],
+                process=_nos_images,
+            ),
+        }
+    )
+
     def __init__(self):
         self.doctype = "nos (www)"
         self.rss_url = "http://feeds.nos.nl/nosnieuwsalgemeen"
@@ -329,86 +369,11 @@ class nos(rss):
         image: images included in the article
         """
 
-        try:
-            tree = fromstring(htmlsource)
-        except:
-            logger.error("HTML tree cannot be parsed")
-        try:
-            title = tree.xpath("//h1")[0].text
-        except:
-            title = ""
-            logger.warning("Could not parse article title")
-        try:
-            category = "".join(tree.xpath('//*/a[@id="link-grey"]//text()'))
-        except:
-            category = ""
-            logger.debug("Could not parse article title")
-        if category == "":
-            try:
-                category = "".join(
-                    tree.xpath(
-                        '//*[@id="content"]/article/header/div/div/div/div/div/div/span/a/text()'
-                    )
-                )
-            except:
-                category = ""
-                logger.debug("Could not parse article category")
-        try:
-            teaser = tree.xpath('//*[@class="article_textwrap"]/p/em//text()')[0]
-        except:
-            logger.debug("Could not parse article teaser")
-            teaser = ""
-        try:
-            text = " ".join(
-                tree.xpath('//*[@class="article_textwrap"]/p//text()')
-            ).strip()
-        except:
-            text = ""
-            logger.warning("Could not parse article text")
-        try:
-            author_door = tree.xpath(
-                '//*[@id="content"]/article/section/div/div/div/span/text()'
-            )[0]
-        except:
-            author_door = ""
-            logger.debug("Could not parse article source")
-        author_bron = ""
-        text = polish(text)
-
-        images = nos._extract_images(self, tree)
-
-        extractedinfo = {
-            "title": title.strip(),
-            "category": category.strip(),
-            "teaser": teaser.strip(),
-            "text": text.strip(),
-            "byline": author_door.replace("\n", " "),
-            "byline_source": author_bron.replace("\n", " ").strip(),
-            "images": images,
-        }
-
+        extractedinfo = nos.extractor(htmlsource)
+        if extractedinfo:
+            extractedinfo["byline_source"] = ""
         return extractedinfo
 
-    def _extract_images(self, dom_nodes):
-        images = []
-        for element in dom_nodes:
-            try:
-                img = element.xpath(
-                    '//figure[@class="article_head_image block_largecenter"]//img'
-                )[0]
-                image = {
-                    "url": img.attrib["src"],
-                    #'height' : img.attrib['height'],
-                    #'width' : img.attrib['width'],
-                    #'caption' : element.xpath(element.xpath('.//div[@Class="caption_content"]/text()')),
-                    "alt": img.attrib["alt"],
-                }
-                if image["url"] not in [i["url"] for i in images]:
-                    images.append(image)
-            except IndexError:
-                pass
-        return images
-
     def getlink(self, link):
         """modifies the link to the article to bypass the cookie wall"""
         # link=re.sub("/$","",link)
@@ -3,7 +3,9 @@ import datetime
 from lxml.html import fromstring
 from ..core.scraper_class import Scraper
 from ..core.scraper_class import UnparsableException
-from ..core.database import check_exists
+from ..core.database import check_exists, config
+from ..core.feed_state import FeedState
+from ..core import instrumentation
 import logging
 import feedparser
 import re
@@ -13,6 +15,9 @@ from urllib.request import HTTPCookieProcessor
 
 logger = logging.getLogger("INCA")
 
+# seconds to wait for a server before giving up on a request
+REQUEST_TIMEOUT = config.getfloat("rss", "request_timeout", fallback=30)
+
 
 def set_cookies(link):
     """
@@ -32,7 +37,9 @@ def set_cookies(link):
         "tubantia.nl",
     ]
     if "telegraaf.nl" in link:
-        link2 = requests.get(link, headers={"User-Agent": "Wget/1.9"}).url
+        link2 = requests.get(
+            link, headers={"User-Agent": "Wget/1.9"}, timeout=REQUEST_TIMEOUT
+        ).url
         cookie_url = requests.utils.unquote(link2)
         if "tmgonlinemedia.nl" in cookie_url:
             cookie = re.search("nl/&(.+?)&detect", cookie_url).group(1) + ".essential"
@@ -79,15 +86,29 @@ class rss(Scraper):
         By overwriting the getlink function, modifications to the link can be made, e.g. to bypass cookie walls
     """
 
+    field_types = {
+        "title_rss": "text",
+        "teaser_rss": "text",
+        "category": "keyword",
+        "byline": "keyword",
+        "byline_source": "keyword",
+        "images": "disabled",
+    }
+
     def __init__(self):
         Scraper.__init__(self)
         self.doctype = "rss"
         self.version = ".1"
         self.date = datetime.datetime(year=2016, month=8, day=2)
 
-    def get(self, save, **kwargs):
+    def get(self, save, use_feedstate=True, **kwargs):
         """Document collected via {} feed reader""".format(self.doctype)
 
+        # When saving, a persistent per-feed state (see core.feed_state) is
+        # used to skip feeds that did not change since the last run and to
+        # only look up entries in the database that were not seen before.
+        # Pass use_feedstate=False to check every entry again.
+
         # This RSS-scraper is a generic fallback option in case we do not have
         # any specific one. Therefore, only use the following generic values
         # if we do not have any more specific info already
@@ -107,8 +128,20 @@ class rss(Scraper):
             RSS_URL = [RSS_URL]
 
         for thisurl in RSS_URL:
-            rss_body = self.get_page_body(thisurl)
+            if save and use_feedstate:
+                state = FeedState(thisurl)
+            else:
+                state = None
+            rss_body = self._get_feed_body(thisurl, state)
+            if rss_body is None:
+                logger.info(
+                    "Feed {thisurl} did not change since last run, skipping".format(
+                        **locals()
+                    )
+                )
+                continue
             d = feedparser.parse(rss_body)
+            entries = []
             for post in d.entries:
                 try:
                     _id = post.id
@@ -116,6 +149,16 @@ class rss(Scraper):
                     _id = post.link
                 if _id == None:
                     _id = post.link
+                entries.append((_id, post))
+            if state is not None:
+                unseen = set(state.unseen([_id for _id, post in entries]))
+                logger.debug(
+                    "{} of {} entries in {} not seen before".format(
+                        len(unseen), len(entries), thisurl
+                    )
+                )
+                entries = [(_id, post) for _id, post in entries if _id in unseen]
+            for _id, post in entries:
                 link = re.sub("/$", "", self.getlink(post.link))
                 # By now, we have retrieved the RSS feed. We now have to determine for the item that
                 # we are currently processing (post in d.entries), whether we want to follow its
@@ -130,7 +173,9 @@ class rss(Scraper):
                             link,
                             headers={"User-Agent": "Wget/1.9"},
                             cookies=set_cookies(link),
+                            timeout=REQUEST_TIMEOUT,
                         )
+                        self._observe_fetch(req)
                         htmlsource = req.text
                     except:
                         htmlsource = None
@@ -147,7 +192,9 @@ class rss(Scraper):
                                     "User-Agent": "Mozilla/5.0 (Windows NT 6.1; Win64; x64; rv:47.0) Gecko/20100101 Firefox/47.0"
                                 },
                                 cookies=set_cookies(link),
+                                timeout=REQUEST_TIMEOUT,
                             )
+                            self._observe_fetch(req)
                             htmlsource = req.text
                         except:
                             htmlsource = None
@@ -195,13 +242,58 @@ class rss(Scraper):
                     doc.update(parsedurl)
                     docnoemptykeys = {k: v for k, v in doc.items() if v or v == False}
                     yield docnoemptykeys
+                if state is not None:
+                    state.mark_seen(_id)
+            if state is not None:
+                self._save_feedstate(state)
+
+    def _save_feedstate(self, state):
+        """Stores the state of a feed after all its entries are yielded.
+        Callers that save the documents in batches (see core.scrape_runner)
+        replace this to save the documents of the feed first."""
+        state.save()
+
+    def _get_feed_body(self, url, state=None):
+        """Retrieves the feed body, returns None if the feed did not change
+
+        If no state is given, this simply calls `get_page_body`. Otherwise,
+        scrapers that do not overwrite `get_page_body` issue a conditional
+        request using the stored ETag and Last-Modified values, and all
+        scrapers compare the hash of the body with that of the previous run.
+        """
+        if state is None:
+            return self.get_page_body(url)
+        if type(self).get_page_body is rss.get_page_body:
+            headers = {"User-Agent": "Wget/1.9"}
+            headers.update(state.request_headers())
+            request = self._observe_fetch(
+                requests.get(url, headers=headers, timeout=REQUEST_TIMEOUT)
+            )
+            if request.status_code == 304:
+                return None
+            state.update_validators(request.headers)
+            rss_body = request.text
+        else:
+            rss_body = self.get_page_body(url)
+        if not state.body_changed(rss_body):
+            return None
+        return rss_body
 
     def get_page_body(self, url, **kwargs):
         """Makes an HTTP request to the given URL and returns a string containing the response body"""
-        request = requests.get(url, headers={"User-Agent": "Wget/1.9"})
+        request = requests.get(
+            url, headers={"User-Agent": "Wget/1.9"}, timeout=REQUEST_TIMEOUT
+        )
+        self._observe_fetch(request)
         response_body = request.text
         return response_body
 
+    def _observe_fetch(self, response):
+        """Records the latency of an HTTP request (see core.instrumentation)"""
+        return instrumentation.observe_response(
+            response, task=self.__class__.__name__
+        )
+
     def parsehtml(self, htmlsource):
         """
         Parses the html source and extracts more keys that can be added to the doc
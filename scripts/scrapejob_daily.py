@@ -1,6 +1,7 @@
 #!/usr/bin/env python3
 
 from inca import Inca
+from inca.clients.twitter_client import twitter_timeline
 import time
 
 myinca = Inca()
@@ -124,10 +125,8 @@ accounts = [
     "santander",
 ]
 
+# all accounts at once, spread over the available credentials
+results = twitter_timeline().harvest(accounts)
 for account in accounts:
-    print(account)
-    try:
-        myinca.clients.twitter_timeline(screen_name=account)
-    except Exception as e:
+    if results.get(account) is None:
         print("issue with", account)
-        print(e)
@@ -1,16 +1,13 @@
 #!/usr/bin/env python3
-from inca import Inca
-
-myinca = Inca()
-
-outlets = [outlet for outlet in dir(myinca.rssscrapers) if not outlet.startswith("__")]
-
-
-for outlet in outlets:
-    print("Scraping {}...".format(outlet))
-    try:
-        eval("myinca.rssscrapers.{}()".format(outlet))
-    except Exception as ex:
-        print("'\nERROR SCRAPING {}.".format(outlet))
-        print(ex)
-        print("\n")
+from inca.core.scrape_runner import run_all_rssscrapers
+
+results = run_all_rssscrapers(max_workers=16, timeout=900)
+
+for result in sorted(results, key=lambda r: r["scraper"]):
+    print(
+        "{scraper:<30} {status:<8} {found:>5} found {new:>5} new "
+        "{fetches:>5} fetches ({fetch_seconds:.1f}s) "
+        "{parse_failures:>3} parse failures {seconds:>7.1f}s".format(**result)
+    )
+    if result["error"]:
+        print("    ERROR SCRAPING {scraper}: {error}".format(**result))